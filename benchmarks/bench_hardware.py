@@ -0,0 +1,249 @@
+"""
+Benchmark of the hardware access on a simulated, timed SMBus.
+
+Run with `python -m benchmarks.bench_hardware --help`.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Sequence, TypeVar
+
+from benchmarks import timed_smbus
+from benchmarks.timed_smbus import BusTiming, TimedSMBus
+
+# The simulated bus replaces the smbus module if it is not installed (i.e. not on the Raspberry PI).
+sys.modules.setdefault('smbus', timed_smbus)
+
+import device_server.bay.controller  # noqa: E402
+from device_server.bay.station import Station  # noqa: E402
+from device_server.config import config  # noqa: E402
+
+
+T = TypeVar('T')
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    # Latencies in seconds of the successful operations.
+    latencies: List[float]
+    errors: int
+    # Wall time in seconds of the whole benchmark.
+    duration: float
+    transactions: int
+
+    @property
+    def samples(self) -> int:
+        """ Number of operations, successful or not. """
+        return len(self.latencies) + self.errors
+
+    @property
+    def requests_per_second(self) -> float:
+        return self.samples / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def transactions_per_request(self) -> float:
+        return self.transactions / self.samples if self.samples > 0 else 0.0
+
+    def percentile(self, q: float) -> float:
+        """ Latency percentile in seconds (nearest rank). """
+        if not self.latencies:
+            return float('nan')
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, max(0, int(round(q / 100 * len(latencies))) - 1))]
+
+    def format(self) -> str:
+        return (
+            f"{self.name:<28} {self.samples:>7} {self.errors:>6} {self.percentile(50) * 1000:>9.3f} "
+            f"{self.percentile(99) * 1000:>9.3f} {self.requests_per_second:>9.1f} {self.transactions_per_request:>9.2f}"
+        )
+
+
+RESULT_HEADER = (
+    f"{'benchmark':<28} {'samples':>7} {'errors':>6} {'p50 [ms]':>9} {'p99 [ms]':>9} {'req/s':>9} {'tx/req':>9}"
+)
+
+
+def bench_call(
+        name: str,
+        fn: Callable[[], T],
+        iterations: int,
+        concurrency: int,
+        failed: Optional[Callable[[T], bool]] = None,
+) -> BenchmarkResult:
+    """ Calls fn iterations times from concurrency threads. Calls which raise OSError or are failed count as errors. """
+
+    def timed_call() -> Optional[float]:
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except OSError:
+            return None
+        if failed is not None and failed(result):
+            return None
+        return time.perf_counter() - start
+
+    transactions = TimedSMBus.total_transactions()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda _: timed_call(), range(iterations)))
+    duration = time.perf_counter() - start
+    latencies = [latency for latency in results if latency is not None]
+    return BenchmarkResult(
+        name=name,
+        latencies=latencies,
+        errors=len(results) - len(latencies),
+        duration=duration,
+        transactions=TimedSMBus.total_transactions() - transactions,
+    )
+
+
+async def bench_http(
+        name: str, method: str, path: str, iterations: int, concurrency: int
+) -> BenchmarkResult:
+    """ Sends iterations requests to the app with concurrency requests in flight. """
+    import httpx
+    from device_server.api import app
+
+    latencies: List[float] = []
+    errors = 0
+    pending = iter(range(iterations))
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path)
+            except OSError:
+                errors += 1
+                continue
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    transactions = TimedSMBus.total_transactions()
+    start = time.perf_counter()
+    async with httpx.AsyncClient(app=app, base_url='http://bench') as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    return BenchmarkResult(
+        name=name,
+        latencies=latencies,
+        errors=errors,
+        duration=duration,
+        transactions=TimedSMBus.total_transactions() - transactions,
+    )
+
+
+async def _run_http_benchmarks(
+        iterations: int, concurrency: int, actuation_iterations: int, timing: BusTiming
+) -> List[BenchmarkResult]:
+    import device_server.api.bay
+    from device_server.api.bay import bay_startup, bay_shutdown
+
+    # Configure the controllers without simulated errors.
+    TimedSMBus.timing = BusTiming()
+    await bay_startup()
+    station = device_server.api.bay.station
+    assert isinstance(station, Station), "The benchmark requires the station in this process"
+    station.wait_configured()
+    TimedSMBus.timing = timing
+    try:
+        bay_id = config.station.bays[0][0]
+        return [
+            await bench_http('GET /bays', 'GET', '/api/v1/device/bays', iterations, concurrency),
+            await bench_http(f'GET /bays/{bay_id}', 'GET', f'/api/v1/device/bays/{bay_id}', iterations, concurrency),
+            await bench_http(
+                f'POST /bays/{bay_id}/open', 'POST', f'/api/v1/device/bays/{bay_id}/open',
+                actuation_iterations, concurrency,
+            ),
+        ]
+    finally:
+        await bay_shutdown()
+
+
+def run_benchmarks(
+        iterations: int = 200,
+        concurrency: int = 8,
+        actuation_iterations: int = 5,
+        timing: Optional[BusTiming] = None,
+        http: bool = True,
+) -> List[BenchmarkResult]:
+    """ Runs all benchmarks on the simulated bus with the station of the loaded config. """
+    if timing is None:
+        timing = BusTiming()
+    TimedSMBus.reset()
+    smbus_cls = device_server.bay.controller.SMBus
+    device_server.bay.controller.SMBus = TimedSMBus
+    try:
+        station = Station(config.station)
+        try:
+            # Configure the controllers without simulated errors.
+            station.configure()
+            station.wait_configured()
+            TimedSMBus.timing = timing
+            bay_id = next(iter(station.bays))
+            results = [
+                # Bays which could not be read are None
+                bench_call(
+                    'Station.get_states', station.get_states, iterations, concurrency,
+                    failed=lambda states: None in states.values(),
+                ),
+                bench_call(
+                    'Station.get_state', lambda: station.get_state(bay_id), iterations, concurrency,
+                    failed=lambda state: state is None,
+                ),
+                bench_call('Station.open_bay', lambda: station.open_bay(bay_id), actuation_iterations, 1),
+                bench_call('Station.open_all_bays', station.open_all_bays, actuation_iterations, 1),
+            ]
+        finally:
+            station.stop()
+        if http:
+            loop = asyncio.new_event_loop()
+            try:
+                results += loop.run_until_complete(
+                    _run_http_benchmarks(iterations, concurrency, actuation_iterations, timing)
+                )
+            finally:
+                loop.close()
+    finally:
+        device_server.bay.controller.SMBus = smbus_cls
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200, help="Number of state reads per benchmark")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent callers")
+    parser.add_argument('--actuation-iterations', type=int, default=5, help="Number of actuations per benchmark")
+    parser.add_argument('--us-per-byte', type=float, default=BusTiming.us_per_byte)
+    parser.add_argument('--clock-stretch-probability', type=float, default=BusTiming.clock_stretch_probability)
+    parser.add_argument('--clock-stretch-us', type=float, default=BusTiming.clock_stretch_us)
+    parser.add_argument('--nack-probability', type=float, default=BusTiming.nack_probability)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-http', action='store_true', help="Skip the benchmarks of the HTTP endpoints")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        iterations=args.iterations,
+        concurrency=args.concurrency,
+        actuation_iterations=args.actuation_iterations,
+        timing=BusTiming(
+            us_per_byte=args.us_per_byte,
+            clock_stretch_probability=args.clock_stretch_probability,
+            clock_stretch_us=args.clock_stretch_us,
+            nack_probability=args.nack_probability,
+            seed=args.seed,
+        ),
+        http=not args.no_http,
+    )
+    print(RESULT_HEADER)
+    for result in results:
+        print(result.format())
+
+
+if __name__ == '__main__':
+    main()
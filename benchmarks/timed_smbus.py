@@ -0,0 +1,98 @@
+import errno
+import random
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import ClassVar, DefaultDict, Dict, Optional
+
+
+class BusTiming:
+    """ Timing model of the simulated I2C bus. """
+
+    # Time to transfer one byte including the ACK bit (9 clocks at 100 kHz).
+    us_per_byte: float = 90.0
+    # Probability that the slave stretches the clock of a transaction and the additional time.
+    clock_stretch_probability: float = 0.0
+    clock_stretch_us: float = 500.0
+    # Probability that a transaction is not acknowledged (raises OSError like the kernel driver).
+    nack_probability: float = 0.0
+
+    def __init__(
+            self,
+            us_per_byte: Optional[float] = None,
+            clock_stretch_probability: Optional[float] = None,
+            clock_stretch_us: Optional[float] = None,
+            nack_probability: Optional[float] = None,
+            seed: int = 0,
+    ):
+        if us_per_byte is not None:
+            self.us_per_byte = us_per_byte
+        if clock_stretch_probability is not None:
+            self.clock_stretch_probability = clock_stretch_probability
+        if clock_stretch_us is not None:
+            self.clock_stretch_us = clock_stretch_us
+        if nack_probability is not None:
+            self.nack_probability = nack_probability
+        self.random = random.Random(seed)
+
+
+class TimedSMBus:
+    """
+    Simulated SMBus with the interface of `smbus.SMBus`, which charges the time of every transaction to the calling
+    thread. Transactions on the same bus are serialized like by the kernel driver.
+    """
+
+    timing: ClassVar[BusTiming] = BusTiming()
+    # Register values by (port, address, register).
+    state: ClassVar[Dict[tuple, int]] = {}
+    # Number of transactions by port.
+    transactions: ClassVar[DefaultDict[int, int]] = defaultdict(int)
+    _bus_locks: ClassVar[DefaultDict[int, Lock]] = defaultdict(Lock)
+    _lock: ClassVar[Lock] = Lock()
+
+    def __init__(self, port: int):
+        self.port = port
+        with self._lock:
+            self._bus_lock = self._bus_locks[port]
+
+    @classmethod
+    def reset(cls, timing: Optional[BusTiming] = None):
+        """ Reset the counters, the register state and optionally set a new timing model. """
+        with cls._lock:
+            if timing is not None:
+                cls.timing = timing
+            cls.state.clear()
+            cls.transactions.clear()
+
+    @classmethod
+    def total_transactions(cls) -> int:
+        with cls._lock:
+            return sum(cls.transactions.values())
+
+    def _transaction(self, address: int, n_bytes: int):
+        with self._lock:
+            self.transactions[self.port] += 1
+            duration = n_bytes * self.timing.us_per_byte
+            if self.timing.random.random() < self.timing.clock_stretch_probability:
+                duration += self.timing.clock_stretch_us
+            nack = self.timing.random.random() < self.timing.nack_probability
+        with self._bus_lock:
+            # Like the ioctl of the kernel driver, the transaction releases the GIL.
+            time.sleep(duration * 1e-6)
+        if nack:
+            raise OSError(errno.EREMOTEIO, f"Remote I/O error (address 0x{address:02x} on bus {self.port})")
+
+    def read_byte_data(self, address: int, register: int) -> int:
+        # Address + register, repeated start with address, data byte.
+        self._transaction(address, 4)
+        return self.state.get((self.port, address, register), 0xff)
+
+    def write_byte_data(self, address: int, register: int, value: int) -> None:
+        # Address + register + data byte.
+        self._transaction(address, 3)
+        with self._lock:
+            self.state[(self.port, address, register)] = value
+
+
+# Allows installing this module in place of the smbus module.
+SMBus = TimedSMBus
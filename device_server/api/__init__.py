@@ -1,13 +1,19 @@
 from fastapi import FastAPI, APIRouter
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 
 from .bay import router as bays_router, bay_startup, bay_shutdown
 from .auth import router as auth_router, card_startup, card_shutdown
+from .metrics import router as metrics_router, MetricsMiddleware
+from device_server.bay.controller import ControllerDegraded
+from device_server.bay.executor import BusOverloaded
 from device_server.config import config
 
 router = APIRouter()
 router.include_router(bays_router, prefix='/api/v1/device')
 router.include_router(auth_router, prefix='/api/v1/auth')
+router.include_router(metrics_router)
 
 
 app = FastAPI()
@@ -18,5 +24,12 @@ app.add_middleware(
     allow_methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'],
     allow_headers=['*'],
 )
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(router)
+
+
+@app.exception_handler(BusOverloaded)
+@app.exception_handler(ControllerDegraded)
+async def hardware_unavailable_handler(request: Request, exc: Exception) -> JSONResponse:
+    return JSONResponse({'detail': str(exc)}, status_code=503, headers={'Retry-After': '1'})
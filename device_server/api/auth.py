@@ -1,30 +1,51 @@
-import httpx
-from fastapi import APIRouter, Body
-from starlette.responses import Response
-from typing import Optional
+import device_server.api.bay
+from fastapi import APIRouter, Body, Query
+from starlette.responses import JSONResponse, Response
+from typing import Optional, Union
 
+from device_server.card.authorizer import CardAuthorizer
 from device_server.card.reader import CardReader
 from device_server.config import config
+from device_server.hardware.client import RemoteCardAuthorizer, RemoteCardReader
 from device_server.model.auth import AuthenticationResult, CardModel
 
 router = APIRouter()
-card_reader: Optional[CardReader] = None
+card_reader: Optional[Union[CardReader, RemoteCardReader]] = None
+authorizer: Optional[Union[CardAuthorizer, RemoteCardAuthorizer]] = None
 
 
 @router.on_event('startup')
 async def card_startup():
-    global card_reader
+    global card_reader, authorizer
     assert card_reader is None, "Already initialized"
-    card_reader = CardReader(config.card_auth)
+    if config.hardware.socket_path is not None:
+        # The hardware process authorizes the read cards once for all workers and notifies its station itself.
+        card_reader = RemoteCardReader(config.card_auth, config.hardware)
+        authorizer = RemoteCardAuthorizer(config.hardware)
+    else:
+        card_reader = CardReader(config.card_auth)
+        authorizer = CardAuthorizer(config.card_auth)
+        card_reader.add_listener(authorizer.prefetch)
+        card_reader.add_listener(_notify_station_activity)
     card_reader.start()
+    authorizer.start()
 
 
 @router.on_event('shutdown')
 async def card_shutdown():
-    global card_reader
+    global card_reader, authorizer
     assert card_reader is not None, "Not initialized"
     card_reader.stop()
     card_reader = None
+    await authorizer.stop()
+    authorizer = None
+
+
+def _notify_station_activity(card_id: str):
+    # Bays are about to be opened after a card tap.
+    station = device_server.api.bay.station
+    if station is not None:
+        station.notify_activity()
 
 
 @router.get(
@@ -33,20 +54,19 @@ async def card_shutdown():
     response_model=AuthenticationResult,
     responses={404: {'model': CardModel}},
 )
-async def get_card():
-    """Gets the authentication result. If 404 is returned, a card was found but not registered yet."""
-    card_id = card_reader.read_card_id()
+async def get_card(wait: float = Query(0, ge=0, le=60)):
+    """
+    Gets the authentication result. If 404 is returned, a card was found but not registered yet. If wait is given, waits
+    up to wait seconds for a card.
+    """
+    assert card_reader is not None and authorizer is not None, "Not initialized"
+    card_id = await card_reader.wait_card_id(wait)
     if card_id is None:
         return Response(status_code=204)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{config.card_auth.server_url}/card/authorize",
-            json=CardModel(card_id=card_id).dict(),
-            headers={'X-Card-Api-Key': config.card_auth.card_login_api_key},
-        )
+    response = await authorizer.authorize(card_id)
     if response.status_code == 404:
-        return CardModel(card_id=card_id)
+        return JSONResponse(CardModel(card_id=card_id).dict(by_alias=True), status_code=404)
     return Response(content=response.content, status_code=response.status_code, headers=response.headers)
 
 
@@ -55,10 +75,6 @@ async def get_card():
     tags=['Auth'],
 )
 async def register_card(card: CardModel = Body(...)):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{config.card_auth.server_url}/card/register",
-            json=card.dict(),
-            headers={'X-Card-Api-Key': config.card_auth.card_login_api_key},
-        )
+    assert authorizer is not None, "Not initialized"
+    response = await authorizer.register(card)
     return Response(content=response.content, status_code=response.status_code, headers=response.headers)
@@ -1,56 +1,289 @@
 import asyncio
-from concurrent.futures.thread import ThreadPoolExecutor
-from fastapi import APIRouter
-from typing import List, Optional
+import json
+import logging
+from contextlib import contextmanager
+from fastapi import APIRouter, Body, HTTPException, Query
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.websockets import WebSocket
+from typing import AsyncIterator, Iterator, List, Optional, Tuple, Union
 
+from device_server.bay.events import StateChangeBroadcaster
+from device_server.bay.journal import Journal, JournalReader
+from device_server.bay.scanner import StateChange, StateSnapshot
 from device_server.bay.station import Station
-from device_server.config import config
-from device_server.model import BayState
+from device_server.config import Config, config, load_config
+from device_server.config.watcher import ConfigWatcher
+from device_server.hardware.client import RemoteStation
+from device_server.model import BayState, BayStateEvent, BayQuery, BayWaitState, StationReloadResult
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
-station: Optional[Station] = None
-thread_executor = ThreadPoolExecutor(1, thread_name_prefix="hardware_thread_")
+station: Optional[Union[Station, RemoteStation]] = None
+broadcaster: Optional[StateChangeBroadcaster] = None
+config_watcher: Optional[ConfigWatcher[Config]] = None
+journal: Optional[Journal] = None
+# Serialized bay listing of the last snapshot version, by ETag.
+bays_response_cache: Optional[Tuple[str, bytes]] = None
+# Polls the states while event streams are subscribed, see _subscribe_events, and the number of subscribed streams.
+event_poller: Optional['asyncio.Future[None]'] = None
+event_subscribers = 0
+
+# Interval in seconds in which a comment is sent on idle event streams to detect disconnected clients.
+EVENT_STREAM_KEEPALIVE = 15.0
+# Seconds between the state reads of a waiting request if the state scanner is disabled.
+WAIT_POLL_INTERVAL = 0.25
+# Number of journal events which are sent per chunk.
+JOURNAL_STREAM_BATCH = 256
 
 
 @router.on_event('startup')
 async def bay_startup():
-    global station
+    global station, broadcaster, config_watcher, journal
     assert station is None, "Already initialized"
-    station = Station(config.station)
-    await asyncio.get_running_loop().run_in_executor(thread_executor, station.configure)
+    if config.hardware.socket_path is not None:
+        station = RemoteStation(config.station, config.hardware)
+    else:
+        station = Station(config.station)
+    broadcaster = StateChangeBroadcaster()
+    station.add_listener(broadcaster.publish)
+    # The hardware process journals and watches the config itself.
+    if config.journal.path is not None and isinstance(station, Station):
+        journal = Journal(config.journal)
+        station.add_listener(journal.record_changes)
+        station.add_actuation_listener(journal.record_actuation)
+        journal.start()
+    await asyncio.get_running_loop().run_in_executor(None, station.configure)
+    station.start()
+    if config.reload_interval is not None and isinstance(station, Station):
+        config_watcher = ConfigWatcher(
+            Config, lambda new_config: station.reload(new_config.station), config.reload_interval
+        )
+        config_watcher.start()
 
 
 @router.on_event('shutdown')
 async def bay_shutdown():
-    global station
+    global station, broadcaster, config_watcher, journal, bays_response_cache
     assert station is not None, "Not initialized"
+    bays_response_cache = None
+    if config_watcher is not None:
+        config_watcher.stop()
+        config_watcher = None
+    station.stop()
+    station.remove_listener(broadcaster.publish)
+    if journal is not None:
+        station.remove_listener(journal.record_changes)
+        station.remove_actuation_listener(journal.record_actuation)
+        journal.stop()
+        journal = None
     station = None
+    broadcaster = None
+
+
+async def _get_snapshot() -> StateSnapshot:
+    """Gets the snapshot of the background scanner, or scans the bus if there is no fresh snapshot."""
+    assert station is not None, "Not initialized"
+    snapshot = station.get_snapshot()
+    if snapshot is None:
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, station.scan)
+    return snapshot
+
+
+async def _poll_states() -> None:
+    """Scans the bus whenever there is no fresh snapshot, such that the state changes are published without scanner."""
+    assert station is not None, "Not initialized"
+    loop = asyncio.get_running_loop()
+    while True:
+        if station.get_snapshot() is None:
+            try:
+                await loop.run_in_executor(None, station.scan)
+            except Exception:
+                logger.exception("Failed to scan the bay states for the event streams")
+        await asyncio.sleep(WAIT_POLL_INTERVAL)
+
+
+@contextmanager
+def _subscribe_events() -> Iterator['asyncio.Queue[List[StateChange]]']:
+    """
+    Subscribes to the state changes. They are published by the background scanner. If it is disabled, the states are
+    polled every WAIT_POLL_INTERVAL seconds while any stream is subscribed.
+    """
+    global event_poller, event_subscribers
+    assert station is not None and broadcaster is not None, "Not initialized"
+    with broadcaster.subscribe() as queue, station.active():
+        if event_subscribers == 0:
+            event_poller = asyncio.ensure_future(_poll_states())
+        event_subscribers += 1
+        try:
+            yield queue
+        finally:
+            event_subscribers -= 1
+            if event_subscribers == 0 and event_poller is not None:
+                event_poller.cancel()
+                event_poller = None
+
+
+def _etag(snapshot: StateSnapshot) -> str:
+    assert station is not None, "Not initialized"
+    return f'"{station.epoch}-{snapshot.version}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
 
 
 @router.get(
     '/bays',
     tags=['Bay'],
     response_model=List[BayState],
+    responses={304: {'description': "The states did not change since the version given in If-None-Match."}},
 )
-async def get_bays() -> List[BayState]:
+async def get_bays(request: Request) -> Response:
+    global bays_response_cache
+    snapshot = await _get_snapshot()
+    etag = _etag(snapshot)
+    if _etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    cached_response = bays_response_cache
+    if cached_response is not None and cached_response[0] == etag:
+        content = cached_response[1]
+    else:
+        content = json.dumps([
+            BayState(id=bay_id, open=is_open, degraded=bay_id in snapshot.degraded).dict(by_alias=True)
+            for bay_id, is_open in snapshot.states.items()
+        ]).encode()
+        bays_response_cache = (etag, content)
+    return Response(content=content, media_type='application/json', headers={'ETag': etag})
+
+
+@router.post(
+    '/bays/query',
+    tags=['Bay'],
+    response_model=List[BayState],
+)
+async def query_bays(query: BayQuery = Body(...)) -> List[BayState]:
+    """Gets the states of the given bays."""
+    snapshot = await _get_snapshot()
+    unknown_bay_ids = [bay_id for bay_id in query.ids if bay_id not in snapshot.states]
+    if unknown_bay_ids:
+        raise HTTPException(404, f"Unknown bays: {', '.join(unknown_bay_ids)}")
     return [
-        BayState(id=bay_id, open=is_open)
-        for bay_id, is_open in
-        (await asyncio.get_running_loop().run_in_executor(thread_executor, station.get_states)).items()
+        BayState(id=bay_id, open=snapshot.states[bay_id], degraded=bay_id in snapshot.degraded)
+        for bay_id in query.ids
     ]
 
 
+@router.websocket('/bays/events')
+async def bay_events_websocket(websocket: WebSocket) -> None:
+    """Streams the state changes of the bays as JSON messages."""
+
+    async def send_events(queue: 'asyncio.Queue[List[StateChange]]') -> None:
+        while True:
+            for change in await queue.get():
+                await websocket.send_json(
+                    BayStateEvent(id=change.bay_id, open=change.open, timestamp=change.timestamp).dict(by_alias=True)
+                )
+
+    await websocket.accept()
+    with _subscribe_events() as queue:
+        sender = asyncio.ensure_future(send_events(queue))
+        try:
+            # Messages from the client are ignored, only wait for the disconnect.
+            while (await websocket.receive())['type'] != 'websocket.disconnect':
+                pass
+        finally:
+            sender.cancel()
+
+
+@router.get(
+    '/bays/events',
+    tags=['Bay'],
+    response_class=StreamingResponse,
+)
+async def bay_events() -> StreamingResponse:
+    """Streams the state changes of the bays as server-sent events."""
+
+    async def stream() -> AsyncIterator[str]:
+        with _subscribe_events() as queue:
+            while True:
+                try:
+                    changes = await asyncio.wait_for(queue.get(), EVENT_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                for change in changes:
+                    event = BayStateEvent(id=change.bay_id, open=change.open, timestamp=change.timestamp)
+                    yield f"data: {event.json(by_alias=True)}\n\n"
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+
 @router.get(
     '/bays/{bay_id}',
     tags=['Bay'],
     response_model=BayState,
 )
-async def get_bay(bay_id: str) -> BayState:
-    return BayState(
-        id=bay_id, open=await asyncio.get_running_loop().run_in_executor(thread_executor, station.get_state, bay_id)
-    )
+async def get_bay(
+        bay_id: str,
+        wait_until: Optional[BayWaitState] = Query(None),
+        timeout: float = Query(30, ge=0, le=60),
+) -> BayState:
+    """
+    Gets the state of the bay. If wait_until is given, waits up to timeout seconds for the bay to reach that state and
+    returns the state at that time.
+    """
+    assert station is not None, "Not initialized"
+    if bay_id not in station.bays:
+        raise HTTPException(404, f"Unknown bay: {bay_id}")
+    if wait_until is None:
+        return await _get_bay_state(bay_id)
+    return await _wait_bay_state(bay_id, wait_until == BayWaitState.open, timeout)
+
+
+async def _get_bay_state(bay_id: str) -> BayState:
+    assert station is not None, "Not initialized"
+    snapshot = station.get_snapshot()
+    if snapshot is None:
+        is_open = await asyncio.get_running_loop().run_in_executor(None, station.get_state, bay_id)
+        if is_open is not None:
+            return BayState(id=bay_id, open=is_open)
+        # The bay could not be read, the scan reports its last known state.
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, station.scan)
+    return BayState(id=bay_id, open=snapshot.states[bay_id], degraded=bay_id in snapshot.degraded)
+
+
+async def _wait_bay_state(bay_id: str, is_open: bool, timeout: float) -> BayState:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    assert station is not None and broadcaster is not None, "Not initialized"
+    # Subscribe before reading the state, such that no change is missed in between.
+    with broadcaster.subscribe() as queue, station.active():
+        while True:
+            scanned = station.get_snapshot() is not None
+            state = await _get_bay_state(bay_id)
+            remaining = deadline - loop.time()
+            if state.open == is_open or remaining <= 0:
+                return state
+            try:
+                if scanned:
+                    # Woken up by any change of the scanner, the state of the bay is checked above.
+                    await asyncio.wait_for(queue.get(), remaining)
+                else:
+                    await asyncio.sleep(min(remaining, WAIT_POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
 
 
 @router.post(
@@ -58,7 +291,8 @@ async def get_bay(bay_id: str) -> BayState:
     tags=['Bay'],
 )
 async def open_all_bays() -> None:
-    await asyncio.get_running_loop().run_in_executor(thread_executor, station.open_all_bays)
+    assert station is not None, "Not initialized"
+    await asyncio.get_running_loop().run_in_executor(None, station.open_all_bays)
 
 
 @router.post(
@@ -66,4 +300,61 @@ async def open_all_bays() -> None:
     tags=['Bay'],
 )
 async def open_bay(bay_id: str) -> None:
-    await asyncio.get_running_loop().run_in_executor(thread_executor, station.open_bay, bay_id)
+    assert station is not None, "Not initialized"
+    await asyncio.get_running_loop().run_in_executor(None, station.open_bay, bay_id)
+
+
+@router.get(
+    '/journal',
+    tags=['Bay'],
+    response_class=StreamingResponse,
+)
+async def get_journal(
+        bay_id: Optional[List[str]] = Query(None),
+        start: Optional[float] = Query(None),
+        end: Optional[float] = Query(None),
+) -> StreamingResponse:
+    """
+    Streams the journaled state changes (opened, closed) and actuations (actuated) of the given bays (all if not given)
+    between the start and end timestamps as JSON lines, oldest first. Events are journaled with a delay of up to the
+    flush interval.
+    """
+    journal_path = config.journal.path
+    if journal_path is None:
+        raise HTTPException(404, "The journal is disabled")
+
+    def stream() -> Iterator[str]:
+        lines: List[str] = []
+        for event in JournalReader(journal_path).query(bay_id, start, end):
+            lines.append(json.dumps({'id': event.bay_id, 'event': event.event_type.name, 'timestamp': event.timestamp}))
+            if len(lines) >= JOURNAL_STREAM_BATCH:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    # The file access of the synchronous iterator runs in the thread pool.
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+@router.post(
+    '/station/reload',
+    tags=['Station'],
+    response_model=StationReloadResult,
+)
+async def reload_station() -> StationReloadResult:
+    """
+    Reloads the station from the config file without restart. Only added and changed controllers are configured again,
+    the bays are swapped once they are configured.
+    """
+    assert station is not None, "Not initialized"
+    loop = asyncio.get_running_loop()
+    try:
+        new_config = await loop.run_in_executor(None, load_config, Config)
+        reconfigured = await loop.run_in_executor(None, station.reload, new_config.station)
+    except (ValueError, KeyError, AssertionError) as e:
+        raise HTTPException(400, f"Invalid config: {e}")
+    except OSError as e:
+        # The controllers could not be configured, the previous bays are kept.
+        raise HTTPException(503, f"Failed to configure the controllers: {e}", headers={'Retry-After': '1'})
+    return StationReloadResult(reconfigured=reconfigured, bays=len(station.bays))
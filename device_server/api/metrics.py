@@ -0,0 +1,57 @@
+import os
+import time
+from fastapi import APIRouter
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from device_server.metrics import HTTP_REQUEST_SECONDS
+
+router = APIRouter()
+
+
+@router.get(
+    '/metrics',
+    tags=['Metrics'],
+    response_class=Response,
+)
+async def get_metrics() -> Response:
+    """Gets the metrics in the prometheus text format, in multiprocess mode those of all processes."""
+    multiprocess_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiprocess_dir is None:
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, multiprocess_dir)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+class MetricsMiddleware:
+    """Measures the duration of the HTTP requests per route."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched endpoint in the scope.
+            endpoint = scope.get('endpoint')
+            HTTP_REQUEST_SECONDS.labels(
+                method=scope['method'],
+                route=getattr(endpoint, '__name__', 'unmatched'),
+                status_code=status_code,
+            ).observe(time.perf_counter() - start)
@@ -1,16 +1,15 @@
+import random
 from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
 
 from pydantic import BaseModel
-from time import sleep
+from time import monotonic, sleep
 
 from smbus import SMBus
 
+from device_server.metrics import CONTROLLER_DEGRADED, I2C_RETRIES, I2C_TRANSACTION_SECONDS
 
-class Address(BaseModel):
-    """ Address of the bay, containing the controller register and the bitmask. """
-
-    controller_register: int = 0x0
-    register_bit_mask: int = 0x0
+T = TypeVar('T')
 
 
 class ControllerConfig(BaseModel):
@@ -19,6 +18,21 @@ class ControllerConfig(BaseModel):
     controller_id: str
     address: int
     i2c_port: int
+    # Interval in seconds in which an actuator controller re-reads its shadow copy of the outputs from the output latch.
+    output_resync_interval: float = 60.0
+    # Number of retries of a failed transaction, after a random delay of up to retry_backoff * 2^retry seconds.
+    retries: int = 2
+    retry_backoff: float = 0.002
+    # Time in seconds after which a failed transaction is not retried anymore.
+    transaction_deadline: float = 0.05
+    # Number of consecutive failed transactions after which the controller is degraded. A degraded controller is not
+    # accessed until recovery_interval seconds passed, then a single transaction probes whether it recovered.
+    failure_threshold: int = 3
+    recovery_interval: float = 5.0
+
+
+class ControllerDegraded(OSError):
+    """ Raised instead of accessing a degraded controller. """
 
 
 class MP23016Registers(Enum):
@@ -42,67 +56,204 @@ class Controller:
     """ Generic controller which contains the base information. """
 
     def __init__(self, controller_config: ControllerConfig):
+        self.config = controller_config
         self.controller_id = controller_config.controller_id
         self.address = controller_config.address
+        self.i2c_port = controller_config.i2c_port
         self.bus = SMBus(controller_config.i2c_port)
+        self.retries = controller_config.retries
+        self.retry_backoff = controller_config.retry_backoff
+        self.transaction_deadline = controller_config.transaction_deadline
+        self.failure_threshold = controller_config.failure_threshold
+        self.recovery_interval = controller_config.recovery_interval
+        self._failures = 0
+        self._degraded_until: Optional[float] = None
+        self._read_seconds = I2C_TRANSACTION_SECONDS.labels(controller_id=self.controller_id, operation='read')
+        self._write_seconds = I2C_TRANSACTION_SECONDS.labels(controller_id=self.controller_id, operation='write')
+        self._retries_counter = I2C_RETRIES.labels(controller_id=self.controller_id)
+        self._degraded_gauge = CONTROLLER_DEGRADED.labels(controller_id=self.controller_id)
+        self._degraded_gauge.set(0)
+
+    @property
+    def degraded(self) -> bool:
+        """ Whether the controller failed repeatedly and is not accessed until it is probed again. """
+        return self._degraded_until is not None
+
+    def _transaction(self, fn: Callable[[], T]) -> T:
+        """
+        Run a bus transaction with retries. Fails immediately while the controller is degraded. The deadline only limits
+        the retries, a hanging transaction cannot be interrupted.
+        """
+        start = monotonic()
+        if self._degraded_until is not None:
+            if start < self._degraded_until:
+                raise ControllerDegraded(f"Controller {self.controller_id} is degraded")
+            # Probe once whether the controller recovered.
+            attempts = 1
+        else:
+            attempts = self.retries + 1
+        deadline = start + self.transaction_deadline
+        attempt = 0
+        while True:
+            try:
+                result = fn()
+            except OSError:
+                attempt += 1
+                delay = random.uniform(0, self.retry_backoff * 2 ** (attempt - 1))
+                if attempt >= attempts or monotonic() + delay > deadline:
+                    self._failed()
+                    raise
+                self._retries_counter.inc()
+                sleep(delay)
+            else:
+                if self._failures or self._degraded_until is not None:
+                    self._failures = 0
+                    self._degraded_until = None
+                    self._degraded_gauge.set(0)
+                return result
+
+    def _failed(self):
+        self._failures += 1
+        if self._degraded_until is not None or self._failures >= self.failure_threshold:
+            self._degraded_until = monotonic() + self.recovery_interval
+            self._degraded_gauge.set(1)
+
+    def _read_byte_data(self, register: int) -> int:
+        with self._read_seconds.time():
+            return self.bus.read_byte_data(self.address, register)
+
+    def _write_byte_data(self, register: int, value: int):
+        with self._write_seconds.time():
+            self.bus.write_byte_data(self.address, register, value)
+
+    def read_register(self, register: int) -> int:
+        """ Read a register of the controller. """
+        return self._transaction(lambda: self._read_byte_data(register))
+
+    def write_register(self, register: int, value: int):
+        """ Write a register of the controller. """
+        self._transaction(lambda: self._write_byte_data(register, value))
+
+    def configuration(self) -> Dict[int, int]:
+        """ The values of the configuration registers by register. """
+        return {
+            # Writing the GP registers writes the output latch.
+            MP23016Registers.OLAT0.value: 0x00,
+            MP23016Registers.OLAT1.value: 0x00,
+            MP23016Registers.IPOL0.value: 0x00,
+            MP23016Registers.IPOL1.value: 0x00,
+            MP23016Registers.IODIR0.value: 0xff,
+            MP23016Registers.IODIR1.value: 0xff,
+            # Resolution of the interrupt precision. If 0bXXXXXXX0 then 200us else 32ms.
+            MP23016Registers.IOCON0.value: 0x00,
+        }
 
     def configure(self):
-        """ Reset all registers to the default. """
-        self.bus.write_byte_data(self.address, MP23016Registers.GP0.value, 0x00)
-        self.bus.write_byte_data(self.address, MP23016Registers.GP1.value, 0x00)
-
-        self.bus.write_byte_data(self.address, MP23016Registers.OLAT0.value, 0x00)
-        self.bus.write_byte_data(self.address, MP23016Registers.OLAT1.value, 0x00)
-
-        self.bus.write_byte_data(self.address, MP23016Registers.IPOL0.value, 0x00)
-        self.bus.write_byte_data(self.address, MP23016Registers.IPOL1.value, 0x00)
-
-        self.bus.write_byte_data(self.address, MP23016Registers.IPOL0.value, 0x00)
-        self.bus.write_byte_data(self.address, MP23016Registers.IPOL1.value, 0x00)
-
-        self.bus.write_byte_data(self.address, MP23016Registers.IODIR0.value, 0xff)
-        self.bus.write_byte_data(self.address, MP23016Registers.IODIR1.value, 0xff)
-
-        # Resolution of the interrupt precision. If 0bXXXXXXX0 then 200us else 32ms.
-        self.bus.write_byte_data(self.address, MP23016Registers.IOCON0.value, 0x00)
+        """ Reset all registers to the default. Only writes the registers which differ, e.g. after a restart. """
+        for register, value in self.configuration().items():
+            if self.read_register(register) != value:
+                self.write_register(register, value)
 
 
 class StateController(Controller):
     """ Controller which can read the state of the bays. """
 
-    def is_open(self, address: Address) -> bool:
-        """ Get the state of the given bay. """
-
-        state_register = self.bus.read_byte_data(self.address, address.controller_register)
+    def read_state_register(self, controller_register: int) -> int:
+        """ Read the raw state register, which contains the state bits of multiple bays. """
+        return self.read_register(controller_register)
 
-        # If the bit of the given port is set, then the door is closed.
-        return state_register & address.register_bit_mask == 0
+    def read_interrupt_capture_register(self, controller_register: int) -> int:
+        """ Read the state register as captured at the time of the last interrupt. Clears the interrupt. """
+        return self.read_register(MP23016Registers.INTCAP0.value + controller_register)
 
 
 class ActuatorController(Controller):
-    """ Controller which can open the bays. """
+    """
+    Controller which can open the bays.
 
-    def configure(self):
-        """ Configure the setting registers. """
-        super().configure()
+    Keeps a shadow copy of the output registers, such that writes which would not change the outputs are skipped.
+    """
 
+    def __init__(self, controller_config: ControllerConfig):
+        super().__init__(controller_config)
+        self.output_resync_interval = controller_config.output_resync_interval
+        # Shadow copy of the output latch by GP register. Registers which are not contained are unknown.
+        self._outputs: Dict[int, int] = {}
+        self._outputs_synced_at: float = monotonic()
+        self._resync_outputs = False
+
+    def configuration(self) -> Dict[int, int]:
+        configuration = super().configuration()
         # Set all port to output ports.
-        self.bus.write_byte_data(self.address, MP23016Registers.IODIR0.value, 0x00)
-        self.bus.write_byte_data(self.address, MP23016Registers.IODIR1.value, 0x00)
-
-    def open_bay(self, address: Address):
-        """ Open the given register."""
-        # UNSAFE: Unlock for a short period of time. If sleeping too long or interrupted, hardware may fail.
-        # First make sure that all ports are "off".
-        self.bus.write_byte_data(self.address, MP23016Registers.GP0.value, 0x0)
-        self.bus.write_byte_data(self.address, MP23016Registers.GP1.value, 0x0)
+        configuration[MP23016Registers.IODIR0.value] = 0x00
+        configuration[MP23016Registers.IODIR1.value] = 0x00
+        return configuration
 
-        sleep(0.01)
+    def configure(self):
+        """ Configure the setting registers. """
+        super().configure()
 
-        self.bus.write_byte_data(
-            self.address,
-            address.controller_register,
-            address.register_bit_mask,
-        )
+        self._outputs = {MP23016Registers.GP0.value: 0x00, MP23016Registers.GP1.value: 0x00}
+        self._outputs_synced_at = monotonic()
+        self._resync_outputs = False
+
+    def sync_outputs(self):
+        """ Re-read the shadow copy of the outputs from the output latch after an error or if it is due. """
+        if not self._resync_outputs and monotonic() - self._outputs_synced_at < self.output_resync_interval:
+            return
+        self._outputs.clear()
+        for controller_register in (MP23016Registers.GP0.value, MP23016Registers.GP1.value):
+            self._outputs[controller_register] = self.read_register(MP23016Registers.OLAT0.value + controller_register)
+        self._outputs_synced_at = monotonic()
+        self._resync_outputs = False
+
+    def write_output(self, controller_register: int, value: int):
+        """ Write the output register, unless it already contains the value. """
+        if self._outputs.get(controller_register) == value:
+            return
+        try:
+            self.write_register(controller_register, value)
+        except OSError:
+            # The state of the output is unknown now.
+            self._outputs.pop(controller_register, None)
+            self._resync_outputs = True
+            raise
+        self._outputs[controller_register] = value
+
+    def pulse(self, register_masks: Dict[int, int]):
+        """ Pulse the given bits of the given registers at the same time. """
+        pulse_controllers([(self, register_masks)])
+
+
+def pulse_controllers(pulses: List[Tuple[ActuatorController, Dict[int, int]]]):
+    """ Pulse the given bits of multiple controllers at the same time. All controllers must be on the same bus. """
+    for controller, _ in pulses:
+        controller.sync_outputs()
+
+    # UNSAFE: Unlock for a short period of time. If sleeping too long or interrupted, hardware may fail.
+    # First make sure that all ports are "off".
+    for controller, _ in pulses:
+        controller.write_output(MP23016Registers.GP0.value, 0x0)
+        controller.write_output(MP23016Registers.GP1.value, 0x0)
+
+    sleep(0.01)
+
+    # The registers which were switched on (or might have been, if the write failed), which must be switched off again.
+    switched_on: List[Tuple[ActuatorController, int]] = []
+    try:
+        for controller, register_masks in pulses:
+            for controller_register, register_bit_mask in register_masks.items():
+                switched_on.append((controller, controller_register))
+                controller.write_output(controller_register, register_bit_mask)
         sleep(0.01)
-        self.bus.write_byte_data(self.address, address.controller_register, 0x0)
+    finally:
+        # Also if a write failed, as the solenoids must not stay energized. Raises the first failed switch off.
+        error: Optional[BaseException] = None
+        for controller, controller_register in switched_on:
+            try:
+                controller.write_output(controller_register, 0x0)
+            except OSError as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
@@ -0,0 +1,76 @@
+from typing import Collection, List, Optional, Sequence
+
+# Bit masks of the bits of a state register.
+_BITS = tuple(1 << bit for bit in range(8))
+
+
+class RegisterDebouncer:
+    """
+    Majority vote over the last samples of every state register, such that a bouncing contact does not flap the state
+    of its bay. A bit is set in the filtered value if it is set in the majority of the samples, thus a state only
+    changes once it was read in more than half of the samples.
+
+    The samples must be spaced in time (e.g. by the scan interval), reads in quick succession do not filter a bounce.
+    """
+
+    __slots__ = ('samples', '_rings', '_positions')
+
+    def __init__(self, register_count: int, samples: int):
+        assert samples >= 1, "At least one sample is required"
+        self.samples = samples
+        # Ring buffer of the last samples by register slot, empty until the register was read the first time.
+        self._rings: List[List[int]] = [[] for _ in range(register_count)]
+        self._positions: List[int] = [0] * register_count
+
+    def _vote(self, ring: List[int]) -> int:
+        majority = self.samples // 2
+        filtered_value = 0
+        for bit in _BITS:
+            if sum(1 for sample in ring if sample & bit) > majority:
+                filtered_value |= bit
+        return filtered_value
+
+    def update(self, register_values: Sequence[Optional[int]]) -> List[Optional[int]]:
+        """
+        Adds the read values of all registers by register slot and returns the filtered values. Registers which could
+        not be read (None) are not sampled and stay None.
+        """
+        if self.samples == 1:
+            return list(register_values)
+        filtered: List[Optional[int]] = []
+        for register_slot, value in enumerate(register_values):
+            if value is None:
+                filtered.append(None)
+                continue
+            ring = self._rings[register_slot]
+            if not ring:
+                # The first read value is taken as stable.
+                ring.extend([value] * self.samples)
+            else:
+                position = self._positions[register_slot]
+                ring[position] = value
+                self._positions[register_slot] = (position + 1) % self.samples
+            filtered.append(self._vote(ring))
+        return filtered
+
+    def override(
+            self, register_values: Sequence[Optional[int]], register_slots: Optional[Collection[int]] = None
+    ) -> List[Optional[int]]:
+        """
+        Takes the read values of the given register slots (all if None) as stable without voting, and returns the
+        filtered values of all registers. The other registers keep their filtered value. Registers which could not be
+        read (None) stay None.
+        """
+        if self.samples == 1:
+            return list(register_values)
+        if register_slots is None:
+            register_slots = range(len(register_values))
+        for register_slot in register_slots:
+            value = register_values[register_slot]
+            if value is not None:
+                self._rings[register_slot] = [value] * self.samples
+                self._positions[register_slot] = 0
+        return [
+            None if value is None else self._vote(ring) if ring else value
+            for value, ring in zip(register_values, self._rings)
+        ]
@@ -0,0 +1,41 @@
+import asyncio
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Iterator, List
+
+from .scanner import StateChange, StateSnapshot
+
+
+class StateChangeBroadcaster:
+    """ Fans out the state changes of the station scans to any number of asyncio subscribers. """
+
+    def __init__(self, max_queued: int = 100):
+        self._max_queued = max_queued
+        self._lock = Lock()
+        self._subscribers: Dict['asyncio.Queue[List[StateChange]]', asyncio.AbstractEventLoop] = {}
+
+    def publish(self, snapshot: StateSnapshot, changes: List[StateChange]):
+        """ Publish changes. Thread-safe, used as station listener. """
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self._put, queue, changes)
+
+    @staticmethod
+    def _put(queue: 'asyncio.Queue[List[StateChange]]', changes: List[StateChange]):
+        if queue.full():
+            # Drop the oldest changes of subscribers which do not keep up.
+            queue.get_nowait()
+        queue.put_nowait(changes)
+
+    @contextmanager
+    def subscribe(self) -> Iterator['asyncio.Queue[List[StateChange]]']:
+        """ Subscribe to the changes. Each item of the queue contains the changes of one scan. """
+        queue: 'asyncio.Queue[List[StateChange]]' = asyncio.Queue(self._max_queued)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_event_loop()
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                del self._subscribers[queue]
@@ -0,0 +1,194 @@
+import heapq
+import itertools
+import time
+from concurrent.futures import Future
+from enum import IntEnum
+from threading import Condition, Thread
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+from device_server.metrics import (
+    BUS_EXECUTOR_COALESCED, BUS_EXECUTOR_QUEUE_DEPTH, BUS_EXECUTOR_REJECTED, BUS_EXECUTOR_WAIT_SECONDS
+)
+
+T = TypeVar('T')
+
+
+class Priority(IntEnum):
+    """ Priority of the hardware operations. Queued operations of a lower value run first. """
+
+    actuation = 0
+    read = 1
+    # Runs when no reads are queued.
+    background = 2
+
+
+class BusOverloaded(Exception):
+    """
+    Raised if an operation other than an actuation is submitted to a bus which already has the maximum number of queued
+    operations.
+    """
+
+
+class _BusThread:
+    """ Thread which runs the operations of one bus by priority, in submission order within the same priority. """
+
+    def __init__(self, i2c_port: int, max_queued: int):
+        self.i2c_port = i2c_port
+        self.max_queued = max_queued
+        self._condition = Condition()
+        # Heap of (priority, sequence, submitted_at, future, key, fn, args).
+        self._queue: List[Tuple[int, int, float, Future, Optional[Hashable], Callable[..., Any], tuple]] = []
+        # The futures of the queued operations which can be shared, by key.
+        self._pending: Dict[Hashable, Future] = {}
+        self._sequence = itertools.count()
+        self._shutdown = False
+        self._queue_depth = BUS_EXECUTOR_QUEUE_DEPTH.labels(i2c_port=i2c_port)
+        self._wait_seconds = BUS_EXECUTOR_WAIT_SECONDS.labels(i2c_port=i2c_port)
+        self._thread = Thread(target=self._run, name=f"i2c_{i2c_port}_thread_0", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable[..., T], args: tuple, priority: Priority, key: Optional[Hashable]) -> 'Future[T]':
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit after shutdown")
+            if key is not None:
+                pending_future = self._pending.get(key)
+                if pending_future is not None:
+                    BUS_EXECUTOR_COALESCED.labels(i2c_port=self.i2c_port).inc()
+                    return pending_future
+            # Actuations are never rejected, an open request must not fail because of queued reads.
+            if priority != Priority.actuation and len(self._queue) >= self.max_queued:
+                BUS_EXECUTOR_REJECTED.labels(i2c_port=self.i2c_port).inc()
+                raise BusOverloaded(f"Too many operations queued for bus {self.i2c_port}")
+            future: 'Future[T]' = Future()
+            heapq.heappush(self._queue, (priority, next(self._sequence), time.perf_counter(), future, key, fn, args))
+            if key is not None:
+                self._pending[key] = future
+            self._queue_depth.inc()
+            self._condition.notify()
+        return future
+
+    def prioritize(self, future: Future, priority: Priority):
+        """ Raises the priority of the queued operation of the future. Does nothing if it is not queued anymore. """
+        with self._condition:
+            for index, entry in enumerate(self._queue):
+                if entry[3] is future:
+                    if priority < entry[0]:
+                        self._queue[index] = (priority, *entry[1:])
+                        heapq.heapify(self._queue)
+                    return
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                _, _, submitted_at, future, key, fn, args = heapq.heappop(self._queue)
+                if key is not None:
+                    # Operations with the same key submitted from now on run again, as this one might have read
+                    # already.
+                    del self._pending[key]
+            self._queue_depth.dec()
+            self._wait_seconds.observe(time.perf_counter() - submitted_at)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self):
+        """ Runs the queued operations and stops the thread. """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        self._thread.join()
+
+
+class BusExecutor:
+    """
+    Serializes all hardware access per I2C bus, while the different buses are accessed in parallel.
+
+    Per bus, actuations run before queued reads and background operations after them. Operations submitted with the
+    key of an operation which is still queued share its result instead of accessing the bus again. If more than
+    max_queued operations are queued for a bus, submitting reads and background operations raises `BusOverloaded`,
+    while actuations are still accepted.
+
+    The blocking methods must not be called from a bus thread, as they wait for the bus threads.
+    """
+
+    def __init__(self, i2c_ports: Iterable[int], max_queued: int = 100):
+        self._max_queued = max_queued
+        self._buses: Dict[int, _BusThread] = {
+            i2c_port: _BusThread(i2c_port, max_queued)
+            for i2c_port in sorted(set(i2c_ports))
+        }
+
+    @property
+    def i2c_ports(self) -> Iterable[int]:
+        return self._buses.keys()
+
+    def add_buses(self, i2c_ports: Iterable[int]):
+        """ Starts the threads of the given buses which do not have one yet. """
+        new_ports = sorted(set(i2c_ports) - self._buses.keys())
+        if new_ports:
+            # Replaced instead of modified, such that concurrent submits never see a partially updated dict.
+            self._buses = {
+                **self._buses,
+                **{i2c_port: _BusThread(i2c_port, self._max_queued) for i2c_port in new_ports},
+            }
+
+    def submit(
+            self,
+            i2c_port: int,
+            fn: Callable[..., T],
+            *args,
+            priority: Priority = Priority.read,
+            key: Optional[Hashable] = None,
+    ) -> 'Future[T]':
+        """ Schedule fn on the thread of the given bus. Operations with the same key may share their result. """
+        return self._buses[i2c_port].submit(fn, args, priority, key)
+
+    def prioritize(self, i2c_port: int, future: Future, priority: Priority):
+        """ Raises the priority of an operation which is still queued, e.g. if a more urgent one waits for it. """
+        self._buses[i2c_port].prioritize(future, priority)
+
+    def run(
+            self,
+            i2c_port: int,
+            fn: Callable[..., T],
+            *args,
+            priority: Priority = Priority.read,
+            key: Optional[Hashable] = None,
+    ) -> T:
+        """ Run fn on the thread of the given bus and wait for the result. """
+        return self.submit(i2c_port, fn, *args, priority=priority, key=key).result()
+
+    def run_all(
+            self,
+            fn: Callable[[int], T],
+            i2c_ports: Optional[Iterable[int]] = None,
+            priority: Priority = Priority.read,
+            key: Optional[Hashable] = None,
+    ) -> Dict[int, T]:
+        """ Run fn(i2c_port) on the threads of all (or the given) buses in parallel and gather the results. """
+        futures: Dict[int, Future] = {}
+        try:
+            for i2c_port in (self._buses.keys() if i2c_ports is None else i2c_ports):
+                futures[i2c_port] = self.submit(i2c_port, fn, i2c_port, priority=priority, key=key)
+        except BusOverloaded:
+            # Do not run the operation on only some of the buses. Operations with a key might be shared with other
+            # waiters, thus they are not cancelled.
+            if key is None:
+                for future in futures.values():
+                    future.cancel()
+            raise
+        return {i2c_port: future.result() for i2c_port, future in futures.items()}
+
+    def shutdown(self):
+        for bus in self._buses.values():
+            bus.shutdown()
@@ -0,0 +1,89 @@
+import os
+import select
+from abc import ABC, abstractmethod
+
+
+class InterruptSource(ABC):
+    """ Waits for the INT line of the state controllers. Can be woken up from another thread. """
+
+    def __init__(self, fd: int, events: int):
+        self._fd = fd
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        self._poll = select.poll()
+        self._poll.register(self._fd, events)
+        self._poll.register(self._wake_read_fd, select.POLLIN)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait for the interrupt.
+
+        Returns:
+            True if the interrupt fired, False on timeout or if woken up.
+        """
+        fired = False
+        for fd, _ in self._poll.poll(timeout * 1000):
+            if fd == self._fd:
+                self._acknowledge()
+                fired = True
+            else:
+                os.read(self._wake_read_fd, 4096)
+        return fired
+
+    def wake(self):
+        """ Wake up a waiting thread without an interrupt. """
+        os.write(self._wake_write_fd, b'\0')
+
+    def close(self):
+        os.close(self._wake_read_fd)
+        os.close(self._wake_write_fd)
+
+    @abstractmethod
+    def _acknowledge(self):
+        """ Clear the pending interrupt, such that the next wait blocks until it fires again. """
+
+
+class GpioInterrupt(InterruptSource):
+    """ INT line connected to a GPIO of the Raspberry PI, using the sysfs GPIO interface. """
+
+    def __init__(self, gpio: int):
+        gpio_path = f'/sys/class/gpio/gpio{gpio}'
+        if not os.path.exists(gpio_path):
+            with open('/sys/class/gpio/export', 'w') as f:
+                f.write(str(gpio))
+        with open(os.path.join(gpio_path, 'direction'), 'w') as f:
+            f.write('in')
+        # The INT line is active low.
+        with open(os.path.join(gpio_path, 'edge'), 'w') as f:
+            f.write('falling')
+        self._value = open(os.path.join(gpio_path, 'value'), 'rb', buffering=0)
+        super().__init__(self._value.fileno(), select.POLLPRI | select.POLLERR)
+        # Clear a pending edge.
+        self._acknowledge()
+
+    def close(self):
+        super().close()
+        self._value.close()
+
+    def _acknowledge(self):
+        self._value.seek(0)
+        self._value.read()
+
+
+class PipeInterrupt(InterruptSource):
+    """ Interrupt which is triggered through a pipe. Portable stand-in for the INT line, e.g. for testing. """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        super().__init__(self._read_fd, select.POLLIN)
+
+    def trigger(self):
+        """ Fire the interrupt. """
+        os.write(self._write_fd, b'\0')
+
+    def close(self):
+        super().close()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+    def _acknowledge(self):
+        os.read(self._read_fd, 4096)
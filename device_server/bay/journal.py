@@ -0,0 +1,279 @@
+import logging
+import mmap
+import os
+import struct
+from enum import IntEnum
+from pydantic import BaseModel
+from threading import Condition, Thread
+from typing import Collection, Iterable, Iterator, List, NamedTuple, Optional
+
+from .scanner import StateChange, StateSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Maximum length of a bay id in UTF-8 bytes.
+BAY_ID_SIZE = 15
+# timestamp, event type, bay id (UTF-8, zero padded). A record whose timestamp is 0 was not written (yet), thus the
+# timestamp is written last.
+RECORD = struct.Struct(f'<dB{BAY_ID_SIZE}s')
+SEGMENT_SUFFIX = '.journal'
+
+
+class JournalConfig(BaseModel):
+    # Directory of the journal of the bay state changes and actuations. Disabled if not set.
+    path: Optional[str] = None
+    # Number of records per segment file (24 bytes each). If the last segment is full, a new one is started.
+    segment_records: int = 65536
+    # Number of segments which are kept, the oldest ones are deleted.
+    max_segments: int = 16
+    # Interval in seconds in which the recorded events are written in one batch.
+    flush_interval: float = 1.0
+
+
+class JournalEventType(IntEnum):
+    closed = 0
+    opened = 1
+    # The bay was opened by a command.
+    actuated = 2
+
+
+class JournalEvent(NamedTuple):
+    timestamp: float
+    event_type: JournalEventType
+    bay_id: str
+
+
+def _segment_paths(path: str) -> List[str]:
+    """ The segment files of the journal, oldest first. """
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(path, name) for name in sorted(names) if name.endswith(SEGMENT_SUFFIX)]
+
+
+def _record_timestamp(segment: mmap.mmap, index: int) -> float:
+    return struct.unpack_from('<d', segment, index * RECORD.size)[0]
+
+
+def _written_count(segment: mmap.mmap) -> int:
+    """ Number of written records of the segment, which are a prefix of the segment. """
+    low, high = 0, len(segment) // RECORD.size
+    while low < high:
+        middle = (low + high) // 2
+        if _record_timestamp(segment, middle) == 0.0:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+class Journal:
+    """
+    Append-only journal of the state changes and actuations of the bays.
+
+    Events are queued by `record` without blocking and written in batches by the journal thread. The journal consists
+    of segment files of fixed-size records, which are preallocated and memory-mapped. Timestamps never decrease, such
+    that a time range can be found by binary search.
+    """
+
+    # Number of queued events after which they are written before the flush interval passed.
+    max_batch = 1024
+
+    def __init__(self, config: JournalConfig):
+        assert config.path is not None, "No journal path configured"
+        self.config = config
+        self.path: str = config.path
+        self._condition = Condition()
+        self._pending: List[JournalEvent] = []
+        self._stopped = False
+        self._segment_index = 0
+        self._count = 0
+        self._last_timestamp = 0.0
+        os.makedirs(self.path, exist_ok=True)
+        segment_paths = _segment_paths(self.path)
+        if segment_paths:
+            self._segment = self._map_segment(int(os.path.basename(segment_paths[-1])[:-len(SEGMENT_SUFFIX)]))
+            self._count = _written_count(self._segment)
+            if self._count > 0:
+                self._last_timestamp = _record_timestamp(self._segment, self._count - 1)
+        else:
+            self._segment = self._map_segment(0)
+        self._thread = Thread(target=self._run, name="journal_thread", daemon=True)
+
+    def _map_segment(self, segment_index: int) -> mmap.mmap:
+        """ Maps the segment file with the index, which is created if it does not exist. """
+        path = os.path.join(self.path, f'{segment_index:010d}{SEGMENT_SUFFIX}')
+        size = self.config.segment_records * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            segment = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._segment_index = segment_index
+        return segment
+
+    def _rotate(self):
+        segment = self._map_segment(self._segment_index + 1)
+        self._segment.close()
+        self._segment = segment
+        self._count = 0
+        segment_paths = _segment_paths(self.path)
+        for path in segment_paths[:max(0, len(segment_paths) - self.config.max_segments)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ Writes the queued events and stops the journal thread. """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        else:
+            self._write(self._pending)
+            self._pending = []
+        self._segment.close()
+
+    def record(self, events: Iterable[JournalEvent]):
+        """ Queues the events for writing. Thread-safe. """
+        with self._condition:
+            self._pending.extend(events)
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify()
+
+    def record_changes(self, snapshot: StateSnapshot, changes: List[StateChange]):
+        """ Station listener which records the state changes. """
+        self.record(
+            JournalEvent(
+                change.timestamp, JournalEventType.opened if change.open else JournalEventType.closed, change.bay_id
+            )
+            for change in changes
+        )
+
+    def record_actuation(self, bay_ids: List[str], timestamp: float):
+        """ Station actuation listener which records the opened bays. """
+        self.record(JournalEvent(timestamp, JournalEventType.actuated, bay_id) for bay_id in bay_ids)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._stopped or len(self._pending) >= self.max_batch, self.config.flush_interval
+                )
+                events = self._pending
+                self._pending = []
+                stopped = self._stopped
+            self._write(events)
+            if stopped:
+                return
+
+    def _write(self, events: List[JournalEvent]):
+        if not events:
+            return
+        # The events of different threads might be recorded out of order. Only the events which are older than the
+        # already written ones (e.g. if the clock was adjusted) are written with the last written timestamp.
+        events = sorted(events, key=lambda event: event.timestamp)
+        written_timestamp = self._last_timestamp
+        try:
+            for event in events:
+                bay_id = event.bay_id.encode()
+                if len(bay_id) > BAY_ID_SIZE:
+                    # Rejected by the station config.
+                    logger.error("Bay id %s is too long for the journal", event.bay_id)
+                    continue
+                if self._count >= self.config.segment_records:
+                    self._rotate()
+                self._last_timestamp = max(written_timestamp, event.timestamp)
+                record = RECORD.pack(self._last_timestamp, event.event_type, bay_id)
+                offset = self._count * RECORD.size
+                self._segment[offset + 8:offset + RECORD.size] = record[8:]
+                self._segment[offset:offset + 8] = record[:8]
+                self._count += 1
+            self._segment.flush()
+        except OSError:
+            logger.exception("Failed to write the journal")
+
+
+class JournalReader:
+    """ Reads the journal, also while it is written by another process. """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @staticmethod
+    def _first_timestamp(path: str) -> Optional[float]:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(8)
+        except FileNotFoundError:
+            return None
+        if len(data) < 8:
+            return None
+        return struct.unpack('<d', data)[0]
+
+    def query(
+            self,
+            bay_ids: Optional[Collection[str]] = None,
+            start: Optional[float] = None,
+            end: Optional[float] = None,
+    ) -> Iterator[JournalEvent]:
+        """ Iterates over the events of the given bays (all if None) in the time range [start, end], oldest first. """
+        encoded_bay_ids = None if bay_ids is None else {
+            bay_id.encode().ljust(BAY_ID_SIZE, b'\0') for bay_id in bay_ids
+        }
+        segment_paths = _segment_paths(self.path)
+        first_timestamps = [self._first_timestamp(path) for path in segment_paths]
+        for segment_index, path in enumerate(segment_paths):
+            first_timestamp = first_timestamps[segment_index]
+            if not first_timestamp:
+                continue
+            if end is not None and first_timestamp > end:
+                return
+            next_timestamp = first_timestamps[segment_index + 1] if segment_index + 1 < len(segment_paths) else None
+            if start is not None and next_timestamp and next_timestamp < start:
+                continue
+            yield from self._query_segment(path, encoded_bay_ids, start, end)
+
+    @staticmethod
+    def _query_segment(
+            path: str, encoded_bay_ids: Optional[Collection[bytes]], start: Optional[float], end: Optional[float]
+    ) -> Iterator[JournalEvent]:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            # Deleted by the rotation meanwhile.
+            return
+        try:
+            segment = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            count = _written_count(segment)
+            index = 0
+            if start is not None:
+                # First record at or after start.
+                high = count
+                while index < high:
+                    middle = (index + high) // 2
+                    if _record_timestamp(segment, middle) < start:
+                        index = middle + 1
+                    else:
+                        high = middle
+            while index < count:
+                timestamp, event_type, bay_id = RECORD.unpack_from(segment, index * RECORD.size)
+                index += 1
+                if end is not None and timestamp > end:
+                    return
+                if encoded_bay_ids is not None and bay_id not in encoded_bay_ids:
+                    continue
+                yield JournalEvent(timestamp, JournalEventType(event_type), bay_id.rstrip(b'\0').decode())
+        finally:
+            segment.close()
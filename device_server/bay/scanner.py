@@ -0,0 +1,169 @@
+import logging
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, FrozenSet, NamedTuple, Optional
+
+from .interrupt import InterruptSource
+
+logger = logging.getLogger(__name__)
+
+
+class StateSnapshot(NamedTuple):
+    """ Immutable snapshot of the states of all bays. """
+
+    # Incremented whenever any bay state changed.
+    version: int
+    # Time of the scan which produced this snapshot, or up to which the interrupt confirmed that nothing changed.
+    timestamp: float
+    # None if the bay was never read successfully.
+    states: Dict[str, Optional[bool]]
+    # The bays whose state could not be read. Their state is the last known one.
+    degraded: FrozenSet[str] = frozenset()
+
+
+class StateChange(NamedTuple):
+    """ Change of the state of a single bay between two consecutive scans. """
+
+    bay_id: str
+    open: bool
+    timestamp: float
+
+
+class StateScanner:
+    """
+    Background thread which periodically scans the states of all bays.
+
+    If an active scan interval is given, the bays are scanned at that interval while the station is active, i.e. for
+    the active window after `activity` and while held. Afterwards, the interval doubles with every scan until it
+    reached the (idle) scan interval.
+
+    If an interrupt source is given, the interrupt scan is run whenever the interrupt fires, and the full scan only
+    runs every scan interval as fallback. As long as the interrupt did not fire, the states did not change: confirm is
+    called every confirm interval, such that the snapshot stays fresh without reading the bus.
+    """
+
+    scan_interval: float
+
+    def __init__(
+            self,
+            scan: Callable[[], StateSnapshot],
+            scan_interval: float,
+            interrupt: Optional[InterruptSource] = None,
+            scan_interrupt: Optional[Callable[[], StateSnapshot]] = None,
+            active_scan_interval: Optional[float] = None,
+            active_window: float = 0.0,
+            confirm: Optional[Callable[[], None]] = None,
+            confirm_interval: float = 0.5,
+    ):
+        assert (interrupt is None) == (scan_interrupt is None), "Interrupt scan requires an interrupt source"
+        assert active_scan_interval is None or active_scan_interval <= scan_interval, \
+            "Active scan interval must not exceed the scan interval"
+        self.scan_interval = scan_interval
+        self.active_scan_interval = active_scan_interval
+        self.active_window = active_window
+        self._scan = scan
+        self._interrupt = interrupt
+        self._scan_interrupt = scan_interrupt
+        self._confirm = confirm
+        self.confirm_interval = confirm_interval
+        self._lock = Lock()
+        # Interval after the last full scan while not active.
+        self._interval = scan_interval
+        self._active_until = 0.0
+        self._active_holds = 0
+        self._stop_event = Event()
+        self._wake_event = Event()
+        self._scanner_thread = Thread(target=self._scan_thread, name="state_scanner_thread", daemon=True)
+
+    def start(self):
+        self._stop_event.clear()
+        self._scanner_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake()
+        if self._scanner_thread.is_alive():
+            self._scanner_thread.join()
+
+    def _wake(self):
+        if self._interrupt is not None:
+            self._interrupt.wake()
+        else:
+            self._wake_event.set()
+
+    def _is_active(self) -> bool:
+        return self._active_holds > 0 or time.monotonic() < self._active_until
+
+    def activity(self):
+        """ Scans at the active interval for the active window from now on. Thread-safe. """
+        if self.active_scan_interval is None:
+            return
+        with self._lock:
+            was_active = self._is_active()
+            self._active_until = time.monotonic() + self.active_window
+        if not was_active:
+            # Shorten the running wait for the next scan.
+            self._wake()
+
+    def hold(self):
+        """ Scans at the active interval until released. Thread-safe. """
+        if self.active_scan_interval is None:
+            return
+        with self._lock:
+            was_active = self._is_active()
+            self._active_holds += 1
+        if not was_active:
+            self._wake()
+
+    def release(self):
+        """ Releases a previous hold, the active window starts again. """
+        if self.active_scan_interval is None:
+            return
+        with self._lock:
+            self._active_holds -= 1
+            self._active_until = time.monotonic() + self.active_window
+
+    def _current_interval(self) -> float:
+        with self._lock:
+            if self.active_scan_interval is not None and self._is_active():
+                return self.active_scan_interval
+            return self._interval
+
+    def _update_interval(self):
+        """ Decays the interval after a full scan. """
+        if self.active_scan_interval is None:
+            return
+        with self._lock:
+            if self._is_active():
+                self._interval = self.active_scan_interval
+            else:
+                self._interval = min(self._interval * 2, self.scan_interval)
+
+    @staticmethod
+    def _run(scan: Callable[[], StateSnapshot]) -> bool:
+        """ Runs the scan. Returns whether it succeeded. """
+        try:
+            scan()
+        except Exception:
+            logger.exception("Failed to scan the bay states")
+            return False
+        return True
+
+    def _scan_thread(self):
+        while not self._stop_event.is_set():
+            scanned_at = time.monotonic()
+            scanned = self._run(self._scan)
+            self._update_interval()
+            # The interval is evaluated again if woken up, as the station might have become active.
+            while not self._stop_event.is_set():
+                remaining = scanned_at + self._current_interval() - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self._interrupt is None:
+                    self._wake_event.wait(remaining)
+                    self._wake_event.clear()
+                elif self._interrupt.wait(min(remaining, self.confirm_interval)):
+                    scanned = self._run(self._scan_interrupt)
+                elif scanned and self._confirm is not None:
+                    # The interrupt did not fire, thus the states did not change since the last scan.
+                    self._confirm()
@@ -1,7 +1,22 @@
-from pydantic import BaseModel
-from typing import Dict, List, Tuple
+import logging
+import time
+import uuid
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import partial
+from pydantic import BaseModel, root_validator, validator
+from threading import Lock
+from typing import Callable, Collection, Dict, Iterator, List, Optional, Tuple
 
-from .controller import StateController, ActuatorController, Address, ControllerConfig
+from .controller import Controller, StateController, ActuatorController, ControllerConfig, pulse_controllers
+from .debounce import RegisterDebouncer
+from .executor import BusExecutor, Priority
+from .interrupt import GpioInterrupt, InterruptSource
+from .journal import BAY_ID_SIZE
+from .scanner import StateChange, StateScanner, StateSnapshot
+from .table import BayTable
+
+logger = logging.getLogger(__name__)
 
 
 class StationConfig(BaseModel):
@@ -15,28 +30,48 @@ class StationConfig(BaseModel):
     # actuator_controller_address.controller_register,
     # actuator_controller_address.register_bit_mask,
     bays: List[Tuple[str, str, int, int, str, int, int]]
+    # Interval in seconds in which the background scanner refreshes the state snapshot. Disabled if not set.
+    scan_interval: Optional[float] = None
+    # Interval in seconds in which the background scanner refreshes the state snapshot while the station is active: for
+    # active_window seconds after an actuation, a card tap or a state change, and while clients wait for changes.
+    # Afterwards the interval doubles with every scan until it reached the scan interval. Disabled if not set.
+    active_scan_interval: Optional[float] = None
+    active_window: float = 5.0
+    # Maximum age in seconds of the state snapshot for answering requests. If the snapshot is older (e.g. because the
+    # scanner is stuck), the bus is read directly. Must not be below the scan interval, otherwise the requests read the
+    # bus while the scanner is idle. In interrupt mode, the snapshot is renewed without reading the bus while the
+    # interrupt did not fire, thus the scan interval may be longer.
+    max_staleness: float = 1.0
+    # GPIO to which the INT line of the state controllers is connected. If set, the scanner reads the interrupt capture
+    # registers when the interrupt fires, then the state registers of the controllers which fired, and only runs a full
+    # scan every scan interval.
+    interrupt_gpio: Optional[int] = None
+    # Maximum number of bays which are opened at the same time when opening all bays. Bays on the same controller
+    # register are opened with a single write, bays on different buses in parallel. Protects the power supply.
+    max_concurrent_actuations: int = 1
+    # Maximum number of hardware operations queued per bus. Further reads are rejected until the queue drained,
+    # actuations are always accepted.
+    max_queued_operations: int = 100
+    # Number of recent scans of the background scanner of every state register over which the state of a bay is decided
+    # by majority, such that a bouncing contact does not cause spurious changes. A change is published after more than
+    # half of the samples showed it, i.e. within the scan intervals. Interrupt scans and scans on request are published
+    # right away. 1 disables debouncing.
+    debounce_samples: int = 1
 
+    @validator('bays', each_item=True)
+    def check_bay(cls, bay):
+        bay_id, _, state_register, state_mask, _, actuator_register, actuator_mask = bay
+        assert len(bay_id.encode()) <= BAY_ID_SIZE, f"Bay id {bay_id} is longer than {BAY_ID_SIZE} bytes (UTF-8)"
+        assert all(0 <= value <= 0xff for value in (state_register, state_mask, actuator_register, actuator_mask)), \
+            f"Registers and masks of bay {bay_id} must be between 0 and 255"
+        return bay
 
-class Bay:
-    bay_id: str
-    state_controller: StateController
-    state_controller_address: Address
-    actuator_controller: ActuatorController
-    actuator_controller_address: Address
-
-    def __init__(
-            self,
-            bay_id: str,
-            state_controller: StateController,
-            state_controller_address: Address,
-            actuator_controller: ActuatorController,
-            actuator_controller_address: Address,
-    ):
-        self.bay_id = bay_id
-        self.state_controller = state_controller
-        self.state_controller_address = state_controller_address
-        self.actuator_controller = actuator_controller
-        self.actuator_controller_address = actuator_controller_address
+    @root_validator(skip_on_failure=True)
+    def check_max_staleness(cls, values):
+        if values['scan_interval'] is not None and values['interrupt_gpio'] is None:
+            assert values['max_staleness'] >= values['scan_interval'], \
+                "max_staleness must not be below scan_interval, requests would read the bus while the scanner is idle"
+        return values
 
 
 class Station:
@@ -45,11 +80,13 @@ class Station:
     def __init__(self, config: StationConfig):
         """Initialize station from station config."""
 
+        self.max_staleness = config.max_staleness
+        self.max_concurrent_actuations = config.max_concurrent_actuations
+
         assert len({c.controller_id for c in config.state_controllers}) == len(config.state_controllers), \
             "Duplicate state controller ids in config"
         assert len({c.controller_id for c in config.actuator_controllers}) == len(config.actuator_controllers), \
             "Duplicate actuator controller ids in config"
-        assert len({c[0] for c in config.bays}) == len(config.bays), "Duplicate bay ids in config"
 
         self.state_controllers: Dict[str, StateController] = {
             state_controller_config.controller_id: StateController(state_controller_config)
@@ -59,47 +96,550 @@ class Station:
             actuator_controller_config.controller_id: ActuatorController(actuator_controller_config)
             for actuator_controller_config in config.actuator_controllers
         }
-        self.bays: Dict[str, Bay] = {
-            bay_config[0]: Bay(
-                bay_id=bay_config[0],
-                state_controller=self.state_controllers[bay_config[1]],
-                state_controller_address=Address(controller_register=bay_config[2], register_bit_mask=bay_config[3]),
-                actuator_controller=self.actuator_controllers[bay_config[4]],
-                actuator_controller_address=Address(controller_register=bay_config[5], register_bit_mask=bay_config[6]),
+        # Replaced as a whole when the config is reloaded. Operations use the table they started with.
+        self.bays = BayTable(config.bays, self.state_controllers, self.actuator_controllers)
+        # Filters the scanned registers of the bays, replaced together with them.
+        self._debouncer = RegisterDebouncer(len(self.bays.register_slot_keys), config.debounce_samples)
+
+        # All hardware access is serialized per bus.
+        self.executor = BusExecutor(
+            (
+                controller_config.i2c_port
+                for controller_config in config.state_controllers + config.actuator_controllers
+            ),
+            config.max_queued_operations,
+        )
+        # Configuration of the actuator controllers by bus, see configure.
+        self._actuators_configured: Dict[int, 'Future[None]'] = {}
+        self._actuators_configured_lock = Lock()
+        self._reload_lock = Lock()
+        self._snapshot: Optional[StateSnapshot] = None
+        # The state registers of the bays by register slot of the last published snapshot.
+        self._register_values: Optional[List[Optional[int]]] = None
+        # Number of the last started read and of the read of the last published snapshot, see _start_read.
+        self._read_sequence = 0
+        self._published_sequence = 0
+        self._snapshot_lock = Lock()
+        # Distinguishes the snapshot versions of different station instances (e.g. after a restart) and bay layouts.
+        self.epoch = uuid.uuid4().hex[:8]
+        self._listeners: List[Callable[[StateSnapshot, List[StateChange]], None]] = []
+        self._snapshot_listeners: List[Callable[[StateSnapshot], None]] = []
+        self._actuation_listeners: List[Callable[[List[str], float], None]] = []
+        self._scanner: Optional[StateScanner] = None
+        self._interrupt: Optional[InterruptSource] = None
+        if config.interrupt_gpio is not None:
+            assert config.scan_interval is not None, "Interrupt mode requires a scan interval"
+            self._interrupt = GpioInterrupt(config.interrupt_gpio)
+        if config.scan_interval is not None:
+            self._scanner = StateScanner(
+                # Only the scans of the scanner are spaced in time, thus only they are debounced.
+                partial(self.scan, sample=True),
+                config.scan_interval,
+                self._interrupt,
+                None if self._interrupt is None else self.scan_interrupt,
+                config.active_scan_interval,
+                config.active_window,
+                self._confirm_snapshot,
+                config.max_staleness / 2,
             )
-            for bay_config in config.bays
-        }
 
-    def configure(self):
-        """ Initialize all the ports. """
+    def start(self):
+        """ Start the background scanner if configured. """
+
+        if self._scanner is not None:
+            self._scanner.start()
+
+    def stop(self):
+        """ Stop the background scanner and the bus threads. """
 
+        if self._scanner is not None:
+            self._scanner.stop()
+        if self._interrupt is not None:
+            self._interrupt.close()
+        self.executor.shutdown()
+
+    def _configure_state_controllers(self, i2c_port: int):
         for state_controller in self.state_controllers.values():
-            state_controller.configure()
+            if state_controller.i2c_port == i2c_port:
+                state_controller.configure()
+
+    def _configure_actuator_controllers(self, i2c_port: int):
         for actuator_controller in self.actuator_controllers.values():
-            actuator_controller.configure()
+            if actuator_controller.i2c_port == i2c_port:
+                actuator_controller.configure()
+
+    def configure(self):
+        """
+        Initialize all the ports, the buses in parallel. Returns as soon as the state controllers are configured, such
+        that the bays can be read. The actuator controllers are configured in the background after the queued reads,
+        actuations wait for the configuration of their bus, which then runs ahead of the reads.
+        """
+
+        bays = self.bays
+        self.executor.run_all(self._configure_state_controllers, bays.state_ports, priority=Priority.actuation)
+        with self._actuators_configured_lock:
+            self._actuators_configured = {
+                i2c_port: self.executor.submit(
+                    i2c_port, self._configure_actuator_controllers, i2c_port, priority=Priority.background
+                )
+                for i2c_port in bays.actuator_ports
+            }
+
+    def reload(self, config: StationConfig) -> List[str]:
+        """
+        Applies a changed config under live traffic and returns the ids of the reconfigured controllers.
+
+        Controllers whose config did not change are kept. New and changed controllers are configured before the bay
+        tables are swapped, such that operations either use the old or the new bays. If configuring fails, the old bays
+        are kept and their controllers are configured again. Changes of the scanner, the interrupt and the queue size
+        require a restart.
+        """
+
+        assert len({c.controller_id for c in config.state_controllers}) == len(config.state_controllers), \
+            "Duplicate state controller ids in config"
+        assert len({c.controller_id for c in config.actuator_controllers}) == len(config.actuator_controllers), \
+            "Duplicate actuator controller ids in config"
+
+        with self._reload_lock:
+            state_controllers: Dict[str, StateController] = {}
+            for state_controller_config in config.state_controllers:
+                state_controller = self.state_controllers.get(state_controller_config.controller_id)
+                if state_controller is None or state_controller.config != state_controller_config:
+                    state_controller = StateController(state_controller_config)
+                state_controllers[state_controller_config.controller_id] = state_controller
+            actuator_controllers: Dict[str, ActuatorController] = {}
+            for actuator_controller_config in config.actuator_controllers:
+                actuator_controller = self.actuator_controllers.get(actuator_controller_config.controller_id)
+                if actuator_controller is None or actuator_controller.config != actuator_controller_config:
+                    actuator_controller = ActuatorController(actuator_controller_config)
+                actuator_controllers[actuator_controller_config.controller_id] = actuator_controller
+            bays = BayTable(config.bays, state_controllers, actuator_controllers)
+
+            reconfigured: List[Controller] = [
+                controller
+                for controller in (*state_controllers.values(), *actuator_controllers.values())
+                if controller is not self.state_controllers.get(controller.controller_id)
+                and controller is not self.actuator_controllers.get(controller.controller_id)
+            ]
+            if reconfigured:
+                self.executor.add_buses(controller.i2c_port for controller in reconfigured)
+
+                def configure_bus(i2c_port: int):
+                    for controller in reconfigured:
+                        if controller.i2c_port == i2c_port:
+                            controller.configure()
+
+                try:
+                    self.executor.run_all(
+                        configure_bus, {controller.i2c_port for controller in reconfigured}, priority=Priority.actuation
+                    )
+                except OSError:
+                    # The current bays are kept, restore their controllers which might have been configured already.
+                    self._restore_controllers(reconfigured)
+                    raise
+
+            with self._snapshot_lock:
+                if bays.bay_ids != self.bays.bay_ids:
+                    self.epoch = uuid.uuid4().hex[:8]
+                self.state_controllers = state_controllers
+                self.actuator_controllers = actuator_controllers
+                self.bays = bays
+                self._register_values = None
+                self._debouncer = RegisterDebouncer(len(bays.register_slot_keys), config.debounce_samples)
+                self.max_staleness = config.max_staleness
+                if self._scanner is not None:
+                    self._scanner.confirm_interval = config.max_staleness / 2
+                self.max_concurrent_actuations = config.max_concurrent_actuations
+        # Publish the states of the new bays right away.
+        self.scan()
+        return [controller.controller_id for controller in reconfigured]
+
+    def _restore_controllers(self, reconfigured: List[Controller]):
+        """Configures the current controllers at the addresses of the given controllers again, after a failed reload."""
+
+        addresses = {(controller.i2c_port, controller.address) for controller in reconfigured}
+        restored = [
+            controller
+            for controller in (*self.state_controllers.values(), *self.actuator_controllers.values())
+            if (controller.i2c_port, controller.address) in addresses
+        ]
+
+        def configure_bus(i2c_port: int):
+            for controller in restored:
+                if controller.i2c_port == i2c_port:
+                    controller.configure()
+
+        try:
+            self.executor.run_all(
+                configure_bus, {controller.i2c_port for controller in restored}, priority=Priority.actuation
+            )
+        except OSError:
+            logger.exception("Failed to restore the controllers after a failed reload")
+
+    def _wait_actuators_configured(self, i2c_port: int):
+        """Waits until the actuator controllers of the bus are configured. Configures them again if that failed."""
+
+        with self._actuators_configured_lock:
+            future = self._actuators_configured.get(i2c_port)
+            if future is None:
+                return
+            if future.done() and future.exception() is not None:
+                future = self.executor.submit(
+                    i2c_port, self._configure_actuator_controllers, i2c_port, priority=Priority.actuation
+                )
+                self._actuators_configured[i2c_port] = future
+        if not future.done():
+            # An actuation must not wait behind the reads for a background configuration.
+            self.executor.prioritize(i2c_port, future, Priority.actuation)
+        future.result()
+
+    def wait_configured(self):
+        """Waits until the actuator controllers of all buses are configured."""
+
+        for i2c_port in self.bays.actuator_ports:
+            self._wait_actuators_configured(i2c_port)
 
     def open_bay(self, bay_id: str) -> None:
         """Open the bay with the given id."""
 
-        bay = self.bays[bay_id]
-        bay.actuator_controller.open_bay(bay.actuator_controller_address)
+        bays = self.bays
+        bay_index = bays.bay_indices[bay_id]
+        actuator_controller = bays.actuator_controller(bay_index)
+        self._wait_actuators_configured(actuator_controller.i2c_port)
+        timestamp = time.time()
+        self.executor.run(
+            actuator_controller.i2c_port,
+            actuator_controller.pulse,
+            {bays.actuator_registers[bay_index]: bays.actuator_masks[bay_index]},
+            priority=Priority.actuation,
+        )
+        for actuation_listener in self._actuation_listeners:
+            actuation_listener([bay_id], timestamp)
+        # The door is about to be opened and closed.
+        self.notify_activity()
 
     def open_all_bays(self) -> None:
-        """Open all bays."""
+        """Open all bays, at most max_concurrent_actuations at the same time."""
+
+        # Split the bays into pulses of at most max_concurrent_actuations bits, with the bits of every pulse combined
+        # per bus, controller and register.
+        bays = self.bays
+        max_concurrent_actuations = self.max_concurrent_actuations
+        pulses: List[Dict[int, Dict[ActuatorController, Dict[int, int]]]] = []
+        pulse_bits = max_concurrent_actuations
+        for bay_index in range(len(bays)):
+            register_bit_mask = bays.actuator_masks[bay_index]
+            bits = bin(register_bit_mask).count('1')
+            if pulse_bits + bits > max_concurrent_actuations:
+                pulses.append({})
+                pulse_bits = 0
+            actuator_controller = bays.actuator_controller(bay_index)
+            register_masks = pulses[-1].setdefault(actuator_controller.i2c_port, {}).setdefault(
+                actuator_controller, {}
+            )
+            controller_register = bays.actuator_registers[bay_index]
+            register_masks[controller_register] = register_masks.get(controller_register, 0) | register_bit_mask
+            pulse_bits += bits
 
-        for bay in self.bays.values():
-            bay.actuator_controller.open_bay(bay.actuator_controller_address)
+        for i2c_port in bays.actuator_ports:
+            self._wait_actuators_configured(i2c_port)
+        timestamp = time.time()
+        for pulse in pulses:
+            self.executor.run_all(
+                lambda i2c_port: pulse_controllers(list(pulse[i2c_port].items())), pulse, priority=Priority.actuation
+            )
+        for actuation_listener in self._actuation_listeners:
+            actuation_listener(list(bays.bay_ids), timestamp)
+        self.notify_activity()
 
-    def get_states(self) -> Dict[str, bool]:
-        """Gets the state of all bays."""
+    def notify_activity(self):
+        """Scans at the active interval for the active window, e.g. after a card tap as bays are about to change."""
 
-        return {
-            bay.bay_id: bay.state_controller.is_open(bay.state_controller_address)
-            for bay in self.bays.values()
-        }
+        if self._scanner is not None:
+            self._scanner.activity()
+
+    @contextmanager
+    def active(self) -> Iterator[None]:
+        """Scans at the active interval while in the context, e.g. while clients wait for state changes."""
+
+        if self._scanner is None:
+            yield
+            return
+        self._scanner.hold()
+        try:
+            yield
+        finally:
+            self._scanner.release()
+
+    def _read_registers(
+            self,
+            bays: BayTable,
+            read_register: Callable[[StateController, int], int],
+            register_slots: Optional[Collection[int]] = None,
+    ) -> List[Optional[int]]:
+        """
+        Reads all (or the given) state registers of the bays by register slot, the buses in parallel. The value of
+        registers which could not be read (e.g. because their controller is degraded) or which were not to be read is
+        None.
+        """
+
+        if register_slots is None:
+            register_slots_by_port = bays.register_slots_by_port
+        else:
+            register_slots_by_port = {}
+            for i2c_port, port_register_slots in bays.register_slots_by_port.items():
+                port_register_slots = [
+                    register_slot for register_slot in port_register_slots if register_slot in register_slots
+                ]
+                if port_register_slots:
+                    register_slots_by_port[i2c_port] = port_register_slots
+
+        def read_bus(i2c_port: int) -> List[Optional[int]]:
+            values: List[Optional[int]] = []
+            for register_slot in register_slots_by_port[i2c_port]:
+                try:
+                    values.append(read_register(
+                        bays.register_slot_controller(register_slot), bays.register_slot_keys[register_slot][1]
+                    ))
+                except OSError:
+                    values.append(None)
+            return values
+
+        register_values: List[Optional[int]] = [None] * len(bays.register_slot_keys)
+        # Identical reads of all registers which are still queued are done only once.
+        bus_results = self.executor.run_all(
+            read_bus,
+            register_slots_by_port,
+            key=(read_register, bays, None if register_slots is None else frozenset(register_slots)),
+        )
+        for i2c_port, bus_register_values in bus_results.items():
+            for register_slot, value in zip(register_slots_by_port[i2c_port], bus_register_values):
+                register_values[register_slot] = value
+        return register_values
+
+    def get_states(self) -> Dict[str, Optional[bool]]:
+        """Gets the state of all bays. The state of bays which could not be read is None."""
+
+        bays = self.bays
+        return dict(zip(bays.bay_ids, bays.decode_states(
+            self._read_registers(bays, StateController.read_state_register)
+        )))
+
+    def get_state(self, bay_id: str) -> Optional[bool]:
+        """Get the state of the bay with the given id. Returns None if it could not be read."""
+
+        bays = self.bays
+        bay_index = bays.bay_indices[bay_id]
+        state_controller = bays.state_controller(bay_index)
+        controller_register = bays.state_registers[bay_index]
+        try:
+            state_register = self.executor.run(
+                state_controller.i2c_port,
+                state_controller.read_state_register,
+                controller_register,
+                # Identical reads of the register which are still queued are done only once.
+                key=(StateController.read_state_register, state_controller.controller_id, controller_register),
+            )
+        except OSError:
+            return None
+        # If the bit of the bay is set, then the door is closed.
+        return state_register & bays.state_masks[bay_index] == 0
+
+    def _start_read(self) -> int:
+        """Numbers a read of the state registers, such that reads are published in the order they were started."""
+
+        with self._snapshot_lock:
+            self._read_sequence += 1
+            return self._read_sequence
+
+    def scan(self, sample: bool = False) -> StateSnapshot:
+        """
+        Scans the states of all bays and publishes them as new snapshot. If sample, the read registers are debounced,
+        otherwise they are taken as stable.
+        """
+
+        # Scans again if the bays were reloaded while reading.
+        while True:
+            bays = self.bays
+            sequence = self._start_read()
+            snapshot = self._publish(
+                bays, sequence, self._read_registers(bays, StateController.read_state_register), sample=sample
+            )
+            if snapshot is not None:
+                return snapshot
+
+    def scan_interrupt(self) -> StateSnapshot:
+        """
+        Handles an interrupt of the state controllers and publishes the states as new snapshot.
+
+        All state controllers share the INT line, thus the interrupt capture registers of all of them are read, which
+        clears the interrupt. Controllers which did not fire keep a stale capture, thus the captures only tell which
+        controllers changed since the last scan: their state registers are read again, the other registers keep their
+        last read value. The read registers are published without debouncing, a bouncing contact fires again and is
+        read once more.
+        """
+
+        while True:
+            bays = self.bays
+            with self._snapshot_lock:
+                last_register_values = self._register_values
+            if last_register_values is None or bays is not self.bays:
+                # Nothing to compare the captures with.
+                return self.scan()
+            sequence = self._start_read()
+            captures = self._read_registers(bays, StateController.read_interrupt_capture_register)
+            fired_controller_slots = {
+                bays.register_slot_keys[register_slot][0]
+                for register_slot, capture in enumerate(captures)
+                if capture is not None and capture != last_register_values[register_slot]
+            }
+            fired_register_slots = [
+                register_slot
+                for register_slot, (controller_slot, _) in enumerate(bays.register_slot_keys)
+                if controller_slot in fired_controller_slots
+            ]
+            fired_register_values = self._read_registers(
+                bays, StateController.read_state_register, fired_register_slots
+            )
+            snapshot = self._publish(bays, sequence, fired_register_values, fired_register_slots)
+            if snapshot is not None:
+                return snapshot
+
+    def _publish(
+            self,
+            bays: BayTable,
+            sequence: int,
+            register_values: List[Optional[int]],
+            register_slots: Optional[Collection[int]] = None,
+            sample: bool = False,
+    ) -> Optional[StateSnapshot]:
+        """
+        Publishes the states of the scanned state registers as new snapshot and notifies the listeners about the
+        changes. If sample, the registers are debounced, otherwise they are taken as stable. Bays which could not be
+        read keep their last known state and are marked as degraded. If only the given register slots were read, the
+        other registers keep their last published value.
+
+        Returns None if the bays were reloaded meanwhile. If a read which was started later was published meanwhile,
+        the read is dropped and its snapshot is returned, such that an older read never reverts a newer one.
+        """
+
+        with self._snapshot_lock:
+            if bays is not self.bays:
+                return None
+            if sequence < self._published_sequence:
+                return self._snapshot
+            if register_slots is not None:
+                read_register_values = register_values
+                register_values = (
+                    [None] * len(bays.register_slot_keys) if self._register_values is None
+                    else list(self._register_values)
+                )
+                for register_slot in register_slots:
+                    register_values[register_slot] = read_register_values[register_slot]
+            self._published_sequence = sequence
+            self._register_values = register_values
+            if sample:
+                filtered_register_values = self._debouncer.update(register_values)
+            else:
+                filtered_register_values = self._debouncer.override(register_values, register_slots)
+            read_states = dict(zip(bays.bay_ids, bays.decode_states(filtered_register_values)))
+            timestamp = time.time()
+            previous_snapshot = self._snapshot
+            degraded = frozenset(bay_id for bay_id, is_open in read_states.items() if is_open is None)
+            states: Dict[str, Optional[bool]] = read_states
+            if degraded:
+                previous_states = {} if previous_snapshot is None else previous_snapshot.states
+                # Bays which were never read successfully stay unknown.
+                states = {
+                    bay_id: previous_states.get(bay_id) if is_open is None else is_open
+                    for bay_id, is_open in read_states.items()
+                }
+            if previous_snapshot is None:
+                snapshot = StateSnapshot(version=1, timestamp=timestamp, states=states, degraded=degraded)
+                self._snapshot = snapshot
+                for snapshot_listener in self._snapshot_listeners:
+                    snapshot_listener(snapshot)
+                return snapshot
+            changes = [
+                StateChange(bay_id=bay_id, open=is_open, timestamp=timestamp)
+                for bay_id, is_open in states.items()
+                if is_open is not None and previous_snapshot.states.get(bay_id) != is_open
+            ]
+            changed = (
+                bool(changes) or degraded != previous_snapshot.degraded
+                # Bays were removed by a reload.
+                or len(states) != len(previous_snapshot.states)
+            )
+            snapshot = StateSnapshot(
+                version=previous_snapshot.version + 1 if changed else previous_snapshot.version,
+                timestamp=timestamp,
+                states=states,
+                degraded=degraded,
+            )
+            self._snapshot = snapshot
+            for snapshot_listener in self._snapshot_listeners:
+                snapshot_listener(snapshot)
+            if changes:
+                for listener in self._listeners:
+                    listener(snapshot, changes)
+                # Further changes are likely, e.g. a door which was opened is closed again.
+                self.notify_activity()
+            return snapshot
+
+    def _confirm_snapshot(self):
+        """
+        Publishes the last snapshot again with the current time. Called by the scanner in interrupt mode while the
+        interrupt did not fire, i.e. the states did not change.
+        """
+
+        with self._snapshot_lock:
+            if self._snapshot is None:
+                return
+            snapshot = self._snapshot._replace(timestamp=time.time())
+            self._snapshot = snapshot
+            for snapshot_listener in self._snapshot_listeners:
+                snapshot_listener(snapshot)
+
+    def add_listener(self, listener: Callable[[StateSnapshot, List[StateChange]], None]):
+        """Adds a listener which is called on the scanning thread with the changes of every scan."""
+
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[StateSnapshot, List[StateChange]], None]):
+        """Removes a previously added listener."""
+
+        self._listeners.remove(listener)
+
+    def add_snapshot_listener(self, listener: Callable[[StateSnapshot], None]):
+        """Adds a listener which is called with every published snapshot, also if nothing changed."""
+
+        self._snapshot_listeners.append(listener)
+
+    def remove_snapshot_listener(self, listener: Callable[[StateSnapshot], None]):
+        """Removes a previously added snapshot listener."""
+
+        self._snapshot_listeners.remove(listener)
+
+    def add_actuation_listener(self, listener: Callable[[List[str], float], None]):
+        """Adds a listener which is called with the opened bays and the time of the command after every actuation."""
+
+        self._actuation_listeners.append(listener)
+
+    def remove_actuation_listener(self, listener: Callable[[List[str], float], None]):
+        """Removes a previously added actuation listener."""
+
+        self._actuation_listeners.remove(listener)
+
+    @property
+    def scanning(self) -> bool:
+        """Whether the background scanner is enabled."""
+
+        return self._scanner is not None
 
-    def get_state(self, bay_id: str) -> bool:
-        """Get the state of the bay with the given id."""
+    def get_snapshot(self) -> Optional[StateSnapshot]:
+        """Gets the snapshot of the background scanner. Returns None if the scanner is disabled or it is stale."""
 
-        bay = self.bays[bay_id]
-        return bay.state_controller.is_open(bay.state_controller_address)
+        snapshot = self._snapshot
+        if self._scanner is None or snapshot is None or time.time() - snapshot.timestamp > self.max_staleness:
+            return None
+        return snapshot
@@ -0,0 +1,108 @@
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .controller import ActuatorController, StateController
+
+
+class BayTable:
+    """
+    Compact tables of the bays of a station, indexed by bay index (the order of the config).
+
+    The state registers are numbered by register slot in the order they are first used by a bay. Scans read every
+    register slot once and decode the bays of a register with its precomputed bay indices and masks.
+    """
+
+    __slots__ = (
+        'bay_ids', 'bay_indices',
+        'state_controllers', 'state_controller_slots', 'state_registers', 'state_masks',
+        'actuator_controllers', 'actuator_controller_slots', 'actuator_registers', 'actuator_masks',
+        'register_slots', 'register_slot_keys', 'register_slot_bay_indices', 'register_slot_masks',
+        'register_slots_by_port', 'state_ports', 'actuator_ports',
+    )
+
+    def __init__(
+            self,
+            bays: Sequence[Tuple[str, str, int, int, str, int, int]],
+            state_controllers: Dict[str, StateController],
+            actuator_controllers: Dict[str, ActuatorController],
+    ):
+        self.bay_ids: Tuple[str, ...] = tuple(bay[0] for bay in bays)
+        self.bay_indices: Dict[str, int] = {bay_id: bay_index for bay_index, bay_id in enumerate(self.bay_ids)}
+        assert len(self.bay_indices) == len(self.bay_ids), "Duplicate bay ids in config"
+
+        state_controller_slots = {controller_id: slot for slot, controller_id in enumerate(state_controllers)}
+        actuator_controller_slots = {controller_id: slot for slot, controller_id in enumerate(actuator_controllers)}
+        self.state_controllers: Tuple[StateController, ...] = tuple(state_controllers.values())
+        self.actuator_controllers: Tuple[ActuatorController, ...] = tuple(actuator_controllers.values())
+
+        # Bay index -> controller slot, controller register and register bit mask.
+        self.state_controller_slots = array('H', (state_controller_slots[bay[1]] for bay in bays))
+        self.state_registers = array('B', (bay[2] for bay in bays))
+        self.state_masks = array('B', (bay[3] for bay in bays))
+        self.actuator_controller_slots = array('H', (actuator_controller_slots[bay[4]] for bay in bays))
+        self.actuator_registers = array('B', (bay[5] for bay in bays))
+        self.actuator_masks = array('B', (bay[6] for bay in bays))
+
+        # (state controller slot, controller register) -> register slot, and register slot -> bay indices and masks.
+        self.register_slots: Dict[Tuple[int, int], int] = {}
+        register_slot_bay_indices: List[List[int]] = []
+        register_slot_masks: List[List[int]] = []
+        for bay_index in range(len(self.bay_ids)):
+            key = (self.state_controller_slots[bay_index], self.state_registers[bay_index])
+            register_slot = self.register_slots.setdefault(key, len(self.register_slots))
+            if register_slot == len(register_slot_bay_indices):
+                register_slot_bay_indices.append([])
+                register_slot_masks.append([])
+            register_slot_bay_indices[register_slot].append(bay_index)
+            register_slot_masks[register_slot].append(self.state_masks[bay_index])
+        self.register_slot_keys: Tuple[Tuple[int, int], ...] = tuple(self.register_slots)
+        self.register_slot_bay_indices: Tuple[array, ...] = tuple(
+            array('H', bay_indices) for bay_indices in register_slot_bay_indices
+        )
+        self.register_slot_masks: Tuple[array, ...] = tuple(array('B', masks) for masks in register_slot_masks)
+
+        # The register slots grouped by the bus they are read from, such that the buses are read in parallel.
+        self.register_slots_by_port: Dict[int, List[int]] = {}
+        for register_slot in range(len(self.register_slot_keys)):
+            self.register_slots_by_port.setdefault(
+                self.register_slot_controller(register_slot).i2c_port, []
+            ).append(register_slot)
+        self.state_ports: Tuple[int, ...] = tuple(sorted({
+            state_controller.i2c_port for state_controller in self.state_controllers
+        }))
+        self.actuator_ports: Tuple[int, ...] = tuple(sorted({
+            actuator_controller.i2c_port for actuator_controller in self.actuator_controllers
+        }))
+
+    def __len__(self) -> int:
+        return len(self.bay_ids)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.bay_ids)
+
+    def __contains__(self, bay_id: object) -> bool:
+        return bay_id in self.bay_indices
+
+    def state_controller(self, bay_index: int) -> StateController:
+        return self.state_controllers[self.state_controller_slots[bay_index]]
+
+    def actuator_controller(self, bay_index: int) -> ActuatorController:
+        return self.actuator_controllers[self.actuator_controller_slots[bay_index]]
+
+    def register_slot_controller(self, register_slot: int) -> StateController:
+        return self.state_controllers[self.register_slot_keys[register_slot][0]]
+
+    def decode_states(self, register_values: Sequence[Optional[int]]) -> List[Optional[bool]]:
+        """
+        Gets the state of all bays by bay index from the values of all state registers by register slot. The state of
+        bays whose register could not be read (None) is None.
+        """
+
+        states: List[Optional[bool]] = [None] * len(self.bay_ids)
+        for bay_indices, masks, value in zip(self.register_slot_bay_indices, self.register_slot_masks, register_values):
+            if value is None:
+                continue
+            # If the bit of the bay is set, then the door is closed.
+            for bay_index, mask in zip(bay_indices, masks):
+                states[bay_index] = value & mask == 0
+        return states
@@ -0,0 +1,121 @@
+import asyncio
+import httpx
+import importlib.util
+import time
+from typing import Dict, NamedTuple, Optional
+
+from device_server.metrics import UPSTREAM_REQUEST_SECONDS
+from device_server.model.auth import CardModel
+from .cache import AuthorizationCache
+from .reader import CardAuthConfig
+
+
+class DepotResponse(NamedTuple):
+    """ Response of the depot server, which can be cached and sent to another process. """
+
+    status_code: int
+    content: bytes
+    headers: Dict[str, str]
+
+
+class CardAuthorizer:
+    """
+    Authorizes the cards at the depot server. The results are cached, and the authorization of a card is started as
+    soon as the card was read, such that the result is ready when it is fetched.
+    """
+
+    def __init__(self, config: CardAuthConfig):
+        self.config = config
+        # Long-lived client, such that the connections to the depot server are kept alive between card taps.
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self.cache: AuthorizationCache[DepotResponse] = AuthorizationCache(
+            config.auth_cache_ttl, config.auth_cache_negative_ttl, config.auth_cache_size
+        )
+        # Authorizations which were started as soon as a card was read, by card id.
+        self.prefetched: Dict[str, 'asyncio.Future[DepotResponse]'] = {}
+
+    def start(self):
+        """ Opens the connection pool. Must be called from the event loop which authorizes the cards. """
+        self._http_client = httpx.AsyncClient(
+            timeout=self.config.http_timeout,
+            limits=httpx.Limits(
+                max_connections=self.config.http_max_connections,
+                max_keepalive_connections=self.config.http_max_keepalive_connections,
+            ),
+            http2=self.config.http2 and importlib.util.find_spec('h2') is not None,
+        )
+
+    async def stop(self):
+        for future in self.prefetched.values():
+            future.cancel()
+        self.prefetched.clear()
+        await self._http_client.aclose()
+        self._http_client = None
+        self.cache.clear()
+
+    async def _post(self, endpoint: str, card: CardModel) -> DepotResponse:
+        """ Posts the card to the endpoint of the depot server. """
+        assert self._http_client is not None, "Not started"
+        api_key = self.config.card_login_api_key
+        start = time.perf_counter()
+        try:
+            response = await self._http_client.post(
+                f"{self.config.server_url}/card/{endpoint}",
+                json=card.dict(),
+                headers={} if api_key is None else {'X-Card-Api-Key': api_key},
+            )
+        except httpx.HTTPError:
+            UPSTREAM_REQUEST_SECONDS.labels(endpoint=endpoint, status_code='error').observe(
+                time.perf_counter() - start
+            )
+            raise
+        UPSTREAM_REQUEST_SECONDS.labels(endpoint=endpoint, status_code=response.status_code).observe(
+            time.perf_counter() - start
+        )
+        return DepotResponse(response.status_code, response.content, dict(response.headers.items()))
+
+    async def _request_authorization(self, card_id: str) -> DepotResponse:
+        """ Requests the authorization of the card from the depot server and caches the result. """
+        response = await self._post('authorize', CardModel(card_id=card_id))
+        if response.status_code == 200:
+            self.cache.put(card_id, response)
+        elif response.status_code == 404:
+            self.cache.put(card_id, response, negative=True)
+        return response
+
+    def _expire_prefetched(self, card_id: str, future: 'asyncio.Future[DepotResponse]'):
+        if self.prefetched.get(card_id) is future:
+            del self.prefetched[card_id]
+
+    def prefetch(self, card_id: str):
+        """ Starts the authorization of the card. Card reader listener, called on the event loop. """
+        if card_id in self.prefetched or self.cache.get(card_id) is not None:
+            return
+        future = asyncio.ensure_future(self._request_authorization(card_id))
+        # Retrieve the exception, such that it is not logged if the card is never fetched. It is raised again when
+        # fetched.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.prefetched[card_id] = future
+        # Kept until it is fetched if there is no timeout.
+        if self.config.card_associate_login_timeout is not None:
+            asyncio.get_event_loop().call_later(
+                self.config.card_associate_login_timeout, self._expire_prefetched, card_id, future
+            )
+
+    async def authorize(self, card_id: str) -> DepotResponse:
+        """ Gets the authorization of the card: the prefetched one, the cached one or a new one. """
+        future = self.prefetched.pop(card_id, None)
+        if future is not None:
+            return await future
+        response = self.cache.get(card_id)
+        if response is None:
+            response = await self._request_authorization(card_id)
+        return response
+
+    async def register(self, card: CardModel) -> DepotResponse:
+        """ Registers the card at the depot server. Its cached authorization is dropped on success. """
+        response = await self._post('register', card)
+        if 200 <= response.status_code < 300:
+            self.cache.invalidate(card.card_id)
+            self.prefetched.pop(card.card_id, None)
+        return response
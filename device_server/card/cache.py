@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Generic, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class AuthorizationCache(Generic[T]):
+    """
+    Size bound LRU cache of authorization results keyed by card id. Positive and negative (i.e. card not registered)
+    results expire after separate times.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lock = Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, T]]' = OrderedDict()
+
+    def get(self, card_id: str) -> Optional[T]:
+        """ Gets the cached result for the card or None if there is none or it expired. """
+        with self._lock:
+            entry = self._entries.get(card_id)
+            if entry is None:
+                return None
+            expires_at, result = entry
+            if expires_at < time.monotonic():
+                del self._entries[card_id]
+                return None
+            self._entries.move_to_end(card_id)
+            return result
+
+    def put(self, card_id: str, result: T, negative: bool = False):
+        """ Caches the result for the card. Negative results are cached for the negative ttl. """
+        ttl = self.negative_ttl if negative else self.ttl
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[card_id] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(card_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, card_id: str):
+        """ Removes the cached result of the card. """
+        with self._lock:
+            self._entries.pop(card_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
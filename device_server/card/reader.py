@@ -1,9 +1,12 @@
+import asyncio
 import time
 from pydantic import BaseModel
 
 from threading import Thread
 
-from typing import Optional
+from typing import Callable, List, Optional
+
+from device_server.metrics import CARD_READER_ITERATION_SECONDS
 
 
 class CardAuthConfig(BaseModel):
@@ -11,6 +14,23 @@ class CardAuthConfig(BaseModel):
     client_id: str
     card_login_api_key: Optional[str]
     card_associate_login_timeout: Optional[int]
+    # Timeout in seconds for the requests to the depot server.
+    http_timeout: float = 5.0
+    # Limits of the connection pool to the depot server.
+    http_max_connections: int = 10
+    http_max_keepalive_connections: int = 5
+    # Use HTTP/2 for the connection to the depot server if the h2 package is installed.
+    http2: bool = True
+    # Time in seconds for which the authorization result of a registered card is cached. Disabled if 0.
+    auth_cache_ttl: float = 60.0
+    # Time in seconds for which an unregistered card is cached. Disabled if 0.
+    auth_cache_negative_ttl: float = 10.0
+    # Maximum number of cached cards.
+    auth_cache_size: int = 256
+    # Interval in seconds in which the card reader is polled. When no card is present, the interval is doubled up to
+    # the idle interval.
+    card_poll_interval: float = 0.1
+    card_idle_poll_interval: float = 0.4
 
 
 class CardReader:
@@ -19,12 +39,22 @@ class CardReader:
     _last_fetched_id: Optional[str] = None
     _last_seen_timestamp: float = 0
     _running: bool
+    _loop: asyncio.AbstractEventLoop
+    _card_event: asyncio.Event
 
     def __init__(self, config: CardAuthConfig):
         self.config = config
+        self._listeners: List[Callable[[str], None]] = []
         self._reader_thread = Thread(target=self._read_card_thread, name="card_reader_thread")
 
+    def add_listener(self, listener: Callable[[str], None]):
+        """ Adds a listener which is called on the event loop with every newly read card id. """
+        self._listeners.append(listener)
+
     def start(self):
+        """ Start the reader thread. Must be called from the event loop which waits for the cards. """
+        self._loop = asyncio.get_event_loop()
+        self._card_event = asyncio.Event()
         self._running = True
         self._reader_thread.start()
 
@@ -36,24 +66,45 @@ class CardReader:
         import nxppy
         mifare = nxppy.Mifare()
 
+        poll_interval = self.config.card_poll_interval
         while self._running:
+            time.sleep(poll_interval)
+            iteration_start = time.perf_counter()
             try:
-                time.sleep(0.1)
                 read_card_id = mifare.select()
             except nxppy.SelectError:
                 read_card_id = None
 
-            if time.time() - self._last_seen_timestamp > self.config.card_associate_login_timeout:
+            if read_card_id is None:
+                # Back off while no card is present
+                poll_interval = min(poll_interval * 2, self.config.card_idle_poll_interval)
+            else:
+                poll_interval = self.config.card_poll_interval
+
+            if (
+                    self._last_seen_id is not None
+                    and time.time() - self._last_seen_timestamp > self.config.card_associate_login_timeout
+            ):
                 # Reset last seen state if timeout occurred
                 self._last_seen_id = None
-                self._last_fetched_id = None
+                self._loop.call_soon_threadsafe(self._card_reset)
             if read_card_id is not None and self._last_seen_id != read_card_id:
                 # Save the read card data if different
                 self._last_seen_id = read_card_id
-                self._last_fetched_id = read_card_id.hex()
                 self._last_seen_timestamp = time.time()
+                self._loop.call_soon_threadsafe(self._card_read, read_card_id.hex())
+            CARD_READER_ITERATION_SECONDS.observe(time.perf_counter() - iteration_start)
+
+    def _card_reset(self):
+        self._last_fetched_id = None
+
+    def _card_read(self, card_id: str):
+        self._last_fetched_id = card_id
+        self._card_event.set()
+        for listener in self._listeners:
+            listener(card_id)
 
-    def read_card_id(self) -> str:
+    def read_card_id(self) -> Optional[str]:
         """
         Returns and resets the last encountered card id. Should not return the same card twice within a specific time
         interval.
@@ -64,3 +115,24 @@ class CardReader:
         result = self._last_fetched_id
         self._last_fetched_id = None
         return result
+
+    async def wait_card_id(self, timeout: float) -> Optional[str]:
+        """
+        Like `read_card_id`, but waits up to timeout seconds for a card if there is none yet.
+
+        Returns:
+            The read card identifier or None on timeout.
+        """
+        deadline = self._loop.time() + timeout
+        while True:
+            result = self.read_card_id()
+            if result is not None:
+                return result
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return None
+            self._card_event.clear()
+            try:
+                await asyncio.wait_for(self._card_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
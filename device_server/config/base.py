@@ -1,11 +1,22 @@
+import hashlib
 import io
+import logging
 import os
-from typing import Any, Dict, Union, Type, TypeVar
+import pickle
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, Type, TypeVar
 
 import oyaml as yaml
+import pydantic
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 DEFAULT_PATH = os.environ.get('API_CONFIG_FILE', os.path.join(os.path.dirname(__file__), '..', 'config.yaml'))
+# Cache of the validated config, disabled if not set. The cache is unpickled, thus it must be in a directory only the
+# service can write to (e.g. the CacheDirectory of its systemd unit).
+DEFAULT_CACHE_PATH = os.environ.get('API_CONFIG_CACHE') or None
+# Env variables with the prefix which configure the loading instead of overriding the config.
+_RESERVED_ENV_KEYS = ('file', 'cache')
 
 
 def camelcase_to_underscore(camelcase: str) -> str:
@@ -29,39 +40,110 @@ def config_to_underscore(cfg):
     return cfg
 
 
-def _assign_key(cfg: Union[list, Dict[str, Any]], key: str, value: Any, self_path: str):
-    found_key: Any = None
-    found_key_underscore = None
-    first_part = key.split('_', 1)[0]
-    if isinstance(cfg, dict):
-        for cfg_key in cfg.keys():
-            if cfg_key.startswith(first_part):
-                if key.startswith(cfg_key):
-                    found_key = cfg_key
-                    found_key_underscore = cfg_key
-    elif isinstance(cfg, list):
-        try:
-            idx = int(first_part)
-        except ValueError:
-            pass
+class _KeyTrie:
+    """
+    Trie of the env keys of all nodes of a config by their '_'-separated parts, e.g. `station_bays_0` for
+    `config['station']['bays'][0]`. Resolves an env key to the path of its node in a single pass over the key.
+    """
+
+    __slots__ = ('children', 'path')
+
+    def __init__(self):
+        self.children: Dict[str, '_KeyTrie'] = {}
+        # Path of the config node of this env key, None if no node has this key.
+        self.path: Optional[Tuple[Union[str, int], ...]] = None
+
+    @classmethod
+    def build(cls, cfg: Any) -> '_KeyTrie':
+        root = cls()
+        root._add_children(cfg, ())
+        return root
+
+    def _add_children(self, cfg: Any, path: Tuple[Union[str, int], ...]):
+        if isinstance(cfg, dict):
+            items: Iterable[Tuple[Union[str, int], Any]] = cfg.items()
+        elif isinstance(cfg, list):
+            items = enumerate(cfg)
         else:
-            if 0 <= idx < len(cfg):
-                found_key = idx
-                found_key_underscore = first_part
-    else:
-        raise ValueError("Invalid cfg")
-    if found_key is None:
+            return
+        for cfg_key, value in items:
+            node = self
+            for part in str(cfg_key).split('_'):
+                node = node.children.setdefault(part, _KeyTrie())
+            node.path = path + (cfg_key,)
+            node._add_children(value, node.path)
+
+    def lookup(self, key: str) -> Optional[Tuple[Union[str, int], ...]]:
+        node = self
+        for part in key.split('_'):
+            child = node.children.get(part)
+            if child is None:
+                return None
+            node = child
+        return node.path
+
+
+def _assign_key(cfg: Any, trie: _KeyTrie, key: str, value: Any, self_path: str):
+    path = trie.lookup(key)
+    try:
+        if path is None:
+            raise KeyError(key)
+        for part in path[:-1]:
+            cfg = cfg[part]
+        # An override of a parent node might have replaced this node.
+        if isinstance(cfg, dict) and path[-1] not in cfg:
+            raise KeyError(key)
+        cfg[path[-1]] = value
+    except (KeyError, IndexError, TypeError):
         raise ValueError("Cannot find {} in {}".format(key, self_path))
-    if found_key_underscore == key:
-        cfg[found_key] = value
-    else:
-        assert found_key_underscore is not None
-        _assign_key(
-            cfg[found_key],
-            key[len(found_key_underscore)+1:],
-            value,
-            self_path + '_' + found_key_underscore
-        )
+
+
+def _cache_key(model_cls: Type[BaseModel], config_data: bytes, env_overrides: List[Tuple[str, str]]) -> str:
+    digest = hashlib.sha256()
+    digest.update(f'{model_cls.__module__}.{model_cls.__qualname__}\0{pydantic.VERSION}\0'.encode())
+    # Invalidates the cache if the config model changes.
+    digest.update(model_cls.schema_json().encode())
+    digest.update(b'\0')
+    digest.update(config_data)
+    for env_key, env_val in env_overrides:
+        digest.update(f'\0{env_key}={env_val}'.encode())
+    return digest.hexdigest()
+
+
+def _load_cached(cache_path: str, cache_key: str) -> Optional[BaseModel]:
+    try:
+        with open(cache_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            # Unpickling runs code, thus only a cache which nobody else could have written is trusted.
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                logger.warning("Ignoring config cache %s, which is not owned by the service or writable by others",
+                               cache_path)
+                return None
+            cached_key, config = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning("Ignoring invalid config cache %s", cache_path, exc_info=True)
+        return None
+    if cached_key != cache_key:
+        return None
+    return config
+
+
+def _store_cached(cache_path: str, cache_key: str, config: BaseModel):
+    # Written to a temporary file first, such that concurrently starting workers never read a partial cache.
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', mode=0o700, exist_ok=True)
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            pickle.dump((cache_key, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        logger.warning("Cannot write the config cache %s", cache_path, exc_info=True)
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
 
 
 TConfig = TypeVar('TConfig', bound=BaseModel)
@@ -71,16 +153,38 @@ def load_config(
         model_cls: Type[TConfig],
         config_file: str = DEFAULT_PATH,
         env_prefix: str = 'api_config_',
+        cache_path: Optional[str] = DEFAULT_CACHE_PATH,
 ) -> TConfig:
-    with open(config_file, 'r') as f:
-        config = yaml.load(f, Loader=yaml.SafeLoader)
+    """
+    Loads the config file, overridden by the env variables with the prefix (e.g. `API_CONFIG_STATION_BAYS_0='[...]'`).
+
+    The validated config is cached in cache_path (if set, `API_CONFIG_CACHE` by default) by the content of the config
+    file and the env overrides.
+    """
+    with open(config_file, 'rb') as f:
+        config_data = f.read()
+    env_overrides = sorted(
+        (env_key.lower()[len(env_prefix):], env_val)
+        for env_key, env_val in os.environ.items()
+        if env_key.lower().startswith(env_prefix) and env_key.lower()[len(env_prefix):] not in _RESERVED_ENV_KEYS
+    )
+    cache_key: Optional[str] = None
+    if cache_path:
+        cache_key = _cache_key(model_cls, config_data, env_overrides)
+        cached_config = _load_cached(cache_path, cache_key)
+        if isinstance(cached_config, model_cls):
+            return cached_config
+
+    try:
+        config = yaml.load(config_data, Loader=yaml.SafeLoader)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Invalid config file {config_file}: {e}")
     # config = config_to_underscore(config)
-    for env_key, env_val in os.environ.items():
-        lower_key = env_key.lower()
-        if lower_key.startswith(env_prefix):
-            lower_key = lower_key[len(env_prefix):]
-
-            _assign_key(
-                config, lower_key, yaml.load(io.StringIO(env_val), Loader=yaml.SafeLoader), env_prefix[:-1]
-            )
-    return model_cls.validate(config)
+    trie = _KeyTrie.build(config)
+    # Sorted, such that overrides of a node are applied before the overrides of its children.
+    for env_key, env_val in env_overrides:
+        _assign_key(config, trie, env_key, yaml.load(io.StringIO(env_val), Loader=yaml.SafeLoader), env_prefix[:-1])
+    validated_config = model_cls.validate(config)
+    if cache_path and cache_key is not None:
+        _store_cached(cache_path, cache_key, validated_config)
+    return validated_config
@@ -1,11 +1,18 @@
 from pydantic import BaseModel, Field
 from typing import Optional, List
 
+from device_server.bay.journal import JournalConfig
 from device_server.bay.station import StationConfig
 from device_server.card.reader import CardAuthConfig
+from device_server.hardware.protocol import HardwareConfig
 
 
 class Config(BaseModel):
     card_auth: CardAuthConfig = Field(...)
     allow_origins: List[str] = Field(...)
     station: StationConfig = Field(...)
+    hardware: HardwareConfig = Field(HardwareConfig())
+    journal: JournalConfig = Field(JournalConfig())
+    # Interval in seconds in which the config file is checked for changes. Changes of the station are applied without
+    # restart, by the hardware process if there is one. Disabled if not set.
+    reload_interval: Optional[float] = None
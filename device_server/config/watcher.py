@@ -0,0 +1,56 @@
+import logging
+import os
+from threading import Event, Thread
+from typing import Any, Callable, Generic, Optional, Tuple, Type
+
+from .base import DEFAULT_PATH, TConfig, load_config
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher(Generic[TConfig]):
+    """
+    Polls the config file for changes and calls the callback with the reloaded config on the watcher thread. Polls
+    instead of using inotify, which is not available without additional dependencies.
+    """
+
+    def __init__(
+            self,
+            model_cls: Type[TConfig],
+            callback: Callable[[TConfig], Any],
+            interval: float,
+            config_file: str = DEFAULT_PATH,
+    ):
+        self.model_cls = model_cls
+        self.callback = callback
+        self.interval = interval
+        self.config_file = config_file
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="config_watcher_thread", daemon=True)
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.config_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        last_stat = self._stat()
+        while not self._stopped.wait(self.interval):
+            stat = self._stat()
+            if stat is None or stat == last_stat:
+                continue
+            last_stat = stat
+            try:
+                config = load_config(self.model_cls, self.config_file)
+                self.callback(config)
+            except Exception:
+                logger.exception("Cannot reload the config file %s", self.config_file)
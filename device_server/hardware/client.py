@@ -0,0 +1,396 @@
+import asyncio
+import logging
+import socket
+import time
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, cast
+
+from device_server.bay.scanner import StateChange, StateSnapshot
+from device_server.bay.station import StationConfig
+from device_server.card.authorizer import DepotResponse
+from device_server.card.reader import CardAuthConfig
+from device_server.model.auth import CardModel
+from .protocol import (
+    HardwareConfig, decode_depot_response, decode_error, decode_message, encode_message, read_message, send_message
+)
+from .shared import SharedSnapshotReader
+
+logger = logging.getLogger(__name__)
+
+
+class HardwareClient:
+    """ Blocking, thread-safe client of the hardware process. Keeps a pool of idle connections. """
+
+    # Seconds to wait before reconnecting a subscription.
+    reconnect_interval = 1.0
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._lock = Lock()
+        self._connections: List[Tuple[socket.socket, BinaryIO]] = []
+
+    def _connect(self) -> Tuple[socket.socket, BinaryIO]:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock, cast(BinaryIO, sock.makefile('rwb'))
+
+    def call(self, method: str, *args: Any) -> Any:
+        """
+        Calls the method in the hardware process and returns its result or raises its error. If an idle connection was
+        closed meanwhile, e.g. because the hardware process was restarted, the call is sent again on a new one.
+        """
+        with self._lock:
+            connection = self._connections.pop() if self._connections else None
+        if connection is not None:
+            try:
+                response = self._request(connection, method, args)
+            except OSError:
+                # No response was received. The other idle connections were closed as well.
+                logger.debug("Idle connection to the hardware process was closed, reconnecting", exc_info=True)
+                self.close()
+                connection = None
+        if connection is None:
+            connection = self._connect()
+            response = self._request(connection, method, args)
+        with self._lock:
+            self._connections.append(connection)
+        if 'error' in response:
+            raise decode_error(response)
+        return response['result']
+
+    @staticmethod
+    def _request(connection: Tuple[socket.socket, BinaryIO], method: str, args: Tuple[Any, ...]) -> Dict[str, Any]:
+        """ Sends the request and reads its response. Closes the connection if that failed. """
+        sock, file = connection
+        try:
+            send_message(file, {'method': method, 'args': args})
+            response = read_message(file)
+            if response is None:
+                raise ConnectionResetError("Hardware process closed the connection")
+        except (OSError, ValueError):
+            file.close()
+            sock.close()
+            raise
+        return response
+
+    async def call_async(self, method: str, *args: Any) -> Any:
+        """
+        Like `call`, but waits for the result on the event loop instead of blocking a thread, e.g. for long polls. Uses
+        a connection of its own, which is closed afterwards.
+        """
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(encode_message({'method': method, 'args': args}))
+            await writer.drain()
+            response = decode_message(await reader.readline())
+        finally:
+            writer.close()
+        if response is None:
+            raise ConnectionResetError("Hardware process closed the connection")
+        if 'error' in response:
+            raise decode_error(response)
+        return response['result']
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]) -> 'Subscription':
+        """ Calls callback with every event of the hardware process on a separate thread, until stopped. """
+        subscription = Subscription(self, callback)
+        subscription.start()
+        return subscription
+
+    def close(self):
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for sock, file in connections:
+            file.close()
+            sock.close()
+
+
+class Subscription:
+    """ Event stream of the hardware process, which reconnects if the connection was lost. """
+
+    def __init__(self, client: HardwareClient, callback: Callable[[Dict[str, Any]], None]):
+        self._client = client
+        self._callback = callback
+        self._stopped = Event()
+        self._sock: Optional[socket.socket] = None
+        self._thread = Thread(target=self._run, name="hardware_events_thread", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                sock, file = self._client._connect()
+            except OSError:
+                self._stopped.wait(self._client.reconnect_interval)
+                continue
+            self._sock = sock
+            try:
+                send_message(file, {'method': 'subscribe'})
+                while not self._stopped.is_set():
+                    event = read_message(file)
+                    if event is None:
+                        break
+                    self._callback(event)
+            except (OSError, ValueError):
+                pass
+            except Exception:
+                logger.exception("Error while handling the events of the hardware process")
+            finally:
+                self._sock = None
+                file.close()
+                sock.close()
+            self._stopped.wait(self._client.reconnect_interval)
+
+
+class RemoteStation:
+    """
+    Station which is owned by the hardware process. Has the interface of `Station`: the snapshots are read from shared
+    memory without IPC, all other operations are forwarded over the socket.
+    """
+
+    # Seconds to wait for the hardware process when configuring.
+    connect_timeout = 30.0
+
+    def __init__(self, config: StationConfig, hardware_config: HardwareConfig):
+        assert hardware_config.socket_path is not None, "No socket path configured"
+        self.max_staleness = config.max_staleness
+        self.active_window = config.active_window
+        self.snapshot_path = hardware_config.snapshot_path
+        # The bays of the hardware process, which might have been reloaded with a different config.
+        self.bays: Dict[str, int] = {bay_config[0]: bay_index for bay_index, bay_config in enumerate(config.bays)}
+        self.epoch = ''
+        self._client = HardwareClient(hardware_config.socket_path)
+        self._reader = SharedSnapshotReader(hardware_config.snapshot_path, list(self.bays))
+        self._listeners: List[Callable[[StateSnapshot, List[StateChange]], None]] = []
+        self._subscription: Optional[Subscription] = None
+        # Holds of `active`, which are renewed in the hardware process by the activity thread.
+        self._active_lock = Lock()
+        self._active_holds = 0
+        self._active_event = Event()
+        self._stopped = Event()
+        self._activity_thread = Thread(target=self._run_activity, name="hardware_activity_thread", daemon=True)
+
+    def configure(self):
+        """ Waits for the hardware process, which configures the controllers itself. """
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                info = self._client.call('info')
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self._set_bays(info)
+
+    def _set_bays(self, info: Dict[str, Any]):
+        if info['bay_ids'] != list(self.bays):
+            self.bays = {bay_id: bay_index for bay_index, bay_id in enumerate(info['bay_ids'])}
+            self._reader = SharedSnapshotReader(self.snapshot_path, info['bay_ids'])
+        self.epoch = info['epoch']
+
+    def _refresh_bays(self, epoch: str):
+        """ Fetches the bays of the hardware process if they were reloaded, i.e. the epoch changed. """
+        if epoch != self.epoch:
+            self._set_bays(self._client.call('info'))
+
+    def start(self):
+        """ Start receiving the state changes. """
+        self._subscription = self._client.subscribe(self._handle_event)
+        self._activity_thread.start()
+
+    def stop(self):
+        if self._subscription is not None:
+            self._subscription.stop()
+            self._subscription = None
+        if self._activity_thread.is_alive():
+            self._stopped.set()
+            self._active_event.set()
+            self._activity_thread.join()
+        self._client.close()
+        self._reader.close()
+
+    def _handle_event(self, event: Dict[str, Any]):
+        if 'epoch' in event:
+            self._refresh_bays(event['epoch'])
+        if event['event'] != 'states':
+            return
+        snapshot = StateSnapshot(
+            version=event['version'],
+            timestamp=event['timestamp'],
+            states=dict(zip(self.bays, event['states'])),
+            degraded=frozenset(event['degraded']),
+        )
+        changes = [
+            StateChange(bay_id=bay_id, open=is_open, timestamp=timestamp)
+            for bay_id, is_open, timestamp in event['changes']
+        ]
+        for listener in self._listeners:
+            listener(snapshot, changes)
+
+    def open_bay(self, bay_id: str) -> None:
+        self._client.call('open_bay', bay_id)
+
+    def open_all_bays(self) -> None:
+        self._client.call('open_all_bays')
+
+    def get_state(self, bay_id: str) -> Optional[bool]:
+        return self._client.call('get_state', bay_id)
+
+    def notify_activity(self):
+        self._client.call('notify_activity')
+
+    @contextmanager
+    def active(self) -> Iterator[None]:
+        """
+        Keeps the hardware process scanning at the active interval while in the context. Does not block, the activity
+        is renewed by a background thread every half active window, such that holds of crashed workers expire.
+        """
+        with self._active_lock:
+            self._active_holds += 1
+        self._active_event.set()
+        try:
+            yield
+        finally:
+            with self._active_lock:
+                self._active_holds -= 1
+
+    def _run_activity(self):
+        while not self._stopped.is_set():
+            self._active_event.wait()
+            self._active_event.clear()
+            while self._active_holds > 0 and not self._stopped.is_set():
+                try:
+                    self.notify_activity()
+                except OSError:
+                    logger.debug("Cannot notify the hardware process about activity", exc_info=True)
+                self._stopped.wait(self.active_window / 2)
+
+    def reload(self, config: StationConfig) -> List[str]:
+        return self._client.call('reload', config.dict())
+
+    def scan(self) -> StateSnapshot:
+        result = self._client.call('scan')
+        self._refresh_bays(result['epoch'])
+        return StateSnapshot(
+            version=result['version'],
+            timestamp=result['timestamp'],
+            states=dict(zip(self.bays, result['states'])),
+            degraded=frozenset(result['degraded']),
+        )
+
+    def add_listener(self, listener: Callable[[StateSnapshot, List[StateChange]], None]):
+        """Adds a listener which is called on the event thread with the changes of every scan."""
+
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[StateSnapshot, List[StateChange]], None]):
+        self._listeners.remove(listener)
+
+    def get_snapshot(self) -> Optional[StateSnapshot]:
+        """Gets the snapshot of the hardware process. Returns None if its scanner is disabled or it is stale."""
+
+        result = self._reader.read()
+        if result is None:
+            # Map the segment again next time, it might not have been created yet.
+            self._reader.close()
+            return None
+        epoch, scanning, snapshot = result
+        if epoch != self.epoch:
+            # Reloaded bays, which are fetched by the event thread (or a scan) instead of blocking the event loop. The
+            # segment of the new bays is mapped once they were fetched.
+            self._reader.close()
+            return None
+        if not scanning:
+            return None
+        if time.time() - snapshot.timestamp > self.max_staleness:
+            # The hardware process might have been restarted with a new segment.
+            self._reader.close()
+            return None
+        return snapshot
+
+
+class RemoteCardReader:
+    """ Card reader which is owned by the hardware process. Has the interface of `CardReader`. """
+
+    def __init__(self, config: CardAuthConfig, hardware_config: HardwareConfig):
+        assert hardware_config.socket_path is not None, "No socket path configured"
+        self.config = config
+        self._client = HardwareClient(hardware_config.socket_path)
+        self._listeners: List[Callable[[str], None]] = []
+        self._subscription: Optional[Subscription] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """ Adds a listener which is called on the event loop with every newly read card id. """
+        self._listeners.append(listener)
+
+    def start(self):
+        """ Start receiving the read cards. Must be called from the event loop which waits for the cards. """
+        self._loop = asyncio.get_event_loop()
+        if self._listeners:
+            self._subscription = self._client.subscribe(self._handle_event)
+
+    def stop(self):
+        if self._subscription is not None:
+            self._subscription.stop()
+            self._subscription = None
+        self._client.close()
+
+    def _handle_event(self, event: Dict[str, Any]):
+        if event['event'] != 'card':
+            return
+        assert self._loop is not None, "Not started"
+        self._loop.call_soon_threadsafe(self._card_read, event['card_id'])
+
+    def _card_read(self, card_id: str):
+        for listener in self._listeners:
+            listener(card_id)
+
+    def read_card_id(self) -> Optional[str]:
+        return self._client.call('read_card_id')
+
+    async def wait_card_id(self, timeout: float) -> Optional[str]:
+        # Does not occupy a thread of the executor, which is shared with the station, while waiting.
+        return await self._client.call_async('wait_card_id', timeout)
+
+
+class RemoteCardAuthorizer:
+    """
+    Card authorizer of the hardware process. Has the interface of `CardAuthorizer`. The hardware process prefetches the
+    authorization of a read card once for all workers and shares its cache.
+    """
+
+    def __init__(self, hardware_config: HardwareConfig):
+        assert hardware_config.socket_path is not None, "No socket path configured"
+        self._client = HardwareClient(hardware_config.socket_path)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        self._client.close()
+
+    async def authorize(self, card_id: str) -> DepotResponse:
+        return decode_depot_response(await self._client.call_async('authorize_card', card_id))
+
+    async def register(self, card: CardModel) -> DepotResponse:
+        return decode_depot_response(await self._client.call_async('register_card', card.dict()))
@@ -0,0 +1,78 @@
+import base64
+import json
+from pydantic import BaseModel
+from typing import Any, BinaryIO, Dict, Optional
+
+from device_server.bay.controller import ControllerDegraded
+from device_server.bay.executor import BusOverloaded
+from device_server.card.authorizer import DepotResponse
+
+
+class HardwareConfig(BaseModel):
+    # Unix socket of the hardware process (`python -m device_server.hardware`). If set, the HTTP workers access the
+    # station and the card reader through the hardware process instead of opening the hardware themselves, such that
+    # multiple workers can run.
+    socket_path: Optional[str] = None
+    # Shared memory file into which the hardware process publishes the state snapshots for the HTTP workers.
+    snapshot_path: str = '/dev/shm/device_server_snapshot'
+
+
+class HardwareError(Exception):
+    """ Error raised by the hardware process, which has no local equivalent. """
+
+
+# Errors which are raised again with the same type by the client.
+_ERROR_TYPES = {
+    'OSError': OSError,
+    'KeyError': KeyError,
+    'ValueError': ValueError,
+    'AssertionError': AssertionError,
+    'BusOverloaded': BusOverloaded,
+    'ControllerDegraded': ControllerDegraded,
+}
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    """ Encodes a message as single line of JSON. """
+    return json.dumps(message).encode() + b'\n'
+
+
+def decode_message(line: bytes) -> Optional[Dict[str, Any]]:
+    """ Decodes a line read from the connection. Returns None if the connection was closed. """
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def send_message(wfile: BinaryIO, message: Dict[str, Any]):
+    """ Sends a message as single line of JSON. """
+    wfile.write(encode_message(message))
+    wfile.flush()
+
+
+def read_message(rfile: BinaryIO) -> Optional[Dict[str, Any]]:
+    """ Reads a message. Returns None if the connection was closed. """
+    return decode_message(rfile.readline())
+
+
+def encode_error(error: Exception) -> Dict[str, Any]:
+    return {'error': type(error).__name__, 'message': str(error)}
+
+
+def decode_error(message: Dict[str, Any]) -> Exception:
+    error_type = _ERROR_TYPES.get(message['error'])
+    if error_type is None:
+        return HardwareError(f"{message['error']}: {message['message']}")
+    return error_type(message['message'])
+
+
+def encode_depot_response(response: DepotResponse) -> Dict[str, Any]:
+    return {
+        'status_code': response.status_code,
+        'content': base64.b64encode(response.content).decode(),
+        'headers': response.headers,
+    }
+
+
+def decode_depot_response(message: Dict[str, Any]) -> DepotResponse:
+    return DepotResponse(message['status_code'], base64.b64decode(message['content']), message['headers'])
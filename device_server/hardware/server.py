@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import queue
+import signal
+import socketserver
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional
+
+from device_server.bay.journal import Journal
+from device_server.bay.scanner import StateChange, StateSnapshot
+from device_server.bay.station import Station, StationConfig
+from device_server.card.authorizer import CardAuthorizer
+from device_server.card.reader import CardReader
+from device_server.config.watcher import ConfigWatcher
+from device_server.model.auth import CardModel
+from .protocol import HardwareConfig, encode_depot_response, encode_error, read_message, send_message
+from .shared import SharedSnapshotWriter
+
+logger = logging.getLogger(__name__)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    hardware: 'HardwareServer'
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: _UnixServer
+
+    def handle(self):
+        while True:
+            try:
+                request = read_message(self.rfile)
+            except (OSError, ValueError):
+                return
+            if request is None:
+                return
+            if request['method'] == 'subscribe':
+                self.server.hardware.stream_events(self.wfile)
+                return
+            try:
+                response = {'result': self.server.hardware.call(request['method'], request.get('args', []))}
+            except Exception as e:
+                response = encode_error(e)
+            try:
+                send_message(self.wfile, response)
+            except OSError:
+                return
+
+
+class HardwareServer:
+    """
+    Owns the station and the card reader and serves them to the HTTP workers over a Unix socket. The state snapshots
+    are published into shared memory, the state changes and read cards are streamed to subscribed workers. The read
+    cards are authorized once for all workers.
+    """
+
+    # Interval in seconds in which idle event streams are checked for disconnected workers.
+    event_keepalive = 15.0
+
+    def __init__(
+            self,
+            station: Station,
+            card_reader: CardReader,
+            authorizer: CardAuthorizer,
+            config: HardwareConfig,
+            loop: asyncio.AbstractEventLoop,
+    ):
+        assert config.socket_path is not None, "No socket path configured"
+        self.station = station
+        self.card_reader = card_reader
+        self.authorizer = authorizer
+        self.config = config
+        self._loop = loop
+        self._subscribers_lock = Lock()
+        self._subscribers: List['queue.Queue[Optional[Dict[str, Any]]]'] = []
+        self._snapshot_writer: Optional[SharedSnapshotWriter] = None
+        self._server: Optional[_UnixServer] = None
+        self._server_thread: Optional[Thread] = None
+        self._methods: Dict[str, Callable[..., Any]] = {
+            'info': self._info,
+            'scan': self._scan,
+            'get_state': station.get_state,
+            'open_bay': station.open_bay,
+            'open_all_bays': station.open_all_bays,
+            'notify_activity': station.notify_activity,
+            'reload': self._reload,
+            'read_card_id': self._read_card_id,
+            'wait_card_id': self._wait_card_id,
+            'authorize_card': self._authorize_card,
+            'register_card': self._register_card,
+        }
+
+    def start(self):
+        """ Publishes the snapshots and starts serving. Must be called from the event loop of the card reader. """
+        self._snapshot_writer = SharedSnapshotWriter(
+            self.config.snapshot_path, len(self.station.bays), self.station.epoch, self.station.scanning
+        )
+        self.station.add_snapshot_listener(self._publish_snapshot)
+        self.station.add_listener(self._publish_changes)
+        self.card_reader.add_listener(self._publish_card)
+        self.card_reader.add_listener(self.authorizer.prefetch)
+        self.card_reader.add_listener(lambda card_id: self.station.notify_activity())
+        if os.path.exists(self.config.socket_path):
+            os.unlink(self.config.socket_path)
+        self._server = _UnixServer(self.config.socket_path, _RequestHandler)
+        self._server.hardware = self
+        self._server_thread = Thread(target=self._server.serve_forever, name="hardware_server_thread", daemon=True)
+        self._server_thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join()
+        os.unlink(self.config.socket_path)
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+        self.station.remove_listener(self._publish_changes)
+        self.station.remove_snapshot_listener(self._publish_snapshot)
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.close()
+            self._snapshot_writer = None
+
+    def call(self, method: str, args: List[Any]) -> Any:
+        """ Calls a method on a connection thread. """
+        return self._methods[method](*args)
+
+    def _publish_snapshot(self, snapshot: StateSnapshot):
+        assert self._snapshot_writer is not None, "Not started"
+        if self._snapshot_writer.epoch != self.station.epoch:
+            # The bays were reloaded. The workers map the new segment once they see the new epoch.
+            self._snapshot_writer.close()
+            self._snapshot_writer = SharedSnapshotWriter(
+                self.config.snapshot_path, len(snapshot.states), self.station.epoch, self.station.scanning
+            )
+            self._broadcast({'event': 'bays', 'epoch': self.station.epoch})
+        self._snapshot_writer.publish(snapshot)
+
+    def _reload(self, config: Dict[str, Any]) -> List[str]:
+        return self.station.reload(StationConfig.parse_obj(config))
+
+    def _info(self) -> Dict[str, Any]:
+        return {
+            'epoch': self.station.epoch,
+            'bay_ids': list(self.station.bays),
+            'scanning': self.station.scanning,
+        }
+
+    def _scan(self) -> Dict[str, Any]:
+        # Scans again if the bays were reloaded meanwhile, such that the states belong to the bays of the epoch.
+        while True:
+            epoch = self.station.epoch
+            snapshot = self.station.scan()
+            if self.station.epoch == epoch:
+                break
+        return {
+            'epoch': epoch,
+            'version': snapshot.version,
+            'timestamp': snapshot.timestamp,
+            'states': list(snapshot.states.values()),
+            'degraded': list(snapshot.degraded),
+        }
+
+    def _read_card_id(self) -> Optional[str]:
+        async def read_card_id() -> Optional[str]:
+            return self.card_reader.read_card_id()
+
+        return asyncio.run_coroutine_threadsafe(read_card_id(), self._loop).result()
+
+    def _wait_card_id(self, timeout: float) -> Optional[str]:
+        return asyncio.run_coroutine_threadsafe(self.card_reader.wait_card_id(timeout), self._loop).result()
+
+    def _authorize_card(self, card_id: str) -> Dict[str, Any]:
+        return encode_depot_response(
+            asyncio.run_coroutine_threadsafe(self.authorizer.authorize(card_id), self._loop).result()
+        )
+
+    def _register_card(self, card: Dict[str, Any]) -> Dict[str, Any]:
+        return encode_depot_response(
+            asyncio.run_coroutine_threadsafe(self.authorizer.register(CardModel.parse_obj(card)), self._loop).result()
+        )
+
+    def _broadcast(self, event: Dict[str, Any]):
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.put(event)
+
+    def _publish_changes(self, snapshot: StateSnapshot, changes: List[StateChange]):
+        self._broadcast({
+            'event': 'states',
+            'epoch': self.station.epoch,
+            'version': snapshot.version,
+            'timestamp': snapshot.timestamp,
+            'states': list(snapshot.states.values()),
+            'degraded': list(snapshot.degraded),
+            'changes': [[change.bay_id, change.open, change.timestamp] for change in changes],
+        })
+
+    def _publish_card(self, card_id: str):
+        self._broadcast({'event': 'card', 'card_id': card_id})
+
+    def stream_events(self, wfile):
+        """ Streams the events to a subscribed worker until it disconnects. Runs on the connection thread. """
+        events: 'queue.Queue[Optional[Dict[str, Any]]]' = queue.Queue()
+        with self._subscribers_lock:
+            self._subscribers.append(events)
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=self.event_keepalive)
+                except queue.Empty:
+                    event = {'event': 'keepalive'}
+                if event is None:
+                    return
+                send_message(wfile, event)
+        except OSError:
+            return
+        finally:
+            with self._subscribers_lock:
+                self._subscribers.remove(events)
+
+
+async def _run(config) -> None:
+    loop = asyncio.get_event_loop()
+    station = Station(config.station)
+    journal = None
+    if config.journal.path is not None:
+        journal = Journal(config.journal)
+        station.add_listener(journal.record_changes)
+        station.add_actuation_listener(journal.record_actuation)
+        journal.start()
+    await loop.run_in_executor(None, station.configure)
+    card_reader = CardReader(config.card_auth)
+    authorizer = CardAuthorizer(config.card_auth)
+    server = HardwareServer(station, card_reader, authorizer, config.hardware, loop)
+    server.start()
+    card_reader.start()
+    authorizer.start()
+    station.start()
+    config_watcher = None
+    if config.reload_interval is not None:
+        config_watcher = ConfigWatcher(
+            type(config), lambda new_config: station.reload(new_config.station), config.reload_interval
+        )
+        config_watcher.start()
+
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    logger.info("Serving the hardware on %s", config.hardware.socket_path)
+    try:
+        await stopped.wait()
+    finally:
+        if config_watcher is not None:
+            config_watcher.stop()
+        station.stop()
+        server.stop()
+        card_reader.stop()
+        await authorizer.stop()
+        if journal is not None:
+            journal.stop()
+
+
+def main():
+    from device_server.config import config
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_run(config))
+    finally:
+        loop.close()
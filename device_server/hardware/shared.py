@@ -0,0 +1,135 @@
+import mmap
+import os
+import struct
+from typing import Dict, FrozenSet, Optional, Sequence, Tuple
+
+from device_server.bay.scanner import StateSnapshot
+
+# sequence, version, timestamp, flags, number of bays, station epoch. Followed by one state byte per bay.
+HEADER = struct.Struct('<QQdII8s')
+FLAG_SCANNER = 0x1
+# Bits of the state bytes.
+STATE_OPEN = 0x1
+STATE_DEGRADED = 0x2
+# The bay was never read successfully.
+STATE_UNKNOWN = 0x4
+
+
+class SharedSnapshotWriter:
+    """
+    Publishes the state snapshots of the station into a shared memory file, such that all HTTP workers can read them
+    without IPC.
+
+    The segment is guarded by a sequence lock: the sequence is odd while the writer updates the segment, and readers
+    retry if the sequence was odd or changed while reading. There is only one writer.
+    """
+
+    def __init__(self, path: str, bay_count: int, epoch: str, scanner: bool):
+        self.path = path
+        self.epoch = epoch
+        self._bay_count = bay_count
+        self._epoch = epoch.encode()[:8]
+        self._flags = FLAG_SCANNER if scanner else 0
+        self._sequence = 0
+        size = HEADER.size + bay_count
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._write(0, 0.0, b'\0' * bay_count)
+
+    def _write(self, version: int, timestamp: float, states: bytes):
+        self._sequence += 1
+        struct.pack_into('<Q', self._mmap, 0, self._sequence)
+        HEADER.pack_into(
+            self._mmap, 0, self._sequence, version, timestamp, self._flags, self._bay_count, self._epoch
+        )
+        self._mmap[HEADER.size:HEADER.size + self._bay_count] = states
+        self._sequence += 1
+        struct.pack_into('<Q', self._mmap, 0, self._sequence)
+
+    def publish(self, snapshot: StateSnapshot):
+        """ Writes the snapshot. The states must be in the order of the bays of the station. """
+        self._write(snapshot.version, snapshot.timestamp, bytes(
+            (STATE_OPEN if is_open else STATE_UNKNOWN if is_open is None else 0)
+            | (STATE_DEGRADED if bay_id in snapshot.degraded else 0)
+            for bay_id, is_open in snapshot.states.items()
+        ))
+
+    def close(self):
+        self._mmap.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SharedSnapshotReader:
+    """ Reads the state snapshots published by a `SharedSnapshotWriter`. """
+
+    # Number of attempts to read a consistent snapshot before giving up.
+    max_attempts = 100
+
+    def __init__(self, path: str, bay_ids: Sequence[str]):
+        self.path = path
+        self.bay_ids = tuple(bay_ids)
+        self._mmap: Optional[mmap.mmap] = None
+        # The decoded states and degraded bays of the last read version, which only changes if a state changed.
+        self._states: Tuple[int, str, Dict[str, Optional[bool]], FrozenSet[str]] = (-1, '', {}, frozenset())
+
+    def _open(self) -> Optional[mmap.mmap]:
+        if self._mmap is None:
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            try:
+                if os.fstat(fd).st_size != HEADER.size + len(self.bay_ids):
+                    return None
+                self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        return self._mmap
+
+    def read(self) -> Optional[Tuple[str, bool, StateSnapshot]]:
+        """
+        Reads the current snapshot. Returns the station epoch, whether the writer runs a scanner and the snapshot, or
+        None if nothing was published yet.
+        """
+        segment = self._open()
+        if segment is None:
+            return None
+        for _ in range(self.max_attempts):
+            sequence, version, timestamp, flags, bay_count, epoch = HEADER.unpack_from(segment, 0)
+            if sequence & 1:
+                continue
+            states = segment[HEADER.size:HEADER.size + bay_count]
+            if struct.unpack_from('<Q', segment, 0)[0] != sequence:
+                continue
+            break
+        else:
+            return None
+        if version == 0:
+            return None
+        epoch = epoch.rstrip(b'\0').decode()
+        cached_version, cached_epoch, cached_states, cached_degraded = self._states
+        if cached_version != version or cached_epoch != epoch:
+            cached_states = dict(zip(self.bay_ids, (
+                None if state & STATE_UNKNOWN else state & STATE_OPEN != 0 for state in states
+            )))
+            cached_degraded = frozenset(
+                bay_id for bay_id, state in zip(self.bay_ids, states) if state & STATE_DEGRADED
+            )
+            self._states = (version, epoch, cached_states, cached_degraded)
+        snapshot = StateSnapshot(
+            version=version, timestamp=timestamp, states=cached_states, degraded=cached_degraded
+        )
+        return epoch, bool(flags & FLAG_SCANNER), snapshot
+
+    def close(self):
+        """ Unmaps the segment. The next read maps the file again, e.g. after the writer was restarted. """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
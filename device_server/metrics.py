@@ -0,0 +1,66 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# If PROMETHEUS_MULTIPROC_DIR is set before prometheus_client is imported (e.g. by gunicorn_conf.py), all processes
+# write their metrics into that directory and /metrics reports those of all workers and of the hardware process.
+
+# Buckets for operations which take between a few microseconds and a few seconds.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf')
+)
+
+I2C_TRANSACTION_SECONDS = Histogram(
+    'device_i2c_transaction_seconds',
+    "Duration of the SMBus transactions per controller.",
+    ['controller_id', 'operation'],
+    buckets=LATENCY_BUCKETS,
+)
+I2C_RETRIES = Counter(
+    'device_i2c_retries',
+    "Number of retried SMBus transactions per controller.",
+    ['controller_id'],
+)
+CONTROLLER_DEGRADED = Gauge(
+    'device_controller_degraded',
+    "Whether the controller is degraded after repeated failures (1) or not (0).",
+    ['controller_id'],
+    multiprocess_mode='livemax',
+)
+BUS_EXECUTOR_QUEUE_DEPTH = Gauge(
+    'device_bus_executor_queue_depth',
+    "Number of hardware operations waiting for the thread of the bus.",
+    ['i2c_port'],
+    multiprocess_mode='livesum',
+)
+BUS_EXECUTOR_WAIT_SECONDS = Histogram(
+    'device_bus_executor_wait_seconds',
+    "Time hardware operations waited for the thread of the bus.",
+    ['i2c_port'],
+    buckets=LATENCY_BUCKETS,
+)
+BUS_EXECUTOR_COALESCED = Counter(
+    'device_bus_executor_coalesced',
+    "Number of hardware operations which shared the result of an identical queued operation.",
+    ['i2c_port'],
+)
+BUS_EXECUTOR_REJECTED = Counter(
+    'device_bus_executor_rejected',
+    "Number of hardware operations which were rejected because the queue of the bus was full.",
+    ['i2c_port'],
+)
+CARD_READER_ITERATION_SECONDS = Histogram(
+    'device_card_reader_iteration_seconds',
+    "Duration of one iteration of the card reader loop, without the poll interval.",
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    'device_upstream_request_seconds',
+    "Duration of the requests to the depot server.",
+    ['endpoint', 'status_code'],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    'device_http_request_seconds',
+    "Duration of the HTTP requests per route.",
+    ['method', 'route', 'status_code'],
+    buckets=LATENCY_BUCKETS,
+)
@@ -1 +1,2 @@
-from .bay import BayState
+from .bay import BayState, BayStateEvent, BayQuery, BayWaitState
+from .station import StationReloadResult
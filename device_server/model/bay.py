@@ -1,6 +1,27 @@
+from enum import Enum
+from typing import List, Optional
+
 from .base import BaseModel
 
 
 class BayState(BaseModel):
+    id: str
+    # The last known state if degraded, None if the bay was never read successfully.
+    open: Optional[bool]
+    # Whether the state could not be read, e.g. because the controller of the bay failed repeatedly.
+    degraded: bool = False
+
+
+class BayStateEvent(BaseModel):
     id: str
     open: bool
+    timestamp: float
+
+
+class BayQuery(BaseModel):
+    ids: List[str]
+
+
+class BayWaitState(str, Enum):
+    open = 'open'
+    closed = 'closed'
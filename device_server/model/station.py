@@ -0,0 +1,10 @@
+from typing import List
+
+from .base import BaseModel
+
+
+class StationReloadResult(BaseModel):
+    # Ids of the controllers which were added or changed and thus configured again.
+    reconfigured: List[str]
+    # Number of bays after the reload.
+    bays: int
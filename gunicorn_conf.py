@@ -1,6 +1,9 @@
 import json
 import multiprocessing
 import os
+import subprocess
+import sys
+import threading
 
 workers_per_core_str = os.getenv("WORKERS_PER_CORE", "1")
 max_workers_str = os.getenv("MAX_WORKERS")
@@ -8,6 +11,11 @@ use_max_workers = None
 if max_workers_str:
     use_max_workers = int(max_workers_str)
 web_concurrency_str = os.getenv("WEB_CONCURRENCY", None)
+# If set, the station and the card reader are owned by a separate hardware process, which is started by the master.
+# Otherwise, every worker would access the hardware itself, thus only one worker is started by default.
+hardware_socket_path = os.getenv("API_CONFIG_HARDWARE_SOCKET_PATH", None)
+# Seconds after which the hardware process is started again if it exited.
+hardware_restart_delay_str = os.getenv("HARDWARE_RESTART_DELAY", "1")
 
 host = os.getenv("HOST", "0.0.0.0")
 port = os.getenv("PORT", "80")
@@ -24,10 +32,12 @@ default_web_concurrency = workers_per_core * cores
 if web_concurrency_str:
     web_concurrency = int(web_concurrency_str)
     assert web_concurrency > 0
-else:
+elif hardware_socket_path:
     web_concurrency = max(int(default_web_concurrency), 2)
     if use_max_workers:
         web_concurrency = min(web_concurrency, use_max_workers)
+else:
+    web_concurrency = 1
 accesslog_var = os.getenv("ACCESS_LOG", "-")
 use_accesslog = accesslog_var or None
 errorlog_var = os.getenv("ERROR_LOG", "-")
@@ -47,6 +57,65 @@ graceful_timeout = int(graceful_timeout_str)
 timeout = int(timeout_str)
 keepalive = int(keepalive_str)
 
+hardware_restart_delay = float(hardware_restart_delay_str)
+
+# With multiple processes, the workers and the hardware process write their metrics into this directory, such that
+# /metrics of any worker reports the metrics of all of them. Must be set before prometheus_client is imported.
+metrics_dir = None
+if hardware_socket_path or workers > 1:
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/dev/shm/device_server_metrics")
+
+hardware_process = None
+hardware_lock = threading.Lock()
+hardware_stopped = threading.Event()
+
+
+def _run_hardware_process(server):
+    """Runs the hardware process and starts it again whenever it exits, until gunicorn exits."""
+    global hardware_process
+    while True:
+        with hardware_lock:
+            if hardware_stopped.is_set():
+                return
+            hardware_process = subprocess.Popen([sys.executable, "-m", "device_server.hardware"])
+        returncode = hardware_process.wait()
+        if metrics_dir is not None:
+            from prometheus_client import multiprocess
+
+            multiprocess.mark_process_dead(hardware_process.pid)
+        if hardware_stopped.is_set():
+            return
+        server.log.error(
+            "Hardware process exited with code %s, restarting in %s seconds", returncode, hardware_restart_delay
+        )
+        hardware_stopped.wait(hardware_restart_delay)
+
+
+def on_starting(server):
+    if metrics_dir is not None:
+        # Drop the metrics of the previous run.
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.unlink(os.path.join(metrics_dir, name))
+    if hardware_socket_path:
+        threading.Thread(target=_run_hardware_process, args=(server,), name="hardware_process", daemon=True).start()
+
+
+def child_exit(server, worker):
+    if metrics_dir is not None:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    with hardware_lock:
+        hardware_stopped.set()
+        process = hardware_process
+    if process is not None:
+        process.terminate()
+        process.wait()
+
 
 # For debugging and testing
 log_data = {
@@ -63,5 +132,8 @@ log_data = {
     "use_max_workers": use_max_workers,
     "host": host,
     "port": port,
+    "hardware_socket_path": hardware_socket_path,
+    "hardware_restart_delay": hardware_restart_delay,
+    "metrics_dir": metrics_dir,
 }
 print(json.dumps(log_data))
\ No newline at end of file
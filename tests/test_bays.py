@@ -1,10 +1,26 @@
+import asyncio
+import os
+import pytest
+import subprocess
+import sys
+import time
 from fastapi.testclient import TestClient
-from typing import Dict, Tuple, List
+from threading import Event, Thread, Timer, current_thread
+from typing import Callable, Dict, Tuple, List
 
+import device_server.api.bay
 import device_server.bay.controller
+import device_server.bay.station
 import smbus
 from device_server.api import app
-from device_server.model import BayState
+from device_server.bay.controller import ActuatorController, ControllerConfig, pulse_controllers
+from device_server.bay.executor import BusExecutor, BusOverloaded, Priority
+from device_server.bay.interrupt import PipeInterrupt
+from device_server.bay.scanner import StateScanner
+from device_server.bay.station import Station
+from device_server.bay.table import BayTable
+from device_server.config import config
+from device_server.model import BayState, BayStateEvent, StationReloadResult
 
 
 class WriteListener:
@@ -20,12 +36,38 @@ class WriteListener:
         return data
 
 
+class FailingWriteListener(WriteListener):
+    def __call__(self, port: int, address: int, register: int, data: int) -> int:
+        raise OSError("NACK")
+
+
 def _count_bits(i: int):
     i = i - ((i >> 1) & 0x55555555)
     i = (i & 0x33333333) + ((i >> 2) & 0x33333333)
     return (((i + (i >> 4) & 0xF0F0F0F) * 0x1010101) & 0xffffffff) >> 24
 
 
+def _wait_until(predicate: Callable[[], bool], timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out waiting"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def reads(monkeypatch) -> List[Tuple[int, int, int]]:
+    """ The (port, address, register) of the reads of all buses. """
+    reads: List[Tuple[int, int, int]] = []
+    read_byte_data = smbus.SMBus.read_byte_data
+
+    def counting_read_byte_data(self, address: int, register: int) -> int:
+        reads.append((self.port, address, register))
+        return read_byte_data(self, address, register)
+
+    monkeypatch.setattr(smbus.SMBus, 'read_byte_data', counting_read_byte_data)
+    return reads
+
+
 def test_bay(monkeypatch):
     write_listener = WriteListener()
     monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
@@ -112,9 +154,8 @@ def test_bay(monkeypatch):
 
         resp = client.post(f'/api/v1/device/bays/1A/open')
         assert resp.status_code == 200, resp.text
+        # The outputs are known to be off already, so they are not reset before the pulse
         assert write_listener.writes == [
-            (0.0, 1, 0x22, 0x00, 0x00),
-            (0.0, 1, 0x22, 0x01, 0x00),
             (0.01, 1, 0x22, 0x01, 0x80),
             (0.02, 1, 0x22, 0x01, 0x00),
         ]
@@ -125,8 +166,6 @@ def test_bay(monkeypatch):
         resp = client.post(f'/api/v1/device/bays/7D/open')
         assert resp.status_code == 200, resp.text
         assert write_listener.writes == [
-            (0.0, 1, 0x23, 0x00, 0x00),
-            (0.0, 1, 0x23, 0x01, 0x00),
             (0.01, 1, 0x23, 0x00, 0x80),
             (0.02, 1, 0x23, 0x00, 0x00),
         ]
@@ -136,7 +175,7 @@ def test_bay(monkeypatch):
 
         resp = client.post(f'/api/v1/device/bays/open')
         assert resp.status_code == 200, resp.text
-        assert len(write_listener.writes) == 4 * len(bay_states)
+        assert len(write_listener.writes) == 2 * len(bay_states)
         # Check every position in the state
         last_state: Dict[Tuple[int, int, int], int] = {
             (1, 0x22, 0x00): 0x00,
@@ -158,3 +197,775 @@ def test_bay(monkeypatch):
             for i, st in state.items():
                 bitcount += _count_bits(st)
             assert bitcount in (0, 1)
+
+
+def test_get_states_reads_each_register_once(reads):
+    smbus.SMBus._state['1.32.0'] = 0xaa
+    smbus.SMBus._state['1.32.1'] = 0xaa
+    smbus.SMBus._state['1.33.0'] = 0xaa
+
+    station = Station(config.station)
+    states = station.get_states()
+    assert len(states) == len(config.station.bays)
+    assert sorted(reads) == [(1, 0x20, 0x00), (1, 0x20, 0x01), (1, 0x21, 0x00)]
+    assert states == {
+        bay_id: station.get_state(bay_id)
+        for bay_id in states
+    }
+
+
+def test_concurrent_scans_publish_in_order():
+    smbus.SMBus._state['1.32.0'] = 0xff
+    smbus.SMBus._state['1.32.1'] = 0xff
+    smbus.SMBus._state['1.33.0'] = 0xff
+
+    station = Station(config.station)
+    try:
+        first_snapshot = station.scan()
+        read_registers = station._read_registers
+        read = Event()
+        resume = Event()
+
+        def blocking_read_registers(*args):
+            register_values = read_registers(*args)
+            if current_thread().name == 'older_scan':
+                read.set()
+                resume.wait(5)
+            return register_values
+
+        station._read_registers = blocking_read_registers
+        older_scan = Thread(target=station.scan, name='older_scan')
+        older_scan.start()
+        assert read.wait(5)
+        # The bay is opened after the older scan read it, the newer scan is published first.
+        smbus.SMBus._state['1.33.0'] = 0xfe
+        snapshot = station.scan()
+        assert snapshot.version == first_snapshot.version + 1 and snapshot.states['7C']
+        resume.set()
+        older_scan.join()
+        # The older read is dropped instead of reverting the change.
+        assert station._snapshot == snapshot
+    finally:
+        station.stop()
+
+
+def test_bay_table():
+    station = Station(config.station)
+    try:
+        table: BayTable = station.bays
+        assert list(table) == [bay[0] for bay in config.station.bays]
+        assert '1A' in table and 'XX' not in table
+        register_values = [0x5a + register_slot for register_slot in range(len(table.register_slot_keys))]
+        states = table.decode_states(register_values)
+        for bay_index, bay in enumerate(config.station.bays):
+            state_controller = table.state_controller(bay_index)
+            assert state_controller.controller_id == bay[1]
+            register_slot = table.register_slots[table.state_controller_slots[bay_index], bay[2]]
+            assert states[bay_index] == (register_values[register_slot] & bay[3] == 0)
+            assert table.actuator_controller(bay_index).controller_id == bay[4]
+            assert (table.actuator_registers[bay_index], table.actuator_masks[bay_index]) == (bay[5], bay[6])
+    finally:
+        station.stop()
+
+
+def test_state_scanner(monkeypatch):
+    monkeypatch.setattr(config.station, 'scan_interval', 0.01)
+
+    with TestClient(app) as client:
+        station = device_server.api.bay.station
+
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+
+        _wait_until(lambda: station.get_snapshot() is not None and not any(station.get_snapshot().states.values()))
+        first_snapshot = station.get_snapshot()
+
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        _wait_until(lambda: station.get_snapshot().version != first_snapshot.version)
+        snapshot = station.get_snapshot()
+        assert snapshot.version == first_snapshot.version + 1
+        assert [bay_id for bay_id, is_open in snapshot.states.items() if is_open] == ['1A']
+
+        resp = client.get('/api/v1/device/bays/1A')
+        assert resp.status_code == 200, resp.text
+        assert BayState.validate(resp.json()) == BayState(id='1A', open=True)
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        assert len(resp.json()) == len(snapshot.states)
+
+
+def test_adaptive_scan_interval():
+    scans: List[float] = []
+    scanner = StateScanner(
+        lambda: scans.append(time.monotonic()), scan_interval=0.5, active_scan_interval=0.01, active_window=0.1
+    )
+    scanner.start()
+    try:
+        # Idle
+        time.sleep(0.1)
+        assert len(scans) == 1
+
+        # Fast after activity, waking up the idle wait
+        scanner.activity()
+        time.sleep(0.1)
+        assert len(scans) >= 4
+        assert scans[1] - scans[0] < 0.3
+
+        # Decays to the idle interval after the active window
+        time.sleep(0.5)
+        intervals = [b - a for a, b in zip(scans, scans[1:])]
+        assert intervals[-1] >= 0.04
+        assert intervals[-1] > intervals[-2]
+
+        # Fast while held
+        scanner.hold()
+        time.sleep(0.05)
+        count = len(scans)
+        time.sleep(0.2)
+        assert len(scans) - count >= 5
+        scanner.release()
+    finally:
+        scanner.stop()
+
+    # A scanner which was never started can be stopped
+    StateScanner(lambda: None, scan_interval=0.5).stop()
+
+
+def test_debounce():
+    station = Station(config.station.copy(update={'debounce_samples': 3}))
+    try:
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+        snapshot = station.scan(sample=True)
+        assert not any(snapshot.states.values())
+
+        # A single bouncing read does not change the state
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        assert station.scan(sample=True).version == snapshot.version
+        smbus.SMBus._state['1.32.1'] = 0xff
+        assert station.scan(sample=True).version == snapshot.version
+        assert station.scan(sample=True).version == snapshot.version
+
+        # The change is published once the majority of the samples showed it
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        assert station.scan(sample=True).version == snapshot.version
+        snapshot = station.scan(sample=True)
+        assert [bay_id for bay_id, is_open in snapshot.states.items() if is_open] == ['1A']
+        # Direct reads are not debounced
+        smbus.SMBus._state['1.32.1'] = 0xff
+        assert station.get_state('1A') is False
+        assert station.scan(sample=True).states['1A']
+
+        # Scans on request are published right away and taken as stable by the following samples
+        snapshot = station.scan()
+        assert not snapshot.states['1A']
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        assert not station.scan(sample=True).states['1A']
+        smbus.SMBus._state['1.32.1'] = 0xff
+        assert not station.scan(sample=True).states['1A']
+
+        # Interrupt scans publish the registers of the fired controllers right away, the others keep their filtered
+        # value
+        smbus.SMBus._state['1.32.8'] = 0xff
+        smbus.SMBus._state['1.32.9'] = 0x7f
+        smbus.SMBus._state['1.33.8'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        snapshot = station.scan_interrupt()
+        assert [bay_id for bay_id, is_open in snapshot.states.items() if is_open] == ['1A']
+        smbus.SMBus._state['1.32.1'] = 0xff
+        assert station.scan(sample=True).states['1A']
+    finally:
+        station.stop()
+
+
+def test_bays_etag_and_query():
+    with TestClient(app) as client:
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        etag = resp.headers['etag']
+        resp = client.get('/api/v1/device/bays', headers={'If-None-Match': etag})
+        assert resp.status_code == 304, resp.text
+        assert resp.headers['etag'] == etag
+        resp = client.get('/api/v1/device/bays', headers={'If-None-Match': f'"other", W/{etag}'})
+        assert resp.status_code == 304, resp.text
+
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        resp = client.get('/api/v1/device/bays', headers={'If-None-Match': etag})
+        assert resp.status_code == 200, resp.text
+        assert resp.headers['etag'] != etag
+        assert [r['id'] for r in resp.json() if r['open']] == ['1A']
+
+        resp = client.post('/api/v1/device/bays/query', json={'ids': ['2A', '1A']})
+        assert resp.status_code == 200, resp.text
+        assert [BayState.validate(r) for r in resp.json()] == [
+            BayState(id='2A', open=False),
+            BayState(id='1A', open=True),
+        ]
+        resp = client.post('/api/v1/device/bays/query', json={'ids': ['1A', 'XX']})
+        assert resp.status_code == 404, resp.text
+
+
+@pytest.mark.parametrize('scan_interval', [0.01, None])
+def test_bay_wait_until(monkeypatch, scan_interval):
+    monkeypatch.setattr(config.station, 'scan_interval', scan_interval)
+    monkeypatch.setattr(device_server.api.bay, 'WAIT_POLL_INTERVAL', 0.01)
+
+    with TestClient(app) as client:
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0x7f
+        smbus.SMBus._state['1.33.0'] = 0xff
+
+        # Already in the state
+        resp = client.get('/api/v1/device/bays/1A', params={'wait_until': 'open', 'timeout': 5})
+        assert resp.status_code == 200, resp.text
+        assert BayState.validate(resp.json()) == BayState(id='1A', open=True)
+
+        # Timeout
+        start = time.monotonic()
+        resp = client.get('/api/v1/device/bays/1A', params={'wait_until': 'closed', 'timeout': 0.1})
+        assert resp.status_code == 200, resp.text
+        assert BayState.validate(resp.json()) == BayState(id='1A', open=True)
+        assert time.monotonic() - start >= 0.1
+
+        # Closed while waiting
+        timer = Timer(0.1, lambda: smbus.SMBus._state.__setitem__('1.32.1', 0xff))
+        timer.start()
+        try:
+            resp = client.get('/api/v1/device/bays/1A', params={'wait_until': 'closed', 'timeout': 5})
+        finally:
+            timer.cancel()
+        assert resp.status_code == 200, resp.text
+        assert BayState.validate(resp.json()) == BayState(id='1A', open=False)
+
+        resp = client.get('/api/v1/device/bays/XX', params={'wait_until': 'closed'})
+        assert resp.status_code == 404, resp.text
+
+
+def test_bay_events(monkeypatch):
+    monkeypatch.setattr(config.station, 'scan_interval', 0.01)
+
+    with TestClient(app) as client:
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+
+        station = device_server.api.bay.station
+        _wait_until(lambda: station.get_snapshot() is not None and not any(station.get_snapshot().states.values()))
+
+        with client.websocket_connect('/api/v1/device/bays/events') as websocket:
+            smbus.SMBus._state['1.33.0'] = 0xfe
+            event = BayStateEvent.validate(websocket.receive_json())
+            assert (event.id, event.open) == ('7C', True)
+            smbus.SMBus._state['1.33.0'] = 0xff
+            event = BayStateEvent.validate(websocket.receive_json())
+            assert (event.id, event.open) == ('7C', False)
+
+
+def test_bay_events_sse_without_scanner():
+    with TestClient(app):
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+
+        station = device_server.api.bay.station
+        assert not station.scanning
+        station.scan()
+
+        # The streamed body is read from the endpoint directly, as the test client cannot read streaming responses
+        # with this Starlette version on newer Python versions.
+        async def read_event() -> str:
+            response = await device_server.api.bay.bay_events()
+            events = response.body_iterator
+            try:
+                next_event = asyncio.ensure_future(events.__anext__())
+                # Let the stream subscribe before the state changes.
+                await asyncio.sleep(0.05)
+                smbus.SMBus._state['1.33.0'] = 0xfe
+                return await asyncio.wait_for(next_event, 5)
+            finally:
+                await events.aclose()
+
+        loop = asyncio.new_event_loop()
+        try:
+            data = loop.run_until_complete(read_event())
+        finally:
+            loop.close()
+        assert data.startswith('data: ') and data.endswith('\n\n')
+        event = BayStateEvent.parse_raw(data[len('data: '):])
+        assert (event.id, event.open) == ('7C', True)
+        # The poller stopped with the last stream.
+        assert device_server.api.bay.event_poller is None
+
+
+def test_interrupt_scan(monkeypatch, reads):
+    interrupt = PipeInterrupt()
+    monkeypatch.setattr(device_server.bay.station, 'GpioInterrupt', lambda gpio: interrupt)
+    smbus.SMBus._state['1.32.0'] = 0xff
+    smbus.SMBus._state['1.32.1'] = 0xff
+    smbus.SMBus._state['1.33.0'] = 0xff
+
+    station = Station(
+        config.station.copy(update={'scan_interval': 60.0, 'interrupt_gpio': 17, 'max_staleness': 0.1})
+    )
+    station.start()
+    try:
+        _wait_until(lambda: station.get_snapshot() is not None)
+        first_snapshot = station.get_snapshot()
+        assert not any(first_snapshot.states.values())
+        assert sorted(reads) == [(1, 0x20, 0x00), (1, 0x20, 0x01), (1, 0x21, 0x00)]
+        reads.clear()
+
+        # While the interrupt does not fire, the snapshot stays fresh without reading the bus
+        time.sleep(0.3)
+        assert station.get_snapshot().version == first_snapshot.version
+        assert reads == []
+
+        # Only the second controller fired. The door was opened at the interrupt, and another one since.
+        smbus.SMBus._state['1.32.8'] = 0xff
+        smbus.SMBus._state['1.32.9'] = 0xff
+        smbus.SMBus._state['1.33.8'] = 0x7f
+        smbus.SMBus._state['1.33.0'] = 0x3f
+        interrupt.trigger()
+        _wait_until(lambda: station.get_snapshot().version != first_snapshot.version)
+        snapshot = station.get_snapshot()
+        assert [bay_id for bay_id, is_open in snapshot.states.items() if is_open] == ['6D', '7D']
+        assert sorted(reads) == [(1, 0x20, 0x08), (1, 0x20, 0x09), (1, 0x21, 0x00), (1, 0x21, 0x08)]
+        reads.clear()
+
+        # The stale captures of controllers which did not fire (e.g. after power-on) do not change the states.
+        smbus.SMBus._state['1.32.8'] = 0x00
+        smbus.SMBus._state['1.32.9'] = 0x00
+        smbus.SMBus._state['1.33.8'] = 0x3f
+        assert station.scan_interrupt() == snapshot._replace(timestamp=station.get_snapshot().timestamp)
+        assert sorted(reads) == [
+            (1, 0x20, 0x00), (1, 0x20, 0x01), (1, 0x20, 0x08), (1, 0x20, 0x09), (1, 0x21, 0x08)
+        ]
+    finally:
+        station.stop()
+
+
+def test_interrupt_idle_requests(monkeypatch, reads):
+    monkeypatch.setattr(device_server.bay.station, 'GpioInterrupt', lambda gpio: PipeInterrupt())
+    monkeypatch.setattr(config.station, 'scan_interval', 60.0)
+    monkeypatch.setattr(config.station, 'interrupt_gpio', 17)
+    monkeypatch.setattr(config.station, 'max_staleness', 0.1)
+    with TestClient(app) as client:
+        station = device_server.api.bay.station
+        _wait_until(lambda: station.get_snapshot() is not None)
+        # Idle in interrupt mode for longer than max_staleness, the requests are answered without reading the bus
+        time.sleep(0.3)
+        reads.clear()
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        resp = client.get('/api/v1/device/bays/1A')
+        assert resp.status_code == 200, resp.text
+        assert reads == []
+
+
+def test_bus_executor():
+    executor = BusExecutor([1, 2, 1])
+    try:
+        assert sorted(executor.i2c_ports) == [1, 2]
+        bus_1_blocked = Event()
+        blocked_future = executor.submit(1, bus_1_blocked.wait)
+        # The other bus is not blocked by the first one
+        assert executor.run(2, lambda: current_thread().name).startswith('i2c_2_thread_')
+        assert not blocked_future.done()
+        # The same bus is serialized
+        queued_future = executor.submit(1, lambda: blocked_future.done())
+        bus_1_blocked.set()
+        assert queued_future.result() is True
+        assert executor.run_all(lambda i2c_port: i2c_port * 10) == {1: 10, 2: 20}
+    finally:
+        executor.shutdown()
+
+
+def test_bus_executor_scheduling():
+    executor = BusExecutor([1], max_queued=4)
+    bus_blocked = Event()
+    try:
+        calls = []
+        blocked_future = executor.submit(1, bus_blocked.wait)
+        time.sleep(0.01)
+        read_future = executor.submit(1, calls.append, 'read', key='read')
+        # Identical queued reads are coalesced
+        assert executor.submit(1, calls.append, 'read', key='read') is read_future
+        background_future = executor.submit(1, calls.append, 'background', priority=Priority.background)
+        actuation_future = executor.submit(1, calls.append, 'actuation', priority=Priority.actuation)
+        # A queued operation can be moved ahead of the reads
+        executor.prioritize(1, background_future, Priority.actuation)
+        other_read_future = executor.submit(1, calls.append, 'other read')
+        # The queue is bounded
+        with pytest.raises(BusOverloaded):
+            executor.submit(1, calls.append, 'rejected')
+        # Actuations are accepted nevertheless
+        late_actuation_future = executor.submit(1, calls.append, 'late actuation', priority=Priority.actuation)
+        bus_blocked.set()
+        for future in (
+                blocked_future, read_future, background_future, actuation_future, other_read_future,
+                late_actuation_future,
+        ):
+            future.result()
+        # Actuations jump ahead of the reads, in submission order
+        assert calls == ['background', 'actuation', 'late actuation', 'read', 'other read']
+        # The read ran, thus it is not coalesced anymore
+        assert executor.submit(1, calls.append, 'read', key='read') is not read_future
+    finally:
+        bus_blocked.set()
+        executor.shutdown()
+
+
+def test_bus_overloaded(monkeypatch):
+    monkeypatch.setattr(config.station, 'max_queued_operations', 1)
+
+    with TestClient(app) as client:
+        device_server.api.bay.station.wait_configured()
+        executor = device_server.api.bay.station.executor
+        bus_blocked = Event()
+        try:
+            executor.submit(1, bus_blocked.wait)
+            time.sleep(0.01)
+            queued = executor.submit(1, lambda: None)
+            resp = client.get('/api/v1/device/bays')
+            assert resp.status_code == 503, resp.text
+            # Opening a bay is queued nevertheless
+            open_responses = []
+            open_thread = Thread(
+                target=lambda: open_responses.append(client.post('/api/v1/device/bays/1A/open')), daemon=True
+            )
+            open_thread.start()
+            time.sleep(0.05)
+            assert open_thread.is_alive()
+        finally:
+            bus_blocked.set()
+        open_thread.join(5)
+        assert open_responses[0].status_code == 200, open_responses[0].text
+        queued.result()
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+
+
+def test_controller_degraded(monkeypatch):
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', lambda delay: None)
+    for state_controller_config in config.station.state_controllers:
+        monkeypatch.setattr(state_controller_config, 'recovery_interval', 0.05)
+    failing_addresses = set()
+    reads: List[Tuple[int, int]] = []
+    read_byte_data = smbus.SMBus.read_byte_data
+
+    def failing_read_byte_data(self, address: int, register: int) -> int:
+        reads.append((address, register))
+        if address in failing_addresses:
+            raise OSError("NACK")
+        return read_byte_data(self, address, register)
+
+    monkeypatch.setattr(smbus.SMBus, 'read_byte_data', failing_read_byte_data)
+
+    with TestClient(app) as client:
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0x7f
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        assert [r['id'] for r in resp.json() if r['open']] == ['7D']
+        assert not any(r['degraded'] for r in resp.json())
+
+        # The failing controller is retried and its bays report the last known state
+        failing_addresses.add(33)
+        smbus.SMBus._state['1.33.0'] = 0xff
+        reads.clear()
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        assert reads.count((33, 0)) == 3
+        assert [r['id'] for r in resp.json() if r['open']] == ['7D']
+        assert [r['id'] for r in resp.json() if r['degraded']] == ['7C', '1D', '2D', '3D', '4D', '5D', '6D', '7D']
+        resp = client.get('/api/v1/device/bays/7D')
+        assert resp.status_code == 200, resp.text
+        assert BayState.validate(resp.json()) == BayState(id='7D', open=True, degraded=True)
+
+        # After repeated failures, the controller is not accessed anymore
+        station = device_server.api.bay.station
+        station.scan()
+        assert station.state_controllers['state2'].degraded
+        reads.clear()
+        station.scan()
+        assert (33, 0) not in reads
+        assert reads
+
+        # It recovers after a successful probe
+        failing_addresses.clear()
+        time.sleep(0.05)
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        assert not any(r['open'] or r['degraded'] for r in resp.json())
+        assert not station.state_controllers['state2'].degraded
+
+    # Bays which were never read successfully are unknown instead of closed
+    failing_addresses.add(33)
+    station = Station(config.station)
+    try:
+        snapshot = station.scan()
+        assert snapshot.states['7D'] is None
+        assert '7D' in snapshot.degraded
+        assert snapshot.states['1A'] is False
+        failing_addresses.clear()
+        time.sleep(0.05)
+        snapshot = station.scan()
+        assert snapshot.states['7D'] is False
+        assert not snapshot.degraded
+    finally:
+        station.stop()
+
+
+def test_open_all_bays_batched(monkeypatch):
+    write_listener = WriteListener()
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', write_listener.sleep)
+
+    station = Station(config.station.copy(update={'max_concurrent_actuations': 8}))
+    try:
+        station.open_all_bays()
+    finally:
+        station.stop()
+
+    # Three pulses of 8 bits each: act1 register 1, act1 register 0, act2 register 0
+    assert [write for write in write_listener.writes if write[4] != 0] == [
+        (0.01, 1, 0x22, 0x01, 0xff),
+        (0.03, 1, 0x22, 0x00, 0xff),
+        (0.05, 1, 0x23, 0x00, 0xff),
+    ]
+    state: Dict[Tuple[int, int, int], int] = {}
+    for write in write_listener.writes:
+        state[write[1:4]] = write[4]
+        assert sum(_count_bits(st) for st in state.values()) <= 8
+
+
+def test_actuator_output_resync(monkeypatch):
+    write_listener = WriteListener()
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', write_listener.sleep)
+
+    controller = ActuatorController(ControllerConfig(controller_id='act', address=0x24, i2c_port=1))
+    controller.configure()
+    write_listener.writes.clear()
+
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', FailingWriteListener())
+    with pytest.raises(OSError):
+        controller.pulse({0x00: 0x01})
+
+    # After the error, the outputs are re-read from the output latch and only the unexpected one is reset
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    write_listener.time = 0.0
+    smbus.SMBus._state['1.36.2'] = 0x01
+    smbus.SMBus._state['1.36.3'] = 0x00
+    controller.pulse({0x00: 0x01})
+    assert write_listener.writes == [
+        (0.0, 1, 0x24, 0x00, 0x00),
+        (0.01, 1, 0x24, 0x00, 0x01),
+        (0.02, 1, 0x24, 0x00, 0x00),
+    ]
+
+
+def test_pulse_switches_off_after_error(monkeypatch):
+    class FailingControllerWriteListener(WriteListener):
+        def __call__(self, port: int, address: int, register: int, data: int) -> int:
+            if address == 0x26 and data != 0:
+                raise OSError("NACK")
+            return super().__call__(port, address, register, data)
+
+    write_listener = FailingControllerWriteListener()
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', write_listener.sleep)
+
+    controllers = [
+        ActuatorController(ControllerConfig(controller_id=f'act{address}', address=address, i2c_port=1, retries=0))
+        for address in (0x25, 0x26)
+    ]
+    for controller in controllers:
+        controller.configure()
+    write_listener.writes.clear()
+
+    with pytest.raises(OSError):
+        pulse_controllers([(controllers[0], {0x00: 0x01}), (controllers[1], {0x00: 0x01})])
+
+    # The output which was switched on before the error is switched off again, the failed one is reset
+    assert write_listener.writes == [
+        (0.01, 1, 0x25, 0x00, 0x01),
+        (0.01, 1, 0x25, 0x00, 0x00),
+        (0.01, 1, 0x26, 0x00, 0x00),
+    ]
+
+
+def test_configure(monkeypatch):
+    write_listener = WriteListener()
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', write_listener.sleep)
+
+    controller = ActuatorController(ControllerConfig(controller_id='act', address=0x25, i2c_port=1))
+    smbus.SMBus._state['1.37.6'] = 0xff
+    smbus.SMBus._state['1.37.7'] = 0x00
+    controller.configure()
+    # Only the registers which differ are written
+    assert write_listener.writes == [(0.0, 1, 0x25, 0x06, 0x00)]
+    write_listener.writes.clear()
+    controller.configure()
+    assert write_listener.writes == []
+
+    # The actuators are configured in the background, failed configurations are retried before actuating
+    station = Station(config.station)
+    try:
+        configure_actuator_controllers = station._configure_actuator_controllers
+        failures = [OSError("NACK")]
+
+        def failing_configure_actuator_controllers(i2c_port: int):
+            if failures:
+                raise failures.pop()
+            configure_actuator_controllers(i2c_port)
+
+        monkeypatch.setattr(station, '_configure_actuator_controllers', failing_configure_actuator_controllers)
+        station.configure()
+        station.get_states()
+        station._actuators_configured[1].exception()
+        station.open_bay('1A')
+        assert not failures
+        assert station._actuators_configured[1].result() is None
+
+        # An actuation moves the queued background configuration ahead of the reads
+        bus_blocked = Event()
+        calls = []
+        station.executor.submit(1, bus_blocked.wait)
+        time.sleep(0.01)
+        station._actuators_configured[1] = station.executor.submit(
+            1, calls.append, 'configure', priority=Priority.background
+        )
+        read_future = station.executor.submit(1, calls.append, 'read')
+        open_thread = Thread(target=station.open_bay, args=('1A',), daemon=True)
+        open_thread.start()
+        time.sleep(0.05)
+        bus_blocked.set()
+        open_thread.join(5)
+        read_future.result()
+        assert calls == ['configure', 'read']
+    finally:
+        station.stop()
+
+
+def test_station_reload(monkeypatch):
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', lambda delay: None)
+    station_config = config.station.copy(update={
+        'state_controllers': [
+            *config.station.state_controllers, ControllerConfig(controller_id='state3', address=0x26, i2c_port=2)
+        ],
+        # Bay 1A is remapped to a new controller on a new bus, 2A is renamed
+        'bays': [
+            ('1A', 'state3', 0x00, 0b00000001, 'act1', 0x01, 0b10000000),
+            ('9Z', *config.station.bays[1][1:]),
+            *config.station.bays[2:],
+        ],
+    })
+    loaded_configs = [config.copy(update={'station': station_config})]
+    monkeypatch.setattr(device_server.api.bay, 'load_config', lambda model_cls: loaded_configs[-1])
+
+    with TestClient(app) as client:
+        station = device_server.api.bay.station
+        state1 = station.state_controllers['state1']
+        epoch = station.epoch
+        smbus.SMBus._state['1.32.0'] = 0xff
+        smbus.SMBus._state['1.32.1'] = 0xff
+        smbus.SMBus._state['1.33.0'] = 0xff
+        smbus.SMBus._state['2.38.0'] = 0xfe
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        etag = resp.headers['etag']
+
+        resp = client.post('/api/v1/device/station/reload')
+        assert resp.status_code == 200, resp.text
+        assert StationReloadResult.validate(resp.json()) == StationReloadResult(
+            reconfigured=['state3'], bays=len(config.station.bays)
+        )
+        # Only the new controller is configured, the others are kept
+        assert smbus.SMBus._state['2.38.6'] == 0xff
+        assert station.state_controllers['state1'] is state1
+        assert station.epoch != epoch
+
+        resp = client.get('/api/v1/device/bays')
+        assert resp.status_code == 200, resp.text
+        assert resp.headers['etag'] != etag
+        assert [r['id'] for r in resp.json()][:2] == ['1A', '9Z']
+        assert [r['id'] for r in resp.json() if r['open']] == ['1A']
+        resp = client.get('/api/v1/device/bays/2A')
+        assert resp.status_code == 404, resp.text
+
+        # Invalid configs are rejected and the bays are kept
+        loaded_configs.append(config.copy(update={
+            'station': station_config.copy(update={'bays': [('1A', 'missing', 0x00, 0x01, 'act1', 0x00, 0x01)]}),
+        }))
+        resp = client.post('/api/v1/device/station/reload')
+        assert resp.status_code == 400, resp.text
+        assert len(station.bays) == len(config.station.bays)
+
+        # If the controllers cannot be configured, the bays are kept and their controllers are configured again
+        read_byte_data = smbus.SMBus.read_byte_data
+
+        def failing_read_byte_data(self, address: int, register: int) -> int:
+            if address == 0x27:
+                raise OSError("NACK")
+            return read_byte_data(self, address, register)
+
+        monkeypatch.setattr(smbus.SMBus, 'read_byte_data', failing_read_byte_data)
+        restored = []
+        restore_controllers = station._restore_controllers
+        monkeypatch.setattr(station, '_restore_controllers', lambda controllers: (
+            restored.extend(controller.controller_id for controller in controllers),
+            restore_controllers(controllers),
+        ))
+        bays = station.bays
+        epoch = station.epoch
+        loaded_configs.append(config.copy(update={'station': station_config.copy(update={
+            'state_controllers': [
+                state1.config.copy(update={'recovery_interval': 1.0}),
+                *station_config.state_controllers[1:],
+                ControllerConfig(controller_id='state4', address=0x27, i2c_port=1),
+            ],
+        })}))
+        resp = client.post('/api/v1/device/station/reload')
+        assert resp.status_code == 503, resp.text
+        assert sorted(restored) == ['state1', 'state4']
+        assert station.bays is bays
+        assert station.epoch == epoch
+        assert station.state_controllers['state1'] is state1
+
+
+def test_metrics():
+    with TestClient(app) as client:
+        resp = client.get('/api/v1/device/bays/1A')
+        assert resp.status_code == 200, resp.text
+
+        resp = client.get('/metrics')
+        assert resp.status_code == 200, resp.text
+        assert 'device_i2c_transaction_seconds_count{controller_id="state1",operation="read"}' in resp.text
+        assert 'device_bus_executor_wait_seconds_count{i2c_port="1"}' in resp.text
+        assert 'device_http_request_seconds_count{method="GET",route="get_bay",status_code="200"}' in resp.text
+
+
+def test_metrics_multiprocess(monkeypatch, tmp_path):
+    # Another process, e.g. the hardware process, writes its metrics into the shared directory.
+    subprocess.run(
+        [
+            sys.executable, '-c',
+            "from device_server.metrics import I2C_RETRIES; I2C_RETRIES.labels(controller_id='state9').inc(3)",
+        ],
+        env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(tmp_path)},
+        check=True,
+    )
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    with TestClient(app) as client:
+        resp = client.get('/metrics')
+        assert resp.status_code == 200, resp.text
+        assert 'device_i2c_retries_total{controller_id="state9"} 3.0' in resp.text
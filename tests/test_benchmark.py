@@ -0,0 +1,41 @@
+import device_server.bay.controller
+from benchmarks.bench_hardware import run_benchmarks
+from benchmarks.timed_smbus import BusTiming, TimedSMBus
+from device_server.config import config
+
+
+def test_benchmark_transactions(monkeypatch):
+    monkeypatch.setattr(device_server.bay.controller, 'SMBus', TimedSMBus)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', lambda delay: None)
+
+    # Sequential requests, such that no reads are coalesced and the counts are exact.
+    results = {
+        result.name: result
+        for result in run_benchmarks(
+            iterations=20, concurrency=1, actuation_iterations=2, timing=BusTiming(us_per_byte=1.0)
+        )
+    }
+    assert all(result.errors == 0 for result in results.values())
+    assert results['Station.get_states'].samples == 20
+    assert results['POST /bays/1A/open'].samples == 2
+    # One read per state register, not per bay
+    assert results['Station.get_states'].transactions_per_request == 3
+    assert results['Station.get_state'].transactions_per_request == 1
+    # Only the pulse is written, the outputs are known to be off
+    assert results['Station.open_bay'].transactions_per_request == 2
+    assert results['Station.open_all_bays'].transactions_per_request == 2 * len(config.station.bays)
+    assert results['GET /bays'].transactions_per_request == 3
+    assert results['GET /bays/1A'].transactions_per_request == 1
+    assert results['POST /bays/1A/open'].transactions_per_request == 2
+
+
+def test_benchmark_nack():
+    smbus_cls = device_server.bay.controller.SMBus
+    results = run_benchmarks(
+        iterations=20, concurrency=1, actuation_iterations=0, timing=BusTiming(us_per_byte=1.0, nack_probability=0.5),
+        http=False,
+    )
+    assert results[0].name == 'Station.get_states'
+    assert 0 < results[0].errors < 20
+    # The bus of the controllers is restored
+    assert device_server.bay.controller.SMBus is smbus_cls
@@ -1,24 +1,38 @@
+import asyncio
 import httpx
+import sys
 from fastapi.testclient import TestClient
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import device_server.api.auth
 from device_server.api import app
-from device_server.card.reader import CardAuthConfig
+from device_server.card.reader import CardAuthConfig, CardReader
 from device_server.config import config
+from device_server.model.auth import CardModel
 
 
 class MockCardReader:
     card_id: Optional[str] = None
+    wait_timeout: Optional[float] = None
+
+    def __init__(self):
+        self.listeners = []
     config: Optional[CardAuthConfig] = None
 
     def start(self):
         pass
 
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
     def stop(self):
         pass
 
-    def read_card_id(self) -> str:
+    def read_card_id(self) -> Optional[str]:
+        return self.card_id
+
+    async def wait_card_id(self, timeout: float) -> Optional[str]:
+        self.wait_timeout = timeout
         return self.card_id
 
     def __call__(self, config: CardAuthConfig):
@@ -28,7 +42,9 @@ class MockCardReader:
 
 class MockAsyncClient:
 
-    calls = []
+    calls: List[Tuple[str, str, Dict[str, Any]]] = []
+    client_kwargs = None
+    status_code = 200
 
     async def post(
             self,
@@ -36,7 +52,7 @@ class MockAsyncClient:
             **kwargs
     ) -> httpx.Response:
         self.calls.append(('POST', url, kwargs))
-        return httpx.Response(200, request=httpx.Request(
+        return httpx.Response(self.status_code, request=httpx.Request(
             'POST',
             url,
             params=kwargs.get('params'),
@@ -48,12 +64,10 @@ class MockAsyncClient:
         ))
 
     def __call__(self, *args, **kwargs):
+        self.client_kwargs = kwargs
         return self
 
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
+    async def aclose(self):
         pass
 
 
@@ -69,6 +83,7 @@ def test_card_auth(monkeypatch):
 
     with TestClient(app) as client:
         assert mock_card_reader.config == config.card_auth
+        assert mock_async_client.client_kwargs['timeout'] == config.card_auth.http_timeout
 
         resp = client.get('/api/v1/auth')
         assert resp.status_code == 204, resp.text
@@ -86,3 +101,104 @@ def test_card_auth(monkeypatch):
                 'headers': {'X-Card-Api-Key': config.card_auth.card_login_api_key},
             },
         )
+
+        mock_card_reader.card_id = 'CARD_ID_1'
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 200, resp.text
+        assert len(mock_async_client.calls) == 2
+
+        # Repeated taps are answered from the cache
+        mock_card_reader.card_id = 'CARD_ID_0'
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 200, resp.text
+        assert len(mock_async_client.calls) == 2
+
+        # Unregistered cards are cached as well
+        mock_async_client.status_code = 404
+        mock_card_reader.card_id = 'CARD_ID_2'
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 404, resp.text
+        assert CardModel.validate(resp.json()) == CardModel(card_id='CARD_ID_2')
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 404, resp.text
+        assert CardModel.validate(resp.json()) == CardModel(card_id='CARD_ID_2')
+        assert len(mock_async_client.calls) == 3
+
+        # Registering the card invalidates the cached result
+        mock_async_client.status_code = 200
+        resp = client.post('/api/v1/authregister', json={'cardId': 'CARD_ID_2'})
+        assert resp.status_code == 200, resp.text
+        assert mock_async_client.calls[-1][:2] == ('POST', 'http://localhost/test/card/register')
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 200, resp.text
+        assert len(mock_async_client.calls) == 5
+        assert mock_async_client.calls[-1][:2] == ('POST', 'http://localhost/test/card/authorize')
+
+        # Authorization is started as soon as the card is read
+        for listener in mock_card_reader.listeners:
+            listener('CARD_ID_3')
+        assert 'CARD_ID_3' in device_server.api.auth.authorizer.prefetched
+        mock_card_reader.card_id = 'CARD_ID_3'
+        resp = client.get('/api/v1/auth')
+        assert resp.status_code == 200, resp.text
+        assert len(mock_async_client.calls) == 6
+        assert mock_async_client.calls[-1][2]['json'] == {'card_id': 'CARD_ID_3'}
+        assert 'CARD_ID_3' not in device_server.api.auth.authorizer.prefetched
+
+        mock_card_reader.card_id = None
+        resp = client.get('/api/v1/auth', params={'wait': 5})
+        assert resp.status_code == 204, resp.text
+        assert mock_card_reader.wait_timeout == 5
+
+
+class MockMifare:
+    card_id: Optional[bytes] = None
+
+    def select(self) -> bytes:
+        if self.card_id is None:
+            raise MockNxppy.SelectError()
+        return self.card_id
+
+
+class MockNxppy:
+    class SelectError(Exception):
+        pass
+
+    mifare = MockMifare()
+
+    def Mifare(self) -> MockMifare:
+        return self.mifare
+
+
+def test_card_reader_wait(monkeypatch):
+    mock_nxppy = MockNxppy()
+    monkeypatch.setitem(sys.modules, 'nxppy', mock_nxppy)
+
+    async def run():
+        card_reader = CardReader(CardAuthConfig(
+            server_url='http://localhost/test',
+            client_id='depot',
+            card_associate_login_timeout=10,
+            card_poll_interval=0.01,
+            card_idle_poll_interval=0.02,
+        ))
+        card_reader.start()
+        try:
+            assert await card_reader.wait_card_id(0.05) is None
+            loop = asyncio.get_event_loop()
+            loop.call_later(0.05, setattr, mock_nxppy.mifare, 'card_id', b'\x01\x02')
+            start = loop.time()
+            assert await card_reader.wait_card_id(5) == '0102'
+            assert loop.time() - start < 1
+            # The same card is not returned twice
+            assert await card_reader.wait_card_id(0.1) is None
+        finally:
+            card_reader.stop()
+
+    # Not asyncio.run, which unsets the event loop of the main thread. The test client of the tests which run later
+    # (e.g. test_hardware, test_journal) gets that loop with asyncio.get_event_loop().
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import device_server.config.base
+from device_server.bay.station import StationConfig
+from device_server.config import Config
+from device_server.config.base import DEFAULT_PATH, load_config
+
+
+def test_load_config(monkeypatch, tmp_path):
+    cache_path = str(tmp_path / 'cache' / 'config.pickle')
+    monkeypatch.setenv('API_CONFIG_HARDWARE_SOCKET_PATH', '/tmp/device_server.sock')
+    monkeypatch.setenv('API_CONFIG_STATION_STATE_CONTROLLERS_1_ADDRESS', '0x30')
+    monkeypatch.setenv('API_CONFIG_STATION_BAYS_0', "['0A', 'state1', 0, 1, 'act1', 0, 1]")
+
+    config = load_config(Config, DEFAULT_PATH, cache_path=cache_path)
+    assert config.hardware.socket_path == '/tmp/device_server.sock'
+    assert config.station.state_controllers[1].address == 0x30
+    assert config.station.bays[0][0] == '0A'
+
+    # The validated config is loaded from the cache without parsing the file again
+    def load_yaml(*args, **kwargs):
+        raise AssertionError("Config file parsed again")
+
+    with monkeypatch.context() as m:
+        m.setattr(device_server.config.base.yaml, 'load', load_yaml)
+        assert load_config(Config, DEFAULT_PATH, cache_path=cache_path) == config
+
+    # Changed overrides invalidate the cache
+    monkeypatch.setenv('API_CONFIG_STATION_STATE_CONTROLLERS_1_ADDRESS', '0x31')
+    assert load_config(Config, DEFAULT_PATH, cache_path=cache_path).station.state_controllers[1].address == 0x31
+
+    # A cache which others can write to is not trusted
+    os.chmod(cache_path, 0o666)
+    with monkeypatch.context() as m:
+        m.setattr(device_server.config.base.yaml, 'load', load_yaml)
+        with pytest.raises(AssertionError):
+            load_config(Config, DEFAULT_PATH, cache_path=cache_path)
+
+    # Overrides of nodes which do not exist are rejected
+    monkeypatch.setenv('API_CONFIG_STATION_STATE_CONTROLLERS_5_ADDRESS', '0x31')
+    with pytest.raises(ValueError):
+        load_config(Config, DEFAULT_PATH, cache_path=None)
+
+
+def test_station_config_staleness():
+    station_config = load_config(Config, DEFAULT_PATH, cache_path=None).station.dict()
+    # Requests would read the bus while the idle scanner waits
+    with pytest.raises(ValueError):
+        StationConfig.validate({**station_config, 'scan_interval': 2.0, 'max_staleness': 1.0})
+    StationConfig.validate({**station_config, 'scan_interval': 2.0, 'max_staleness': 2.0})
+    # The interrupt keeps the snapshot fresh
+    StationConfig.validate({**station_config, 'scan_interval': 60.0, 'max_staleness': 1.0, 'interrupt_gpio': 17})
+
+
+def test_station_config_bays():
+    station_config = load_config(Config, DEFAULT_PATH, cache_path=None).station.dict()
+    # Registers and masks are bytes
+    with pytest.raises(ValueError):
+        StationConfig.validate({**station_config, 'bays': [('1A', 'state1', 0x00, 0x100, 'act1', 0x00, 0x01)]})
+    with pytest.raises(ValueError):
+        StationConfig.validate({**station_config, 'bays': [('1A', 'state1', 0x00, 0x01, 'act1', -1, 0x01)]})
+    StationConfig.validate({**station_config, 'bays': [('1A', 'state1', 0x00, 0xff, 'act1', 0x01, 0x01)]})
+    # Bay ids fit into the journal records
+    with pytest.raises(ValueError):
+        StationConfig.validate({**station_config, 'bays': [('Ä' * 8, 'state1', 0x00, 0x01, 'act1', 0x00, 0x01)]})
+    StationConfig.validate({**station_config, 'bays': [('Ä' * 7 + 'A', 'state1', 0x00, 0x01, 'act1', 0x00, 0x01)]})
@@ -0,0 +1,260 @@
+import asyncio
+import socket
+import socketserver
+import time
+from fastapi.testclient import TestClient
+from threading import Thread, Timer, current_thread
+from typing import List, Optional
+
+import device_server.api.auth
+import device_server.api.bay
+import device_server.bay.controller
+import smbus
+from device_server.api import app
+from device_server.bay.scanner import StateSnapshot
+from device_server.bay.station import Station
+from device_server.card.authorizer import DepotResponse
+from device_server.config import config
+from device_server.hardware.client import HardwareClient, RemoteStation
+from device_server.hardware.protocol import HardwareConfig, read_message, send_message
+from device_server.hardware.server import HardwareServer
+from device_server.hardware.shared import SharedSnapshotReader, SharedSnapshotWriter
+from device_server.model import BayState
+from device_server.model.auth import CardModel
+
+
+class WriteListener:
+    def __init__(self):
+        self.writes: List[tuple] = []
+
+    def __call__(self, port: int, address: int, register: int, data: int):
+        self.writes.append((port, address, register, data))
+
+
+class MockCardReader:
+    card_id: Optional[str] = None
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def read_card_id(self) -> Optional[str]:
+        card_id = self.card_id
+        self.card_id = None
+        return card_id
+
+    async def wait_card_id(self, timeout: float) -> Optional[str]:
+        return self.read_card_id()
+
+
+class MockAuthorizer:
+    def __init__(self):
+        self.prefetched: List[str] = []
+        self.registered: List[CardModel] = []
+
+    def prefetch(self, card_id: str):
+        self.prefetched.append(card_id)
+
+    async def authorize(self, card_id: str) -> DepotResponse:
+        content = b'{"redirectUri": "/' + card_id.encode() + b'"}'
+        return DepotResponse(200, content, {'content-type': 'application/json'})
+
+    async def register(self, card: CardModel) -> DepotResponse:
+        self.registered.append(card)
+        return DepotResponse(201, b'', {})
+
+
+def test_shared_snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    reader = SharedSnapshotReader(path, ['1A', '2A'])
+    assert reader.read() is None
+    writer = SharedSnapshotWriter(path, 2, 'abcd', scanner=True)
+    try:
+        assert reader.read() is None
+        writer.publish(StateSnapshot(version=3, timestamp=12.5, states={'1A': True, '2A': False}))
+        assert reader.read() == (
+            'abcd', True, StateSnapshot(version=3, timestamp=12.5, states={'1A': True, '2A': False})
+        )
+        writer.publish(StateSnapshot(version=4, timestamp=13.5, states={'1A': False, '2A': False}))
+        assert reader.read() == (
+            'abcd', True, StateSnapshot(version=4, timestamp=13.5, states={'1A': False, '2A': False})
+        )
+        # Bays which were never read successfully
+        writer.publish(StateSnapshot(version=5, timestamp=14.5, states={'1A': False, '2A': None}, degraded={'2A'}))
+        assert reader.read() == (
+            'abcd', True,
+            StateSnapshot(version=5, timestamp=14.5, states={'1A': False, '2A': None}, degraded=frozenset({'2A'})),
+        )
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_hardware_client_reconnect(tmp_path):
+    socket_path = str(tmp_path / 'hardware.sock')
+    connections: List[socket.socket] = []
+
+    class EchoHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            connections.append(self.request)
+            while True:
+                try:
+                    request = read_message(self.rfile)
+                except OSError:
+                    return
+                if request is None:
+                    return
+                send_message(self.wfile, {'result': request['method']})
+
+    server = socketserver.ThreadingUnixStreamServer(socket_path, EchoHandler)
+    server.daemon_threads = True
+    server_thread = Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    client = HardwareClient(socket_path)
+    try:
+        assert client.call('info') == 'info'
+        client._connections.append(client._connect())
+        deadline = time.monotonic() + 5
+        while len(connections) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+        # A restarted hardware process closed the idle connections
+        for connection in connections:
+            connection.shutdown(socket.SHUT_RDWR)
+        assert client.call('scan') == 'scan'
+        assert len(client._connections) == 1
+        assert len(connections) == 3
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+
+
+def test_remote_station(monkeypatch, tmp_path):
+    hardware_config = HardwareConfig(socket_path=str(tmp_path / 'hardware.sock'), snapshot_path=str(tmp_path / 'shm'))
+    monkeypatch.setattr(config.station, 'scan_interval', 0.01)
+    write_listener = WriteListener()
+    monkeypatch.setattr(smbus.SMBus, '_write_listener', write_listener)
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', lambda delay: None)
+
+    loop = asyncio.new_event_loop()
+    loop_thread = Thread(target=loop.run_forever)
+    loop_thread.start()
+    station = Station(config.station)
+    station.configure()
+    card_reader = MockCardReader()
+    authorizer = MockAuthorizer()
+    server = HardwareServer(station, card_reader, authorizer, hardware_config, loop)
+    server.start()
+    # Set before the scanner starts, such that the first published snapshot already shows them.
+    smbus.SMBus._state['1.32.0'] = 0xff
+    smbus.SMBus._state['1.32.1'] = 0x7f
+    smbus.SMBus._state['1.33.0'] = 0xff
+    station.start()
+    try:
+        monkeypatch.setattr(config, 'hardware', hardware_config)
+        with TestClient(app) as client:
+            remote_station = device_server.api.bay.station
+            assert isinstance(remote_station, RemoteStation)
+            assert remote_station.epoch == station.epoch
+
+            deadline = time.monotonic() + 5
+            while remote_station.get_snapshot() is None:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            resp = client.get('/api/v1/device/bays/1A')
+            assert resp.status_code == 200, resp.text
+            assert BayState.validate(resp.json()) == BayState(id='1A', open=True)
+            resp = client.get('/api/v1/device/bays')
+            assert resp.status_code == 200, resp.text
+            assert [r['id'] for r in resp.json() if r['open']] == ['1A']
+            assert resp.headers['etag'] == f'"{station.epoch}-{station.get_snapshot().version}"'
+
+            # State changes are forwarded to the waiting requests of the worker
+            timer = Timer(0.1, lambda: smbus.SMBus._state.__setitem__('1.32.1', 0xff))
+            timer.start()
+            try:
+                resp = client.get('/api/v1/device/bays/1A', params={'wait_until': 'closed', 'timeout': 5})
+            finally:
+                timer.cancel()
+            assert resp.status_code == 200, resp.text
+            assert BayState.validate(resp.json()) == BayState(id='1A', open=False)
+
+            write_listener.writes.clear()
+            resp = client.post('/api/v1/device/bays/1A/open')
+            assert resp.status_code == 200, resp.text
+            assert write_listener.writes == [
+                (1, 0x22, 0x01, 0b10000000), (1, 0x22, 0x01, 0),
+            ]
+
+            remote_card_reader = device_server.api.auth.card_reader
+            card_reader.card_id = '0102'
+            assert remote_card_reader.read_card_id() == '0102'
+            assert remote_card_reader.read_card_id() is None
+            # Long polls wait on the event loop, not in the thread pool
+            card_reader.card_id = '0506'
+            wait_loop = asyncio.new_event_loop()
+            try:
+                assert wait_loop.run_until_complete(remote_card_reader.wait_card_id(1)) == '0506'
+            finally:
+                wait_loop.close()
+
+            # The read card is authorized once by the hardware process, not by every worker
+            for listener in card_reader.listeners:
+                loop.call_soon_threadsafe(listener, '0304')
+            deadline = time.monotonic() + 5
+            while not authorizer.prefetched:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            assert authorizer.prefetched == ['0304']
+            card_reader.card_id = '0304'
+            resp = client.get('/api/v1/auth')
+            assert resp.status_code == 200, resp.text
+            assert resp.json() == {'redirectUri': '/0304'}
+            resp = client.post('/api/v1/authregister', json={'cardId': '0708'})
+            assert resp.status_code == 201, resp.text
+            assert authorizer.registered == [CardModel(card_id='0708')]
+
+            # A changed epoch is not fetched by the caller of get_snapshot, which is the event loop
+            calling_threads = []
+            call = remote_station._client.call
+
+            def recording_call(*args):
+                calling_threads.append(current_thread())
+                return call(*args)
+
+            with monkeypatch.context() as m:
+                m.setattr(remote_station._client, 'call', recording_call)
+                m.setattr(remote_station, 'epoch', 'stale')
+                assert remote_station.get_snapshot() is None
+            assert current_thread() not in calling_threads
+
+            # Bays reloaded by the hardware process are picked up by the worker
+            station_config = config.station.copy(update={
+                'bays': [('9Z', *config.station.bays[0][1:]), *config.station.bays[1:]],
+            })
+            monkeypatch.setattr(
+                device_server.api.bay, 'load_config', lambda model_cls: config.copy(update={'station': station_config})
+            )
+            resp = client.post('/api/v1/device/station/reload')
+            assert resp.status_code == 200, resp.text
+            assert resp.json()['reconfigured'] == []
+            deadline = time.monotonic() + 5
+            while '9Z' not in remote_station.bays or remote_station.get_snapshot() is None:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            assert remote_station.epoch == station.epoch
+            resp = client.get('/api/v1/device/bays')
+            assert resp.status_code == 200, resp.text
+            assert [r['id'] for r in resp.json()][0] == '9Z'
+            assert resp.headers['etag'] == f'"{station.epoch}-{station.get_snapshot().version}"'
+    finally:
+        station.stop()
+        server.stop()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
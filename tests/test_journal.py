@@ -0,0 +1,75 @@
+import asyncio
+import json
+import os
+import time
+from fastapi.testclient import TestClient
+
+import device_server.api.bay
+import device_server.bay.controller
+from device_server.api import app
+from device_server.bay.journal import Journal, JournalConfig, JournalEvent, JournalEventType, JournalReader
+from device_server.config import config
+
+
+def test_journal(tmp_path):
+    journal_config = JournalConfig(path=str(tmp_path), segment_records=4, max_segments=3, flush_interval=0.01)
+    journal = Journal(journal_config)
+    journal.record(JournalEvent(float(i + 1), JournalEventType.opened, f'{i % 2}A') for i in range(10))
+    journal.stop()
+    assert len(os.listdir(tmp_path)) == 3
+    reader = JournalReader(str(tmp_path))
+    assert [event.timestamp for event in reader.query()] == [float(i + 1) for i in range(10)]
+    assert [event.timestamp for event in reader.query(['1A'], start=3.0, end=8.0)] == [4.0, 6.0, 8.0]
+    assert list(reader.query(start=11.0)) == []
+
+    # Appends to the last segment after a restart, the oldest segments are rotated out
+    journal = Journal(journal_config)
+    # Recorded before the journal thread starts, such that they are written in one batch
+    journal.record_actuation(['1A', '2A'], 12.0)
+    journal.record([JournalEvent(11.0, JournalEventType.opened, '3A')])
+    journal.record_actuation(['4A'], 5.0)
+    journal.start()
+    journal.stop()
+    events = list(reader.query())
+    # A batch is written in order, timestamps before the already written ones are raised to them
+    assert [event.timestamp for event in events] == [float(i + 1) for i in range(4, 10)] + [10.0, 11.0, 12.0, 12.0]
+    assert events[-4:] == [
+        JournalEvent(10.0, JournalEventType.actuated, '4A'),
+        JournalEvent(11.0, JournalEventType.opened, '3A'),
+        JournalEvent(12.0, JournalEventType.actuated, '1A'),
+        JournalEvent(12.0, JournalEventType.actuated, '2A'),
+    ]
+
+
+def test_journal_api(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        config, 'journal', JournalConfig(path=str(tmp_path / 'journal'), flush_interval=0.01)
+    )
+    monkeypatch.setattr(device_server.bay.controller, 'sleep', lambda delay: None)
+
+    with TestClient(app) as client:
+        started = time.time()
+        resp = client.post('/api/v1/device/bays/1A/open')
+        assert resp.status_code == 200, resp.text
+        resp = client.post('/api/v1/device/bays/2A/open')
+        assert resp.status_code == 200, resp.text
+
+        # Read from the endpoint directly, see test_bay_events_sse_without_scanner.
+        async def read_journal() -> str:
+            response = await device_server.api.bay.get_journal(['2A'], started, None)
+            return ''.join([chunk async for chunk in response.body_iterator])
+
+        loop = asyncio.new_event_loop()
+        try:
+            deadline = time.monotonic() + 5
+            while True:
+                text = loop.run_until_complete(read_journal())
+                if text:
+                    break
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+        finally:
+            loop.close()
+        events = [json.loads(line) for line in text.splitlines()]
+        assert [(event['id'], event['event']) for event in events] == [('2A', 'actuated')]
+        assert events[0]['timestamp'] >= started